@@ -0,0 +1,187 @@
+# Export and import of a chat's records. Archive is records as they are stored (still encrypted with the chat's key).
+# The key is derived from the password, and it changes when the password-hash is upgraded or the password is
+# changed. So the header also keeps the KDF parameters and salt of the key. An archive made with another key is
+# imported once the user sends the password it was made with, and its records are then re-encrypted with the
+# chat's current key. Archive is MAGIC, KDF parameters and salt (each prefixed by its length, see
+# crypto.key_params()), key check (see key_check()) and zlib stream of records, every record being
+#	version (1 byte), timestamp (8), data_size (8), number of chunks (4),
+#	ciphertext of label (empty if none), ciphertext (or stream header of multi-part record) and chunks,
+#	each of them prefixed by its length (4).
+# Archives of version 1 have no labels, archives of versions 1 and 2 have no KDF parameters (only the current key of
+# the chat is tried). Index tokens of labels are not exported, they are made again on import
+# Records are read from DB by a cursor and written one by one, imported records are inserted in batches, so memory
+# used by both does not depend on number of records
+import hashlib, hmac, logging, struct, zlib
+
+import db_handler as dbh
+from db_handler import Record, RecordChunk
+from crypto import open_label, label_words, label_tokens, open_record, seal_record, rekey_chunk, password_key, key_params
+from constants import *
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SSA\x03'
+MAGIC_V2 = b'SSA\x02'
+MAGIC_V1 = b'SSA\x01'
+KEY_CHECK_SIZE = 16
+_RECORD = struct.Struct('>BQQI')
+_LENGTH = struct.Struct('>I')
+
+# Returns value identifying key of the chat, which made archive (without revealing the key)
+def key_check(key):
+	return hmac.new(key, b'securestore archive', hashlib.sha256).digest()[:KEY_CHECK_SIZE]
+
+def _field(data):
+	return _LENGTH.pack(len(data)) + data
+
+# Writes archive of all records of given chat (whose password-hash is given) to binary file out. Returns number of
+# exported records
+def export_records(chat_id, hash, out, level=ARCHIVE_COMPRESS_LEVEL):
+	key = password_key(hash)
+	params, salt = key_params(hash)
+	out.write(MAGIC + _field((params or '').encode()) + _field(salt or b'') + key_check(key))
+	deflater = zlib.compressobj(level)
+	uid = dbh.get_chat_uid(chat_id)
+	records = 0
+	if uid is not None:
+		query = Record.select(Record.id, Record.timestamp, Record.version, Record.data, Record.payload, Record.data_size,
+							  Record.header, Record.chunks, Record.label).where(Record.chat_uid == uid).order_by(Record.id)
+		with dbh.db.atomic():
+			for record_uid, timestamp, version, data, payload, size, header, chunks, label in query.tuples().iterator():
+				out.write(deflater.compress(_RECORD.pack(version, timestamp, size, chunks) + _field(label or b'')))
+				if chunks > 0:
+					out.write(deflater.compress(_field(header)))
+					for chunk in dbh.iter_chunks(record_uid):
+						out.write(deflater.compress(_field(chunk)))
+				else:
+					out.write(deflater.compress(_field(data.encode() if payload is None else payload)))
+				records += 1
+	out.write(deflater.flush())
+	return records
+
+# Reads exact amounts of bytes from zlib stream of archive, decompressing at most ARCHIVE_READ_SIZE at once
+class _Reader:
+	def __init__(self, stream):
+		self.stream = stream
+		self.inflater = zlib.decompressobj()
+		self.buffer = bytearray()
+
+	def _fill(self):
+		data = self.inflater.unconsumed_tail
+		if not data:
+			data = self.stream.read(ARCHIVE_READ_SIZE)
+			if not data:
+				return False
+		try:
+			self.buffer += self.inflater.decompress(data, ARCHIVE_READ_SIZE)
+		except zlib.error:
+			raise ValueError('Archive is corrupted')
+		return True
+
+	def read(self, size):
+		while len(self.buffer) < size:
+			if not self._fill():
+				raise ValueError('Archive is truncated')
+		data = bytes(self.buffer[:size])
+		del self.buffer[:size]
+		return data
+
+	def field(self):
+		size, = _LENGTH.unpack(self.read(_LENGTH.size))
+		if size > ARCHIVE_MAX_FIELD:
+			raise ValueError('Archive is corrupted')
+		return self.read(size)
+
+	def at_end(self):
+		while len(self.buffer) == 0:
+			if not self._fill():
+				if not self.inflater.eof:
+					raise ValueError('Archive is truncated')
+				return True
+		return False
+
+def _read(stream, size):
+	data = stream.read(size)
+	if len(data) != size:
+		raise ValueError('Archive is truncated')
+	return data
+
+# Reads header of archive from binary file stream. Returns tuple (magic, KDF parameters, salt, key check), parameters
+# and salt being None if the archive does not tell them. Raises ValueError if stream is not an archive
+def read_header(stream):
+	magic = stream.read(len(MAGIC))
+	if magic not in (MAGIC, MAGIC_V2, MAGIC_V1):
+		raise ValueError('File is not an archive of records')
+	params = salt = None
+	if magic == MAGIC:
+		params = _read(stream, _LENGTH.unpack(_read(stream, _LENGTH.size))[0]).decode() or None
+		salt = _read(stream, _LENGTH.unpack(_read(stream, _LENGTH.size))[0]) or None
+	return magic, params, salt, _read(stream, KEY_CHECK_SIZE)
+
+# Checks if archive with given header can be imported with key of given password-hash, without asking for password
+def made_with(header, hash):
+	_, params, salt, _ = header
+	return (params is None and salt is None) or (params, salt) == key_params(hash)
+
+def _reseal(payload, source_key, key):
+	return seal_record(open_record(RECORD_VERSION, None, payload, source_key), key)
+
+# Adds records from archive (binary file stream, positioned after header read by read_header()) to given chat in one
+# transaction. Records of archive made with another key (source_key) are re-encrypted with the chat's key.
+# Returns number of imported records. Raises ValueError if archive is damaged or was made with other key
+def import_records(chat_id, key, stream, header, source_key=None, batch=ARCHIVE_BATCH, chunk_batch=ARCHIVE_CHUNK_BATCH):
+	magic = header[0]
+	source_key = source_key or key
+	if not hmac.compare_digest(header[3], key_check(source_key)):
+		raise ValueError('Archive was made with another password')
+	reseal = source_key != key
+	reader = _Reader(stream)
+	uid = dbh.ensure_chat_uid(chat_id)
+	rows, records = [], 0
+	with dbh.db.atomic():
+		while not reader.at_end():
+			version, timestamp, size, chunks = _RECORD.unpack(reader.read(_RECORD.size))
+			row = {'chat_uid': uid, 'timestamp': timestamp, 'data_size': size, 'version': version,
+				   'data': None, 'payload': None, 'header': None, 'chunks': chunks, 'label': None}
+			label = reader.field() if magic != MAGIC_V1 else b''
+			data = reader.field()
+			if reseal and label:
+				label = _reseal(label, source_key, key)
+			if chunks > 0:
+				row['header'] = data
+			elif reseal:
+				row['payload'] = seal_record(open_record(version, data, data, source_key), key)
+				row['version'] = RECORD_VERSION
+			elif version == 1:
+				row['data'] = data.decode()
+			else:
+				row['payload'] = data
+			if chunks == 0 and not label:
+				rows.append(row)
+				if len(rows) >= batch:
+					Record.insert_many(rows).execute()
+					rows = []
+			else:
+				# Records, whose id is needed, are inserted one by one (in order of the archive)
+				if rows:
+					Record.insert_many(rows).execute()
+					rows = []
+				row['label'] = label or None
+				record_uid = Record.insert(**row).execute()
+				if label:
+					dbh.add_tokens(uid, record_uid, label_tokens(label_words(open_label(label, key)), key))
+				pending = []
+				for seq in range(chunks):
+					chunk = reader.field()
+					if reseal:
+						chunk = rekey_chunk(source_key, key, data, seq, chunk)
+					pending.append({'record_uid': record_uid, 'upload': None, 'seq': seq, 'data': chunk,
+									'last': seq == chunks - 1})
+					if len(pending) >= chunk_batch or seq == chunks - 1:
+						RecordChunk.insert_many(pending).execute()
+						pending = []
+			records += 1
+		if rows:
+			Record.insert_many(rows).execute()
+	logger.info('Imported {0} records to chat_id=\'{1}\''.format(records, chat_id))
+	return records
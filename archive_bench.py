@@ -0,0 +1,81 @@
+# Benchmark of export and import of records (see archive.py): throughput, archive size and peak memory allocated
+# by Python (tracemalloc, measured by separate runs) for growing number of records. Peak memory should not depend
+# on number of records. Every MULTIPART-th record is a multi-part one of CHUNKS chunks
+# Usage: python archive_bench.py [records]
+import os, random, shutil, sys, tempfile, time, tracemalloc
+
+import db_handler as dbh
+from db_handler import Record, RecordChunk
+from crypto import get_hash, seal_record, new_stream_header, encrypt_chunks
+from archive import export_records, import_records, read_header
+from util import timestamp_now
+
+SIZES = (10000, 100000)
+DISTINCT = 1000
+MULTIPART = 1000
+CHUNKS = 4
+BATCH = 5000
+
+random.seed(42)
+
+# Fills chat with given number of records, sealing only DISTINCT of them (sealing is not what is measured)
+def fill(chat_id, key, records):
+	uid = dbh.ensure_chat_uid(chat_id)
+	secrets = [os.urandom(random.randint(16, 512)) for _ in range(DISTINCT)]
+	payloads = [seal_record(s, key) for s in secrets]
+	with dbh.db.atomic():
+		rows = []
+		for i in range(records):
+			if i % MULTIPART == MULTIPART - 1:
+				header = new_stream_header()
+				record_uid = Record.insert(chat_uid=uid, timestamp=timestamp_now(), data_size=CHUNKS * 1024,
+										   header=header, chunks=CHUNKS).execute()
+				chunks = encrypt_chunks(key, header, 0, [os.urandom(1024) for _ in range(CHUNKS)], last=True)
+				RecordChunk.insert_many([{'record_uid': record_uid, 'seq': seq, 'data': c}
+										 for seq, c in enumerate(chunks)]).execute()
+				continue
+			rows.append({'chat_uid': uid, 'timestamp': timestamp_now(), 'payload': payloads[i % DISTINCT],
+						 'data_size': len(secrets[i % DISTINCT]), 'version': 2})
+			if len(rows) == BATCH:
+				Record.insert_many(rows).execute()
+				rows = []
+		if rows:
+			Record.insert_many(rows).execute()
+
+# Runs fn measuring its time
+def timed(fn, *args):
+	start = time.perf_counter()
+	return fn(*args), time.perf_counter() - start
+
+# Runs fn measuring peak of memory allocated meanwhile (tracemalloc slows it down, so it is not timed)
+def peak(fn, *args):
+	tracemalloc.start()
+	fn(*args)
+	result = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return result
+
+if __name__ == '__main__':
+	sizes = (int(sys.argv[1]),) if len(sys.argv) > 1 else SIZES
+	directory = tempfile.mkdtemp()
+	key = get_hash('benchmark')
+	print('  {0:>10}{1:>14}{2:>14}{3:>14}{4:>14}{5:>14}'.format('records', 'archive, MiB', 'export rec/s',
+																'export peak', 'import rec/s', 'import peak'))
+	for size in sizes:
+		dbh.init(os.path.join(directory, '{0}.db'.format(size)))
+		fill(1, key, size)
+		path = os.path.join(directory, '{0}.ssa'.format(size))
+		with open(path, 'wb') as out:
+			exported, export_time = timed(export_records, 1, key, out)
+		with open(path, 'wb') as out:
+			export_peak = peak(export_records, 1, key, out)
+		with open(path, 'rb') as stream:
+			imported, import_time = timed(lambda: import_records(2, key, stream, read_header(stream)))
+		with open(path, 'rb') as stream:
+			import_peak = peak(lambda: import_records(3, key, stream, read_header(stream)))
+		assert exported == imported == size and dbh.count_records(2) == size
+		print('  {0:>10}{1:>14.1f}{2:>14.0f}{3:>11.0f} KiB{4:>14.0f}{5:>11.0f} KiB'.format(
+			size, os.path.getsize(path) / 2 ** 20, exported / export_time, export_peak / 1024,
+			imported / import_time, import_peak / 1024))
+		dbh.close()
+	shutil.rmtree(directory)
@@ -0,0 +1,102 @@
+import logging, queue, threading
+
+from telegram.error import RetryAfter, TimedOut, NetworkError, BadRequest, InvalidToken
+
+import outbox
+from constants import *
+
+logger = logging.getLogger(__name__)
+
+# Background pipeline deleting messages of finished sessions, so that logout does not wait for hundreds of HTTP calls.
+# Message ids are deleted in bulk (deleteMessages, up to CLEANUP_BATCH ids per call) if Bot API supports it
+# and one by one otherwise, by CLEANUP_WORKERS threads. Calls go through the outbox with the lowest priority, so
+# they neither delay replies nor exceed flood limits, and are retried by it on flood control and network errors
+class Cleaner:
+	def __init__(self, workers=CLEANUP_WORKERS, batch=CLEANUP_BATCH, retries=CLEANUP_RETRIES, bulk=CLEANUP_BULK):
+		self.workers = workers
+		self.batch = batch
+		self.retries = retries
+		self.bulk = bulk
+		self._queue = queue.Queue()
+		self._threads = []
+		self._lock = threading.Lock()
+		self._progress = {}			# chat_id -> [deleted or given up, total]
+
+	def _start(self):
+		with self._lock:
+			if self._threads:
+				return
+			for i in range(self.workers):
+				thread = threading.Thread(target=self._work, name='cleanup:{0}'.format(i), daemon=True)
+				thread.start()
+				self._threads.append(thread)
+
+	# Schedules deletion of given messages and returns immediately
+	def schedule(self, bot, chat_id, msg_ids):
+		msg_ids = list(msg_ids)
+		if len(msg_ids) == 0:
+			return
+		self._start()
+		with self._lock:
+			progress = self._progress.setdefault(chat_id, [0, 0])
+			progress[1] += len(msg_ids)
+		for i in range(0, len(msg_ids), self.batch):
+			self._queue.put((bot, chat_id, msg_ids[i:i + self.batch]))
+
+	# Returns tuple (processed, total) of messages scheduled for given chat, None - if nothing is pending
+	def progress(self, chat_id):
+		with self._lock:
+			progress = self._progress.get(chat_id)
+			return None if progress is None else tuple(progress)
+
+	# Blocks until everything scheduled so far is processed
+	def join(self):
+		self._queue.join()
+
+	def _done(self, chat_id, count):
+		with self._lock:
+			progress = self._progress[chat_id]
+			progress[0] += count
+			if progress[0] >= progress[1]:
+				del self._progress[chat_id]
+
+	def _work(self):
+		while True:
+			bot, chat_id, msg_ids = self._queue.get()
+			try:
+				if not (self.bulk and self._delete_bulk(bot, chat_id, msg_ids)):
+					for msg_id in msg_ids:
+						self._call(chat_id, bot.delete_message, chat_id, msg_id)
+			except Exception as e:
+				logger.warning('Cleanup of {0} messages in chat_id=\'{1}\' failed: {2}'.format(len(msg_ids), chat_id, e))
+			finally:
+				self._done(chat_id, len(msg_ids))
+				self._queue.task_done()
+
+	# Returns True if messages were deleted by one call, False - if bulk deletion is not available
+	def _delete_bulk(self, bot, chat_id, msg_ids):
+		try:
+			url = '{0}/deleteMessages'.format(bot.base_url)
+			return self._call(chat_id, bot._request.post, url, {'chat_id': chat_id, 'message_ids': msg_ids}, raise_bad=True)
+		except InvalidToken:
+			# Unknown method (404): Bot API server is too old, do not try again
+			logger.info('Bulk deletion of messages is not supported, deleting one by one')
+			self.bulk = False
+		except BadRequest:
+			pass
+		return False
+
+	# Calls fn through the outbox and waits for it. Returns result, None - if given up
+	def _call(self, chat_id, fn, *args, raise_bad=False):
+		future = outbox.scheduler.call(chat_id, fn, *args, priority=outbox.PRIORITY_CLEANUP, per_chat=False,
+									   retries=self.retries)
+		try:
+			return future.result()
+		except BadRequest:
+			if raise_bad:
+				raise
+		except (RetryAfter, TimedOut, NetworkError):
+			pass
+		return None
+
+cleaner = Cleaner()
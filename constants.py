@@ -5,7 +5,10 @@ STATE_TYPING_PASSWORD, \
 STATE_CHOOSE_PASSWORD_ACTION, \
 STATE_TYPING_RECORD,\
 STATE_CONFIRMING_RECORD,\
-STATE_BROWSING = range(7)
+STATE_BROWSING,\
+STATE_TYPING_PARTS,\
+STATE_TYPING_LABEL,\
+STATE_TYPING_ARCHIVE_PASSWORD = range(10)
 
 # Modes for ctx.user_data['password_mode'] flag
 MODE_PWD_SET,\
@@ -27,10 +30,17 @@ BTN_LOGOUT =		'Log out'
 BTN_START =			'Start'
 BTN_RECORD_SAVE =	'Save'
 BTN_RECORD_CANCEL =	'Cancel'
+BTN_RECORD_PARTS =	'Send in parts'
+BTN_RECORD_LABEL =	'Add label'
 BTN_BROWSE_PREV = 	'<< Previous'
 BTN_BROWSE_NEXT = 	'Next >>'
 BTN_BROWSE_BACK = 	'Back'
 
+# Callback data of inline keyboard buttons
+CB_BROWSE_PREV =	'browse_prev'
+CB_BROWSE_NEXT =	'browse_next'
+CB_BROWSE_BACK =	'browse_back'
+
 # Message that needs to be entered by user in order to destroy all data
 CONSCIOUS_CONFIRMATION_MSG = 'Consciously I remove all {0} records'
 
@@ -38,5 +48,140 @@ CONSCIOUS_CONFIRMATION_MSG = 'Consciously I remove all {0} records'
 DEFAULT_UNAUTH_TIMER =		30		# Amount of seconds after which bot unauthorizes user
 DEFAULT_CLEAR_ON_LOGOUT =	True	# If bot should delete history on logout
 DEFAULT_CLEAR_ON_ALARM =	False	# If bot should delete history on unauthorization alarm
+MSG_IDS_CAP =			1000	# Max number of message ids of a session kept for deleting history (oldest are forgotten)
+
+# Parameters of the inactivity tracker (timer wheel), which unauthorizes inactive users
+SESSION_WHEEL_TICK =	1		# Amount of seconds covered by one slot of the wheel (and interval of sweeps)
+SESSION_WHEEL_SLOTS =	64		# Number of slots, wheel span should exceed DEFAULT_UNAUTH_TIMER
+
+# Parameters of the background deletion of session messages
+CLEANUP_WORKERS =		2		# Number of threads deleting messages
+CLEANUP_BATCH =			100		# Max number of messages deleted by one call (limit of Bot API deleteMessages)
+CLEANUP_BULK =			True	# If deleteMessages should be tried before deleting messages one by one
+CLEANUP_RETRIES =		5		# Max number of retries of one call on flood control and network errors
+
+# Parameters of the outgoing queue of Bot API calls (see outbox.py)
+OUTBOX_WORKERS =		4		# Number of threads making calls
+OUTBOX_RATE =			30		# Max calls per second over all chats (None - unlimited)
+OUTBOX_BURST =			30		# Max calls made at once over all chats after a quiet period
+OUTBOX_CHAT_RATE =		1		# Max messages per second to one chat (None - unlimited)
+OUTBOX_CHAT_BURST =		3		# Max messages sent to one chat at once after a quiet period
+OUTBOX_RETRIES =		5		# Max number of retries of one call on flood control and network errors
+OUTBOX_BACKOFF =		0.5		# Amount of seconds before first retry on network error, doubled each retry
+OUTBOX_DRAIN_TIMEOUT =	5		# Max amount of seconds to wait for queued calls on shutdown
+
+BROWSE_PAGE_LIMIT = 7 # Number of records that are being displayed on [Browse] button
+
+# Parameters of the password hashing (KDF) worker pool
+KDF_POOL_KIND =			'thread'	# One of 'thread'/'process'/'inline' ('inline' hashes on the calling thread)
+KDF_POOL_WORKERS =		2			# Number of workers hashing passwords in parallel
+KDF_QUEUE_LIMIT =		32			# Max number of hashing jobs queued or running at once (over all chats)
+KDF_PER_CHAT_LIMIT =	1			# Max number of hashing jobs a single chat may have in flight
+
+# Parameters of password-hashes (see crypto.hash_password)
+KDF_ALGORITHM =			'pbkdf2-sha256'	# Algorithm of new hashes: 'pbkdf2-sha256' or 'scrypt' (memory-hard)
+KDF_ITERATIONS =		100000		# Iterations of PBKDF2: of legacy hashes and min for new ones
+KDF_SCRYPT_N =			2 ** 14		# CPU/memory cost of scrypt: min for new hashes (memory is 128 * N * R bytes)
+KDF_SCRYPT_R =			8			# Block size of scrypt
+KDF_SCRYPT_P =			1			# Parallelization of scrypt
+KDF_SCRYPT_MAX_N =		2 ** 17		# Max CPU/memory cost of scrypt chosen by calibration
+KDF_CALIBRATE =			True		# If cost of new hashes is calibrated at startup to take KDF_TARGET_TIME
+KDF_TARGET_TIME =		0.1			# Amount of seconds hashing of one password should take
+KDF_SALT_SIZE =			16			# Length (bytes) of random salt of every chat
+KDF_UPGRADE_RATIO =		0.75		# Hash is upgraded on login if its cost is below this share of the current cost
+
+# Parameters of the limiter of password attempts (see rate_limit.py), checked before password is hashed
+LOGIN_BURST =			5		# Max number of attempts in a row
+LOGIN_RATE =			1 / 30	# Number of attempts restored per second
+LOGIN_BACKOFF =			2		# Amount of seconds chat is blocked after first wrong password, doubled by every next one
+LOGIN_BACKOFF_MAX =		900		# Max amount of seconds chat is blocked after wrong password
+LOGIN_FORGET_AFTER =	24 * 3600	# Amount of seconds after which wrong passwords of a chat are forgotten
+LOGIN_PRUNE_INTERVAL =	600		# Amount of seconds between prunings of forgotten chats
+LOGIN_PERSISTENT =		True	# If wrong passwords are counted in DB, so that restart does not reset the backoff
+
+# Parameters of the in-process cache of chats (row id and password-hash by chat_id)
+CHAT_CACHE_SIZE =		10000	# Max number of chats kept in cache
+CHAT_CACHE_TTL =		600		# Amount of seconds after which cached chat is re-read from DB
+
+# Parameters of encryption
+FERNET_CACHE_SIZE =		1024	# Max number of cipher (Fernet) instances kept by key
+STREAM_CHUNK_SIZE =		64 * 1024	# Max amount of bytes encrypted as one chunk of a multi-part record
+RECORD_VERSION =		2		# Format of new records: 1 - base64 Fernet token of text, 2 - raw token of codec byte + data
+COMPRESS_THRESHOLD =	256		# Min length of record (bytes) which is compressed before encryption
+COMPRESS_LEVEL =		6		# Level of zlib (or zstd) compression
+REKEY_BATCH =			64		# Max number of records (or chunks) re-encrypted by one transaction, when key of chat changes
+
+# Parameters of labels of records and search over them (see crypto.label_tokens)
+LABEL_MAX_LENGTH =		256		# Max length of label (characters)
+LABEL_MAX_WORDS =		32		# Max number of words of label, which can be searched for
+LABEL_TOKEN_SIZE =		16		# Length (bytes) of HMAC token of one word stored in the index
+SEARCH_LIMIT =			20		# Max number of records shown as search results
+
+# Parameters of export and import of records (see archive.py)
+ARCHIVE_BATCH =			500			# Number of single-part records inserted by one INSERT on import
+ARCHIVE_CHUNK_BATCH =	16			# Number of chunks of multi-part record inserted by one INSERT on import
+ARCHIVE_READ_SIZE =		64 * 1024	# Amount of bytes read (and max amount decompressed) at once on import
+ARCHIVE_COMPRESS_LEVEL =	6			# Level of zlib compression of archive
+ARCHIVE_MAX_FIELD =		16 * 1024 * 1024	# Max length of one field (ciphertext, chunk) accepted on import
+ARCHIVE_MAX_SIZE =		20 * 1024 * 1024	# Max size of archive (bytes), bots cannot download larger files
+ARCHIVE_FILENAME =		'securestore-{0}.ssa'	# Name of exported archive, formatted with date
+
+# Parameters of the bot runtime
+RUNTIME_MODE =			'sync'	# Either 'sync' (Updater with its dispatcher thread), 'webhook' (see webhook.py)
+								# or 'sharded' (see sharding.py)
+
+# Parameters of the webhook mode
+WEBHOOK_HOST =			'127.0.0.1'	# Address of the local listener, usually behind a reverse proxy terminating TLS
+WEBHOOK_PORT =			8443
+WEBHOOK_PATH =			None	# Path of requests, None - unguessable one derived from the bot token
+WEBHOOK_SECRET =		None	# X-Telegram-Bot-Api-Secret-Token header required in requests (setWebhook asks Telegram to
+								# send it), None - derived from the bot token. Requests without it are answered with 403
+WEBHOOK_URL =			None	# Public URL (without path) registered by setWebhook on start, None - to not register
+WEBHOOK_CERT =			None	# Path to certificate (PEM) to serve TLS by the listener itself, None - plain HTTP
+WEBHOOK_KEY =			None	# Path to private key of the certificate
+WEBHOOK_SELF_SIGNED =	False	# If the certificate should be uploaded to Telegram by setWebhook
+WEBHOOK_MAX_CONNECTIONS =	40	# Max number of simultaneous requests from Telegram
+WEBHOOK_WORKERS =		8		# Number of threads handling updates, updates of one chat always go to the same one
+WEBHOOK_QUEUE_SIZE =	256		# Max number of updates waiting for each worker, above it requests are answered with 503
+WEBHOOK_RETRY_AFTER =	1		# Value of Retry-After header (seconds) of 503 responses
+WEBHOOK_MAX_BODY =		1024 * 1024	# Max size of request body (bytes), larger requests are answered with 413
+
+# Parameters of the sharded mode (see sharding.py)
+SHARD_COUNT =			4		# Number of worker processes, each of them owns its own database file
+SHARD_DB_PATH =			'database-{0}.db'	# Database file of a shard, formatted with its number
+SHARD_MAP_PATH =		'shards.json'	# Chats moved from their default shard by rebalance.py (chat_id -> shard)
+SHARD_INGEST =			'polling'	# How the front process receives updates: 'polling' or 'webhook' (WEBHOOK_*)
+SHARD_POLL_TIMEOUT =	10		# Long polling timeout (seconds) of the front process
+SHARD_QUEUE_SIZE =		1024	# Max number of updates waiting for a worker process, above it the front waits
+
+# Parameters of the metrics (see metrics.py)
+METRICS_ENABLED =		False	# If handlers, DB queries, crypto and Bot API calls should be timed and counted
+METRICS_HOST =			'127.0.0.1'
+METRICS_PORT =			None	# Port of the Prometheus text endpoint (GET /metrics), None - to not serve it
+METRICS_LOG_INTERVAL =	300		# Amount of seconds between metrics snapshots in log, 0 - to not log them
+
+# Parameters of the persistence of sessions (chat_data and conversation states, see persistence.py)
+PERSISTENCE_ENABLED =	True	# If sessions should survive restart of the bot
+PERSISTENCE_FLUSH_INTERVAL =	5	# Amount of seconds between writes of changed sessions to DB
+PERSISTENCE_FLUSHED_CACHE =	10000	# Max number of chats whose flushed state is remembered to skip writing it again
 
-BROWSE_PAGE_LIMIT = 7 # Number of records that are being displayed on [Browse] button
\ No newline at end of file
+# Parameters of the database
+DB_PATH =				'database.db'
+DB_PROFILE =			'tuned'	# Name of the profile from DB_PROFILES, that is applied to every connection
+RECORD_BATCHING =		False	# If records of all chats should be saved by group commits (see db_handler.RecordBatcher)
+RECORD_BATCH_WINDOW =	0.005	# Max amount of seconds record waits for others to be committed together
+RECORD_BATCH_ROWS =		100		# Max number of records committed together
+DB_PROFILES = {
+	# SQLite defaults: rollback journal, fsync on every commit
+	'default': {},
+	# WAL lets readers work alongside the writer, synchronous=NORMAL fsyncs on checkpoints only
+	# (committed transaction may be lost on power failure, but DB is never corrupted)
+	'tuned': {
+		'journal_mode': 'wal',
+		'synchronous': 'normal',
+		'cache_size': -16 * 1024,			# in KiB, per connection
+		'mmap_size': 64 * 1024 * 1024,		# in bytes, pages are shared with other connections via OS page cache
+		'busy_timeout': 5000,				# in ms, to wait for the write lock instead of failing at once
+		'temp_store': 'memory',
+	},
+}
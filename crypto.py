@@ -1,28 +1,364 @@
-import re, base64, hashlib, os
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.fernet import Fernet
+import re, base64, hashlib, hmac, math, os, time, types, zlib
 
 from api_token import SALT
+from constants import *
+from util import LruCache
+from metrics import timed
+
+_primitives = None
+
+# Returns namespace of cryptography's primitives and zstandard module (None if not installed). They are imported
+# on first use rather than with this module, so that tools and processes importing crypto start faster
+def primitives():
+	global _primitives
+	if _primitives is None:
+		from cryptography.hazmat.backends import default_backend
+		from cryptography.hazmat.primitives import hashes
+		from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+		from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+		from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+		from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+		from cryptography.fernet import Fernet, InvalidToken
+		from cryptography.exceptions import InvalidTag
+		try:
+			import zstandard
+		except ImportError:
+			zstandard = None
+		_primitives = types.SimpleNamespace(backend=default_backend(), hashes=hashes, PBKDF2HMAC=PBKDF2HMAC,
+											Scrypt=Scrypt, HKDF=HKDF, AESGCM=AESGCM, Fernet=Fernet,
+											InvalidToken=InvalidToken, InvalidTag=InvalidTag, zstandard=zstandard)
+	return _primitives
 
 # Tests given password for strength
 def is_password_weak(pwd):
 	return not re.match(r'[A-Za-z0-9@#$%^&+=]{8,}', pwd)
 
-# Calculates hash of password
+# Calculates legacy hash of password (global SALT, KDF_ITERATIONS of PBKDF2), see hash_password()
+@timed('crypto')
 def get_hash(pwd):
 	password = pwd.encode()  # Convert to type bytes
-	kdf = PBKDF2HMAC(
-		algorithm=hashes.SHA256(),
+	p = primitives()
+	kdf = p.PBKDF2HMAC(
+		algorithm=p.hashes.SHA256(),
 		length=32,
 		salt=SALT,
-		iterations=100000,
-		backend=default_backend()
+		iterations=KDF_ITERATIONS,
+		backend=p.backend
 	)
 	key = base64.urlsafe_b64encode(kdf.derive(password))  # Can only use kdf once
 	return key
 
+# Versioned password-hashes: '$<algorithm>$<parameters>$<salt>$<key>', e.g. '$pbkdf2-sha256$i=310000$<salt>$<key>'.
+# Every chat has its own random salt. key is urlsafe base64 of 32 derived bytes, it is Fernet key of the chat's records
+# as well. Hashes without '$' are legacy ones (see get_hash()). Parameters of new hashes are calibrated at startup
+# to take KDF_TARGET_TIME, older hashes are upgraded on successful login (see needs_upgrade())
+KDF_PBKDF2 = 'pbkdf2-sha256'
+KDF_SCRYPT = 'scrypt'
+
+# Returns parameters of given algorithm as string, e.g. 'pbkdf2-sha256$i=310000'
+def make_kdf_params(algorithm, **params):
+	return '{0}${1}'.format(algorithm, ','.join('{0}={1}'.format(k, v) for k, v in sorted(params.items())))
+
+def _parse_kdf_params(text):
+	algorithm, params = text.split('$')
+	return algorithm, {k: int(v) for k, v in (p.split('=') for p in params.split(','))}
+
+def _default_kdf_params(algorithm=KDF_ALGORITHM):
+	if algorithm == KDF_SCRYPT:
+		return make_kdf_params(KDF_SCRYPT, n=KDF_SCRYPT_N, r=KDF_SCRYPT_R, p=KDF_SCRYPT_P)
+	return make_kdf_params(KDF_PBKDF2, i=KDF_ITERATIONS)
+
+_kdf_params = _default_kdf_params()
+
+# Returns parameters of new password-hashes
+def kdf_params():
+	return _kdf_params
+
+def set_kdf_params(params):
+	global _kdf_params
+	_kdf_params = params
+
+def _is_legacy(hash):
+	return (b'$' if isinstance(hash, bytes) else '$') not in hash
+
+# Returns tuple (parameters, salt, key) of versioned password-hash
+def _split_hash(hash):
+	if isinstance(hash, bytes):
+		hash = hash.decode()
+	_, algorithm, params, salt, key = hash.split('$')
+	return '{0}${1}'.format(algorithm, params), base64.urlsafe_b64decode(salt + '=' * (-len(salt) % 4)), key
+
+def _derive(pwd, params, salt):
+	algorithm, values = _parse_kdf_params(params)
+	p = primitives()
+	if algorithm == KDF_PBKDF2:
+		kdf = p.PBKDF2HMAC(algorithm=p.hashes.SHA256(), length=32, salt=salt, iterations=values['i'], backend=p.backend)
+	elif algorithm == KDF_SCRYPT:
+		kdf = p.Scrypt(salt=salt, length=32, n=values['n'], r=values['r'], p=values['p'], backend=p.backend)
+	else:
+		raise ValueError('Unknown KDF algorithm \'{0}\''.format(algorithm))
+	return base64.urlsafe_b64encode(kdf.derive(pwd.encode())).decode()
+
+# Calculates hash of password. With reference hash the same algorithm, parameters and salt are used (to compare
+# result with it), otherwise given parameters (current ones by default) and new random salt
+@timed('crypto')
+def hash_password(pwd, reference=None, params=None):
+	if reference is not None and _is_legacy(reference):
+		return get_hash(pwd)
+	if reference is not None:
+		params, salt, _ = _split_hash(reference)
+	else:
+		params, salt = params or _kdf_params, os.urandom(KDF_SALT_SIZE)
+	key = _derive(pwd, params, salt)
+	return '${0}${1}${2}'.format(params, base64.urlsafe_b64encode(salt).decode().rstrip('='), key).encode()
+
+# Compares password-hashes in constant time
+def same_hash(a, b):
+	if a is None or b is None:
+		return False
+	return hmac.compare_digest(a.encode() if isinstance(a, str) else a, b.encode() if isinstance(b, str) else b)
+
+# Hashes password to compare it with reference hash (new hash is made if there is no reference). Returns tuple
+# (hash, upgraded), where upgraded is a new hash of the password with given parameters, if password matches reference
+# whose parameters are outdated, None - otherwise. Is a single job of KDF pool, so parameters are passed explicitly
+def check_password(pwd, reference, params):
+	hash = hash_password(pwd, reference, params)
+	upgraded = None
+	if reference is not None and same_hash(hash, reference) and needs_upgrade(reference, params):
+		upgraded = hash_password(pwd, None, params)
+	return hash, upgraded
+
+def _kdf_cost(params):
+	algorithm, values = _parse_kdf_params(params)
+	if algorithm == KDF_SCRYPT:
+		return values['n'] * values['r'] * values['p']
+	return values['i']
+
+# Checks if password-hash should be replaced by a hash with given (current by default) parameters: if it is legacy,
+# made by other algorithm or is noticeably cheaper (calibration results differ slightly from run to run)
+def needs_upgrade(hash, params=None):
+	params = params or _kdf_params
+	if _is_legacy(hash):
+		return True
+	old = _split_hash(hash)[0]
+	if old.split('$')[0] != params.split('$')[0]:
+		return True
+	return _kdf_cost(old) < _kdf_cost(params) * KDF_UPGRADE_RATIO
+
+# Returns Fernet key of the chat's records contained in password-hash
+def password_key(hash):
+	if hash is None or _is_legacy(hash):
+		return hash
+	return _split_hash(hash)[2].encode()
+
+# Returns tuple (parameters, salt), which key of password-hash is derived with, (None, None) - for legacy hash
+def key_params(hash):
+	if _is_legacy(hash):
+		return None, None
+	params, salt, _ = _split_hash(hash)
+	return params, salt
+
+# Derives Fernet key of records from password with parameters and salt returned by key_params()
+def derive_key(pwd, params, salt):
+	if params is None:
+		return get_hash(pwd)
+	return _derive(pwd, params, salt).encode()
+
+def _measure(params):
+	salt = os.urandom(KDF_SALT_SIZE)
+	best = None
+	for _ in range(3):
+		start = time.perf_counter()
+		_derive('calibration', params, salt)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+# Chooses parameters of given algorithm, so that hashing takes about target seconds on this machine (but never less
+# than the configured ones), and makes them current. Returns the parameters
+def calibrate(algorithm=KDF_ALGORITHM, target=KDF_TARGET_TIME):
+	if algorithm == KDF_SCRYPT:
+		sample = make_kdf_params(KDF_SCRYPT, n=KDF_SCRYPT_N, r=KDF_SCRYPT_R, p=KDF_SCRYPT_P)
+		log_n = int(math.log2(KDF_SCRYPT_N * target / _measure(sample)))
+		n = min(max(2 ** log_n, KDF_SCRYPT_N), KDF_SCRYPT_MAX_N)
+		params = make_kdf_params(KDF_SCRYPT, n=n, r=KDF_SCRYPT_R, p=KDF_SCRYPT_P)
+	else:
+		sample = make_kdf_params(KDF_PBKDF2, i=10000)
+		iterations = int(10000 * target / _measure(sample)) // 10000 * 10000
+		params = make_kdf_params(KDF_PBKDF2, i=max(iterations, KDF_ITERATIONS))
+	set_kdf_params(params)
+	return params
+
+# Fernet instances by key, so that key is decoded and split once per session instead of once per message
+ciphers = LruCache(FERNET_CACHE_SIZE)
+
+# Returns (cached) Fernet instance for given key
+def get_cipher(key):
+	if isinstance(key, str):
+		key = key.encode()
+	f = ciphers.get(key)
+	if f is None:
+		f = primitives().Fernet(key)
+		ciphers.put(key, f)
+	return f
+
+# Drops cached Fernet instance of given key (e.g. on logout)
+def forget_key(key):
+	if key is None:
+		return
+	if isinstance(key, str):
+		key = key.encode()
+	ciphers.invalidate(key)
+
+@timed('crypto')
 def encrypt_string(data, key):
-	f = Fernet(key)
-	return f.encrypt(data.encode())
\ No newline at end of file
+	return get_cipher(key).encrypt(data.encode())
+
+# Codecs of record plaintext, written as its first byte before encryption
+CODEC_NONE, CODEC_ZLIB, CODEC_ZSTD = range(3)
+
+# Compresses data (by zstd if available, zlib otherwise) if it is large enough and returns it prefixed with codec byte
+def compress(data):
+	if len(data) >= COMPRESS_THRESHOLD:
+		zstandard = primitives().zstandard
+		if zstandard is not None:
+			codec, body = CODEC_ZSTD, zstandard.ZstdCompressor(level=COMPRESS_LEVEL).compress(data)
+		else:
+			codec, body = CODEC_ZLIB, zlib.compress(data, COMPRESS_LEVEL)
+		if len(body) < len(data):
+			return bytes((codec,)) + body
+	return bytes((CODEC_NONE,)) + data
+
+def decompress(framed):
+	codec, body = framed[0], framed[1:]
+	if codec == CODEC_NONE:
+		return body
+	if codec == CODEC_ZLIB:
+		return zlib.decompress(body)
+	if codec == CODEC_ZSTD:
+		zstandard = primitives().zstandard
+		if zstandard is None:
+			raise ValueError('Record is compressed by zstd, but zstandard module is not installed')
+		return zstandard.ZstdDecompressor().decompress(body)
+	raise ValueError('Unknown codec {0}'.format(codec))
+
+# Compresses and encrypts data (bytes) into raw ciphertext of a version 2 record (Fernet token without base64)
+@timed('crypto')
+def seal_record(data, key):
+	return base64.urlsafe_b64decode(get_cipher(key).encrypt(compress(data)))
+
+# Decrypts record of given version (see db_handler.Record) and returns its plaintext (bytes)
+@timed('crypto')
+def open_record(version, data, payload, key):
+	if version == 1:
+		return get_cipher(key).decrypt(data.encode() if isinstance(data, str) else data)
+	return decompress(get_cipher(key).decrypt(base64.urlsafe_b64encode(payload)))
+
+# Blind index of record labels: a label is sealed like a record, and every normalized word of it is stored as
+# HMAC token keyed by a key derived from user's key. Search hashes its words the same way and looks tokens up,
+# so neither labels nor words are stored in clear and only the found labels are decrypted
+
+# Returns normalized unique words of label (or search query)
+def label_words(text):
+	return sorted(set(re.findall(r'\w+', text.casefold())))[:LABEL_MAX_WORDS]
+
+def _index_key(key):
+	if isinstance(key, str):
+		key = key.encode()
+	p = primitives()
+	hkdf = p.HKDF(
+		algorithm=p.hashes.SHA256(),
+		length=32,
+		salt=None,
+		info=b'securestore label index',
+		backend=p.backend
+	)
+	return hkdf.derive(base64.urlsafe_b64decode(key))
+
+# Returns index tokens of given words
+def label_tokens(words, key):
+	index_key = _index_key(key)
+	return [hmac.new(index_key, w.encode(), hashlib.sha256).digest()[:LABEL_TOKEN_SIZE] for w in words]
+
+# Encrypts label into tuple (ciphertext, index tokens of its words)
+@timed('crypto')
+def seal_label(label, key):
+	return seal_record(label.encode(), key), label_tokens(label_words(label), key)
+
+def open_label(payload, key):
+	return open_record(RECORD_VERSION, None, payload, key).decode()
+
+# Decrypts every label of given iterable with one key setup
+@timed('crypto')
+def open_labels(payloads, key):
+	f = get_cipher(key)
+	return [decompress(f.decrypt(base64.urlsafe_b64encode(payload))).decode() for payload in payloads]
+
+# Streaming AEAD for multi-part records (STREAM construction over AES-GCM). Every record gets a random header:
+# 16 bytes of salt for deriving the record key from user's key and 7 bytes of nonce prefix. Chunk number seq is sealed
+# with nonce = prefix | seq | last flag, so reordered, dropped or cut off chunks fail authentication.
+# The final chunk (flagged as last) may be empty
+STREAM_SALT_SIZE = 16
+STREAM_PREFIX_SIZE = 7
+
+def new_stream_header():
+	return os.urandom(STREAM_SALT_SIZE + STREAM_PREFIX_SIZE)
+
+def _stream_cipher(key, header):
+	if isinstance(key, str):
+		key = key.encode()
+	p = primitives()
+	hkdf = p.HKDF(
+		algorithm=p.hashes.SHA256(),
+		length=32,
+		salt=header[:STREAM_SALT_SIZE],
+		info=b'securestore stream',
+		backend=p.backend
+	)
+	return p.AESGCM(hkdf.derive(base64.urlsafe_b64decode(key))), header[STREAM_SALT_SIZE:]
+
+def _stream_nonce(prefix, seq, last):
+	return prefix + seq.to_bytes(4, 'big') + (b'\x01' if last else b'\x00')
+
+# Encrypts consecutive chunks of one record starting from chunk number seq
+@timed('crypto')
+def encrypt_chunks(key, header, seq, chunks, last=False):
+	cipher, prefix = _stream_cipher(key, header)
+	chunks = list(chunks)
+	return [cipher.encrypt(_stream_nonce(prefix, seq + i, last and i == len(chunks) - 1), c, None)
+			for i, c in enumerate(chunks)]
+
+# Re-encrypts chunk number seq of a stream with another key, keeping its last flag
+def rekey_chunk(old_key, new_key, header, seq, chunk):
+	cipher, prefix = _stream_cipher(old_key, header)
+	invalid_tag = primitives().InvalidTag
+	for last in (False, True):
+		try:
+			plain = cipher.decrypt(_stream_nonce(prefix, seq, last), chunk, None)
+		except invalid_tag:
+			continue
+		return _stream_cipher(new_key, header)[0].encrypt(_stream_nonce(prefix, seq, last), plain, None)
+	raise invalid_tag()
+
+# Lazily decrypts chunks of one record (iterable in order of seq), yielding plaintext chunk by chunk.
+# Raises cryptography.exceptions.InvalidTag if chunks were tampered with or the stream is incomplete
+def decrypt_chunks(key, header, chunks):
+	cipher, prefix = _stream_cipher(key, header)
+	seq = 0
+	pending = None
+	for chunk in chunks:
+		if pending is not None:
+			yield cipher.decrypt(_stream_nonce(prefix, seq, False), pending, None)
+			seq += 1
+		pending = chunk
+	if pending is None:
+		raise ValueError('Stream has no chunks')
+	yield cipher.decrypt(_stream_nonce(prefix, seq, True), pending, None)
+
+# Splits readable binary stream into chunks of STREAM_CHUNK_SIZE bytes
+def split_stream(stream, size=STREAM_CHUNK_SIZE):
+	while True:
+		chunk = stream.read(size)
+		if not chunk:
+			break
+		yield chunk
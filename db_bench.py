@@ -0,0 +1,142 @@
+# Micro-benchmarks of db_handler:
+#  - SQLite round trips per user action: legacy select-then-len-then-get access vs current db_handler
+#  - write throughput of create_record under each of DB_PROFILES
+# Usage: python db_bench.py
+import os, shutil, tempfile, threading, time
+
+import db_handler as dbh
+from db_handler import Chat, Record
+from util import timestamp_now
+from constants import DB_PROFILES
+
+ITERATIONS = 200
+WRITES = 2000
+WRITERS = (1, 4)
+
+# Counts every statement which goes to SQLite
+class QueryCounter:
+	def __init__(self, db):
+		self.db = db
+		self.count = 0
+		self._execute_sql = db.execute_sql
+
+	def __enter__(self):
+		def counting(sql, params=None, *args, **kwargs):
+			self.count += 1
+			return self._execute_sql(sql, params, *args, **kwargs)
+		self.db.execute_sql = counting
+		return self
+
+	def __exit__(self, *exc):
+		self.db.execute_sql = self._execute_sql
+
+# Data access as it was done before: select, len() on it and then get() it
+class legacy:
+	@staticmethod
+	def create_chat_if_not_exist(chat_id, password=None):
+		chats = Chat.select().where(Chat.chat_id == chat_id)
+		if len(chats) == 0:
+			return Chat(chat_id=chat_id, password=password).save()
+		return 0
+
+	@staticmethod
+	def get_password(chat_id):
+		chat = Chat.select().where(Chat.chat_id == chat_id)
+		if len(chat) == 0:
+			return None
+		return chat.get().password
+
+	@staticmethod
+	def set_password(chat_id, password):
+		chat = Chat.select().where(Chat.chat_id == chat_id)
+		if len(chat) == 0:
+			return Chat(chat_id=chat_id, password=password).save()
+		chat = chat.get()
+		chat.password = password
+		return chat.save()
+
+	@staticmethod
+	def create_record(chat_id, data, size):
+		chat = Chat.select().where(Chat.chat_id == chat_id)
+		if len(chat) == 0:
+			legacy.create_chat_if_not_exist(chat_id)
+		return Record(chat_uid=chat.get(), timestamp=timestamp_now(), data=data, data_size=len(data)).save()
+
+	@staticmethod
+	def get_records_overview(chat_id):
+		chat = Chat.select(Chat.id).where(Chat.chat_id == chat_id)
+		if len(chat) == 0:
+			legacy.create_chat_if_not_exist(chat_id)
+		chat = Chat.select(Chat.id).where(Chat.chat_id == chat_id)
+		if len(chat) == 0:
+			return None
+		records = Record.select(Record.id, Record.timestamp, Record.data_size).where(Record.chat_uid == chat).execute()
+		return [{'uid': r.id, 'timestamp': r.timestamp, 'size': r.data_size} for r in records]
+
+	@staticmethod
+	def delete_all(chat_id):
+		chat = Chat.select(Chat.id).where(Chat.chat_id == chat_id)
+		if len(chat) == 0:
+			return (0, 0)
+		records = Record.delete().where(Record.chat_uid == chat).execute()
+		chat = Chat.delete().where(Chat.chat_id == chat_id).execute()
+		return (chat, records)
+
+# User actions of the bot, expressed as the calls main.py does for them
+def actions(impl):
+	return [
+		('start',			lambda c: (impl.create_chat_if_not_exist(c), impl.get_password(c))),
+		('set password',	lambda c: impl.set_password(c, 'hash')),
+		('encrypt record',	lambda c: impl.get_password(c)),
+		('save record',		lambda c: impl.create_record(c, b'data', 4)),
+		('browse',			lambda c: impl.get_records_overview(c)),
+		('delete all',		lambda c: impl.delete_all(c)),
+	]
+
+def run(name, impl):
+	print('{0}:'.format(name))
+	print('  {0:<16}{1:>12}{2:>12}'.format('action', 'queries', 'usec/call'))
+	for action, fn in actions(impl):
+		with QueryCounter(dbh.db) as counter:
+			start = time.perf_counter()
+			for chat_id in range(ITERATIONS):
+				fn(chat_id)
+			elapsed = time.perf_counter() - start
+		print('  {0:<16}{1:>12.1f}{2:>12.1f}'.format(action, counter.count / ITERATIONS, elapsed / ITERATIONS * 1e6))
+
+# Saves WRITES records from given number of threads, returns records per second
+def write_throughput(writers):
+	per_writer = WRITES // writers
+
+	def write(chat_id):
+		for i in range(per_writer):
+			dbh.create_record(chat_id, b'data', 4)
+		dbh.close()
+
+	threads = [threading.Thread(target=write, args=(chat_id,)) for chat_id in range(writers)]
+	start = time.perf_counter()
+	for t in threads: t.start()
+	for t in threads: t.join()
+	return per_writer * writers / (time.perf_counter() - start)
+
+if __name__ == '__main__':
+	directory = tempfile.mkdtemp()
+
+	dbh.init(os.path.join(directory, 'queries.db'), 'default')
+	run('legacy', legacy)
+	run('db_handler', dbh)
+	print('chat cache: {0}'.format(dbh.cache_stats()))
+	dbh.close()
+
+	print('write throughput (records/sec):')
+	print('  {0:<16}'.format('profile') + ''.join('{0:>12}'.format('{0} writers'.format(w)) for w in WRITERS))
+	for profile in DB_PROFILES:
+		line = '  {0:<16}'.format(profile)
+		for writers in WRITERS:
+			dbh.init(os.path.join(directory, '{0}-{1}.db'.format(profile, writers)), profile)
+			for chat_id in range(writers):
+				dbh.create_chat_if_not_exist(chat_id)
+			line += '{0:>12.0f}'.format(write_throughput(writers))
+			dbh.close()
+		print(line)
+	shutil.rmtree(directory)
@@ -1,6 +1,8 @@
 from peewee import *
 from util import *
-import logging, datetime
+from constants import *
+import logging, datetime, queue, threading, time, zlib
+from concurrent.futures import Future
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
 					level=logging.INFO)
@@ -9,7 +11,8 @@ logger = logging.getLogger('peewee')
 # logger.addHandler(logging.StreamHandler())
 # logger.setLevel(logging.DEBUG)
 
-db = SqliteDatabase('database.db')
+# Is opened by init(). Peewee keeps a separate connection for each thread, pragmas of profile are set on each of them
+db = SqliteDatabase(None, thread_safe=True)
 
 class BaseModel(Model):
 	class Meta:
@@ -23,103 +26,458 @@ class Chat(BaseModel):
 class Record(BaseModel):
 	chat_uid = ForeignKeyField(Chat)
 	timestamp = DateField()
-	data = TextField(null=True)
-	data_size = IntegerField()
+	data = TextField(null=True)			# Fernet token of version 1 record (legacy)
+	data_size = IntegerField()			# Length of plaintext (of ciphertext for version 1 records)
+	payload = BlobField(null=True)		# Raw ciphertext of version 2 record (see crypto.seal_record)
+	version = IntegerField(default=1)	# Format of the record, RECORD_VERSION for new ones
+	header = BlobField(null=True)		# Stream header of multi-part record (see crypto.encrypt_chunks)
+	chunks = IntegerField(default=0)	# Number of chunks of multi-part record, 0 - if record is stored in data
+	label = BlobField(null=True)		# Ciphertext of label of the record (see crypto.seal_label)
 
-db.create_tables([Chat, Record])
+	class Meta:
+		# Serves both per-chat COUNT and keyset pagination of overview (newest first) as a range scan
+		indexes = (
+			(('chat_uid', 'timestamp', 'id'), False),
+		)
+
+# Encrypted chunk of multi-part record. While record is being uploaded its chunks are bound to the upload only
+# and record_uid is set once upload is finished, so unfinished records never show up in overview
+class RecordChunk(BaseModel):
+	record_uid = ForeignKeyField(Record, null=True)
+	upload = CharField(null=True)
+	seq = IntegerField()
+	data = BlobField()
+	last = BooleanField(default=False)	# If the chunk is sealed as the final one of its stream (see crypto.encrypt_chunks)
+
+	class Meta:
+		indexes = (
+			(('record_uid', 'seq'), True),
+			(('upload', 'seq'), True),
+		)
+
+# Blind index of labels: HMAC token of one word of a record's label (see crypto.label_tokens)
+class RecordToken(BaseModel):
+	chat_uid = ForeignKeyField(Chat)
+	record_uid = ForeignKeyField(Record)
+	token = BlobField()
+
+	class Meta:
+		# Search resolves tokens of a chat to records by this index only
+		indexes = (
+			(('chat_uid', 'token', 'record_uid'), True),
+		)
+
+# Serialized session state of a chat (see persistence.py)
+class ChatState(BaseModel):
+	chat_id = IntegerField(unique=True)
+	data = TextField()
+
+# State of a conversation of ConversationHandler with given name, key is serialized key of conversation
+class ConversationState(BaseModel):
+	name = CharField()
+	key = CharField()
+	state = IntegerField()
+
+	class Meta:
+		indexes = (
+			(('name', 'key'), True),
+		)
+
+# Failed login attempts of a chat (see rate_limit.LoginLimiter), blocked_until is unix time
+class LoginAttempt(BaseModel):
+	chat_id = IntegerField(unique=True)
+	failures = IntegerField(default=0)
+	blocked_until = FloatField(default=0)
+
+# Re-encryption of a chat's records with its new key (see rekey.py): records and chunks with row ids in
+# (record_from, record_to] and (chunk_from, chunk_to] are still encrypted with key of old password-hash
+class Rekey(BaseModel):
+	chat_uid = ForeignKeyField(Chat, unique=True)
+	password = TextField()
+	record_from = IntegerField()
+	record_to = IntegerField()
+	chunk_from = IntegerField()
+	chunk_to = IntegerField()
+
+MODELS = [Chat, Record, RecordChunk, RecordToken, ChatState, ConversationState, LoginAttempt, Rekey]
+
+# Returns fingerprint of the schema of MODELS (checksum of its DDL), which fits into SQLite's user_version
+def schema_version():
+	statements = []
+	for model in MODELS:
+		statements.append(model._schema._create_table(safe=True).query()[0])
+		statements += [index.query()[0] for index in model._schema._create_indexes(safe=True)]
+	return zlib.crc32('\n'.join(statements).encode()) & 0x7fffffff
 
-# TODO: get rid of repetitive code (always checking chat_id and len()!)!!!
-# Creates new chat entry and returns 1 if created successfully, 0 - if already exists, other - error
+# Opens database at given path with given tuning profile (see DB_PROFILES). Nothing touches the database before it.
+# Absent tables and columns are created only if the database was not made by the current schema (its fingerprint is
+# kept in user_version), so a restart of the bot opens the database with a single query
+def init(path=DB_PATH, profile=DB_PROFILE):
+	pragmas = DB_PROFILES[profile]
+	db.init(path, pragmas=list(pragmas.items()), timeout=pragmas.get('busy_timeout', 5000) / 1000)
+	version = schema_version()
+	if db.execute_sql('PRAGMA user_version').fetchone()[0] != version:
+		db.create_tables(MODELS)
+		add_missing_columns()
+		db.execute_sql('PRAGMA user_version = {0}'.format(version))
+	chat_cache.clear()
+
+# Adds columns, which were introduced after tables had been created (they all must be nullable or have default)
+def add_missing_columns():
+	from playhouse.migrate import SqliteMigrator, migrate
+	migrator = SqliteMigrator(db)
+	operations = []
+	for model in MODELS:
+		table = model._meta.table_name
+		existing = set(c.name for c in db.get_columns(table))
+		for field in model._meta.sorted_fields:
+			if field.column_name not in existing:
+				logger.info('Adding column \'{0}\' to table \'{1}\''.format(field.column_name, table))
+				operations.append(migrator.add_column(table, field.column_name, field))
+	if operations:
+		with db.atomic():
+			migrate(*operations)
+
+# Closes connection of the calling thread (e.g. before the thread finishes)
+def close():
+	if not db.is_closed():
+		db.close()
+
+# (row id, password-hash) of chats by chat_id. Every write changing them invalidates the entry explicitly
+chat_cache = LruCache(CHAT_CACHE_SIZE, CHAT_CACHE_TTL)
+
+# Returns hit/miss/eviction counters of chat cache
+def cache_stats():
+	return chat_cache.stats()
+
+# Returns tuple (row id, password-hash) of the chat with given chat_id, None - if no such chat
+def get_chat(chat_id):
+	chat = chat_cache.get(chat_id)
+	if chat is not None:
+		return chat
+
+	generation = chat_cache.generation()
+	chat = Chat.select(Chat.id, Chat.password).where(Chat.chat_id == chat_id).tuples().first()
+	if chat is not None:
+		chat_cache.put(chat_id, chat, generation)
+	return chat
+
+# Returns row id of the chat with given chat_id (one indexed query, if not cached), None - if no such chat
+def get_chat_uid(chat_id):
+	chat = get_chat(chat_id)
+	return None if chat is None else chat[0]
+
+# Creates new chat entry (INSERT ... ON CONFLICT DO NOTHING) and returns 1 if created, 0 - if already exists
 def create_chat_if_not_exist(chat_id, password=None):
-	chats = Chat.select().where(Chat.chat_id == chat_id)
-	if len(chats) == 0:
-		return Chat(chat_id=chat_id, password=password).save()
-	elif len(chats) > 1:
-		logger.warning('{1} duplicates for chat_id=\'{0}\' exist! New entry has not been created'.format(chat_id, len(chats) - 1))
-		return len(chats)
-	return 0
-
-# TODO: delete multiple in case of error
-# Deletes chat entry and returns 1 if deletes successfully, 0 - if no chat found, other - error
+	query = Chat.insert(chat_id=chat_id, password=password) \
+		.on_conflict(conflict_target=[Chat.chat_id], action='NOTHING')
+	return db.execute(query).rowcount
+
+# Returns row id of the chat with given chat_id, creating the chat if absent
+def ensure_chat_uid(chat_id):
+	uid = get_chat_uid(chat_id)
+	if uid is None:
+		create_chat_if_not_exist(chat_id)
+		uid = get_chat_uid(chat_id)
+	return uid
+
+# Deletes chat entry and returns 1 if deletes successfully, 0 - if no chat found
 def delete_chat(chat_id):
-	chats = Chat.select().where(Chat.chat_id == chat_id)
-	if len(chats) == 1:
-		return chats.get().delete_instance()
-	elif len(chats) > 1:
-		logger.warning('{1} duplicates for chat_id=\'{0}\' exist! Entry has not been deleted'.format(chat_id, len(chats) - 1))
-		return len(chats)
-	return 0
-
-# Updates (or creates new) entry with new password and returns 1 - if success, other - error
+	deleted = Chat.delete().where(Chat.chat_id == chat_id).execute()
+	chat_cache.invalidate(chat_id)
+	return deleted
+
+# Updates (or creates new) entry with new password (INSERT ... ON CONFLICT DO UPDATE) and returns 1 - if success
 def set_password(chat_id, password):
-	chat = Chat.select().where(Chat.chat_id == chat_id)
-	if len(chat) == 0:
-		return Chat(chat_id=chat_id, password=password).save()
-	elif len(chat) == 1:
-		chat = chat.get()
-		chat.password = password
-		return chat.save()
-	logger.warning('{1} duplicates for chat_id=\'{0}\' exist! Entry has not been updated'.format(chat_id, len(chat) - 1))
-	return len(chat)
-
-# TODO: probably manage ourselves by deleting duplicates
-# Retrieves password-hash and returns it in case of succes, None - if error
+	query = Chat.insert(chat_id=chat_id, password=password) \
+		.on_conflict(conflict_target=[Chat.chat_id], update={Chat.password: EXCLUDED.password})
+	updated = db.execute(query).rowcount
+	chat_cache.invalidate(chat_id)
+	return updated
+
+# Retrieves password-hash and returns it in case of succes, None - if no chat found
 def get_password(chat_id):
-	chat = Chat.select().where(Chat.chat_id == chat_id)
-	if len(chat) == 0:
-		return None
-	elif len(chat) > 1:
-		logger.warning('{1} duplicates for chat_id=\'{0}\' exist! Ignored'.format(chat_id, len(chat) - 1))
-	return chat.get().password
-
-# TODO: probably manage ourselves by deleting duplicates
-# Creates record (first checking chat_id for existance and creating if absent) and returns 1 - on success, 0 - otherwise
-def create_record(chat_id, data):
-	chat = Chat.select().where(Chat.chat_id == chat_id)
-	if len(chat) == 0:
+	chat = get_chat(chat_id)
+	return None if chat is None else chat[1]
+
+# Creates record of current version from ciphertext sealed by crypto.seal_record() and length of its plaintext
+# (creating chat if absent) and returns 1 - on success, 0 - otherwise. Label is tuple (ciphertext, index tokens)
+# made by crypto.seal_label()
+def create_record(chat_id, payload, size, label=None):
+	uid = get_chat_uid(chat_id)
+	if uid is None:
 		logger.warning('Chat with chat_id=\'{0}\' could not be found!'
 					   'Record will be saved, chat will be created, but no password stored!'.format(chat_id))
-		create_chat_if_not_exist(chat_id)
-	elif len(chat) > 1:
-		logger.warning('{1} duplicates for chat_id=\'{0}\' exist!'
-					   'Record will be saved for chat_uid=\'{2}\''.format(chat_id, len(chat) - 1, chat.id))
+		uid = ensure_chat_uid(chat_id)
+
+	query = Record.insert(chat_uid=uid, timestamp=timestamp_now(), payload=payload, data_size=size, version=RECORD_VERSION,
+						  label=label[0] if label else None)
+	if label is None:
+		return db.execute(query).rowcount
+	with db.atomic():
+		record_uid = query.execute()
+		add_tokens(uid, record_uid, label[1])
+	return 1
+
+# Stores index tokens of label of given record
+def add_tokens(uid, record_uid, tokens):
+	rows = [{'chat_uid': uid, 'record_uid': record_uid, 'token': t} for t in tokens]
+	if rows:
+		RecordToken.insert_many(rows).execute()
+	return len(rows)
 
-	record = Record(chat_uid=chat.get(), timestamp=timestamp_now(), data=data, data_size=len(data))
-	return record.save()
+# Write-behind batcher of record inserts (RECORD_BATCHING). Inserts of all chats are collected for up to
+# RECORD_BATCH_WINDOW seconds or RECORD_BATCH_ROWS rows and committed by one insert_many transaction.
+# Durability: future of a record resolves only after its batch is committed, so a caller never confirms a record
+# which is not in DB. Records still waiting for their batch are lost if the process dies (their callers got no
+# confirmation yet); committed ones are as durable as the profile's synchronous level makes them
+class RecordBatcher:
+	def __init__(self, window=RECORD_BATCH_WINDOW, max_rows=RECORD_BATCH_ROWS):
+		self.window = window
+		self.max_rows = max_rows
+		self._queue = queue.Queue()
+		self._thread = None
+		self._lock = threading.Lock()
+
+	# Returns Future resolving to 1 once record is committed
+	def submit(self, chat_id, payload, size):
+		future = Future()
+		with self._lock:
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run, name='record-batcher', daemon=True)
+				self._thread.start()
+		self._queue.put((chat_id, payload, size, future))
+		return future
+
+	# Blocks until everything submitted so far is committed
+	def flush(self):
+		self._queue.join()
+
+	def _run(self):
+		while True:
+			batch = [self._queue.get()]
+			deadline = time.monotonic() + self.window
+			while len(batch) < self.max_rows:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					break
+				try: batch.append(self._queue.get(timeout=remaining))
+				except queue.Empty: break
+			self._commit(batch)
+			for _ in batch:
+				self._queue.task_done()
+
+	def _commit(self, batch):
+		try:
+			now = timestamp_now()
+			rows = []
+			for chat_id, payload, size, future in batch:
+				uid = get_chat_uid(chat_id)
+				if uid is None:
+					logger.warning('Chat with chat_id=\'{0}\' could not be found!'
+								   'Record will be saved, chat will be created, but no password stored!'.format(chat_id))
+					uid = ensure_chat_uid(chat_id)
+				rows.append({'chat_uid': uid, 'timestamp': now, 'payload': payload, 'data_size': size, 'version': RECORD_VERSION})
+			with db.atomic():
+				Record.insert_many(rows).execute()
+		except Exception as e:
+			for item in batch:
+				item[-1].set_exception(e)
+			return
+		for item in batch:
+			item[-1].set_result(1)
+
+record_batcher = RecordBatcher()
+
+# Creates record like create_record(), but returns Future with its result. With RECORD_BATCHING
+# the insert (of a record without label) is committed together with inserts of other chats, see RecordBatcher
+def create_record_async(chat_id, payload, size, label=None):
+	if RECORD_BATCHING and label is None:
+		return record_batcher.submit(chat_id, payload, size)
+	future = Future()
+	try: future.set_result(create_record(chat_id, payload, size, label))
+	except Exception as e: future.set_exception(e)
+	return future
+
+# Stores encrypted chunks of an unfinished multi-part record, numbered from seq on
+def append_chunks(upload, seq, chunks, last=False):
+	chunks = list(chunks)
+	rows = [{'upload': upload, 'seq': seq + i, 'data': c, 'last': last and i == len(chunks) - 1}
+			for i, c in enumerate(chunks)]
+	if rows:
+		with db.atomic():
+			RecordChunk.insert_many(rows).execute()
+	return len(rows)
+
+# Turns uploaded chunks into a record of given chat (with label, if given, see create_record())
+# and returns 1 - on success, 0 - otherwise. An upload, which was not sealed by its final chunk or misses some chunks,
+# would never decrypt, so it is refused
+def finish_upload(chat_id, upload, header, size, label=None):
+	uid = ensure_chat_uid(chat_id)
+	with db.atomic():
+		chunks = RecordChunk.select().where(RecordChunk.upload == upload).count()
+		final = RecordChunk.select(RecordChunk.seq, RecordChunk.last).where(RecordChunk.upload == upload) \
+			.order_by(RecordChunk.seq.desc()).tuples().first()
+		if final is None or not final[1] or final[0] != chunks - 1:
+			logger.warning('Upload \'{0}\' of chat_id=\'{1}\' is incomplete, it is not saved'.format(upload, chat_id))
+			return 0
+		record = Record.create(chat_uid=uid, timestamp=timestamp_now(), data=None, data_size=size,
+							   header=header, chunks=chunks, label=label[0] if label else None)
+		RecordChunk.update(record_uid=record.id, upload=None).where(RecordChunk.upload == upload).execute()
+		if label:
+			add_tokens(uid, record.id, label[1])
+	return 1
+
+# Drops chunks of an unfinished multi-part record
+def cancel_upload(upload):
+	return RecordChunk.delete().where(RecordChunk.upload == upload).execute()
+
+# Returns tuple (version, data, payload) of given single-part record of given chat, None - if there is no such record
+def get_record_data(chat_id, record_uid):
+	uid = get_chat_uid(chat_id)
+	if uid is None:
+		return None
+	return Record.select(Record.version, Record.data, Record.payload) \
+		.where((Record.id == record_uid) & (Record.chat_uid == uid)).tuples().first()
+
+# Lazily yields encrypted chunks of multi-part record in order, reading them from DB one by one
+def iter_chunks(record_uid):
+	query = RecordChunk.select(RecordChunk.data).where(RecordChunk.record_uid == record_uid).order_by(RecordChunk.seq)
+	for (data,) in query.tuples().iterator():
+		yield data
 
-# TODO: probably manage ourselves by deleting duplicates
 # Deletes all data connected with given chat_id. returns number of deletions from tables (chats, records)
 def delete_all(chat_id):
-	chat = Chat.select(Chat.id).where(Chat.chat_id == chat_id)
-	if len(chat) == 0:
-		logger.warning('Chat with chat_id=\'{0}\' could not be found! Data has not been not deleted!')
+	uid = get_chat_uid(chat_id)
+	if uid is None:
+		logger.warning('Chat with chat_id=\'{0}\' could not be found! Data has not been not deleted!'.format(chat_id))
 		return (0, 0)
-	elif len(chat) > 1:
-		logger.warning('{1} duplicates for chat_id=\'{0}\' exist!')
 
-	records = Record.delete().where(Record.chat_uid == chat).execute()
-	chat = Chat.delete().where(Chat.chat_id == chat_id).execute()
+	with db.atomic():
+		RecordChunk.delete().where(RecordChunk.record_uid.in_(Record.select(Record.id).where(Record.chat_uid == uid))).execute()
+		RecordToken.delete().where(RecordToken.chat_uid == uid).execute()
+		Rekey.delete().where(Rekey.chat_uid == uid).execute()
+		records = Record.delete().where(Record.chat_uid == uid).execute()
+		chat = Chat.delete().where(Chat.id == uid).execute()
+	chat_cache.invalidate(chat_id)
 	return (chat, records)
 
-# TODO: probably manage ourselves by deleting duplicates
-# Returns meta-info on all records for given chat_id
+# Returns meta-info on all records for given chat_id (creating chat if absent), None - if DB is not available
 def get_records_overview(chat_id, limit=None):
-	chat = Chat.select(Chat.id).where(Chat.chat_id == chat_id)
-	if len(chat) == 0:
-		logger.warning('Chat with chat_id=\'{0}\' could not be found! Creating new.')
-		create_chat_if_not_exist(chat_id)
-	elif len(chat) > 1:
-		logger.warning('{1} duplicates for chat_id=\'{0}\' exist!')
-
-	chat = Chat.select(Chat.id).where(Chat.chat_id == chat_id)
-	if len(chat) == 0:
-		logger.warning('Chat with chat_id=\'{0}\' could not be found even after creating! Probably DB is not available.')
+	uid = ensure_chat_uid(chat_id)
+	if uid is None:
+		logger.warning('Chat with chat_id=\'{0}\' could not be found even after creating! Probably DB is not available.'.format(chat_id))
 		return None
 
-	records = Record.select(Record.id, Record.timestamp, Record.data_size).where(Record.chat_uid == chat).execute()
+	records = Record.select(Record.id, Record.timestamp, Record.data_size).where(Record.chat_uid == uid)
+	if limit is not None:
+		records = records.limit(limit)
 
 	return [{
 		'uid': r.id,
 		'timestamp': r.timestamp,
 		'size': r.data_size
-	} for r in records]
\ No newline at end of file
+	} for r in records.execute()]
+
+# Returns number of records stored for given chat_id
+def count_records(chat_id):
+	uid = get_chat_uid(chat_id)
+	if uid is None:
+		return 0
+	return Record.select().where(Record.chat_uid == uid).count()
+
+# Returns one page of meta-info on records for given chat_id, newest first, None - if DB is not available.
+# Pages are addressed by keyset cursors (timestamp, uid) of a record: 'after' gives records older than the cursor,
+# 'before' - newer ones (still ordered newest first); without both the newest page is returned
+def get_records_page(chat_id, after=None, before=None, limit=BROWSE_PAGE_LIMIT):
+	uid = ensure_chat_uid(chat_id)
+	if uid is None:
+		logger.warning('Chat with chat_id=\'{0}\' could not be found even after creating! Probably DB is not available.'.format(chat_id))
+		return None
+
+	key = Tuple(Record.timestamp, Record.id)
+	records = Record.select(Record.id, Record.timestamp, Record.data_size).where(Record.chat_uid == uid)
+	if before is not None:
+		records = records.where(key > Tuple(*before)).order_by(Record.timestamp.asc(), Record.id.asc())
+	else:
+		if after is not None:
+			records = records.where(key < Tuple(*after))
+		records = records.order_by(Record.timestamp.desc(), Record.id.desc())
+
+	page = [{
+		'uid': r.id,
+		'timestamp': r.timestamp,
+		'size': r.data_size
+	} for r in records.limit(limit).execute()]
+	if before is not None:
+		page.reverse()
+	return page
+
+# Returns meta-info (with label ciphertext) on records of given chat, whose labels have all given index tokens,
+# newest first. Tokens are resolved to records by one lookup of RecordToken index
+def search_records(chat_id, tokens, limit=SEARCH_LIMIT):
+	uid = get_chat_uid(chat_id)
+	if uid is None or len(tokens) == 0:
+		return []
+
+	matches = RecordToken.select(RecordToken.record_uid) \
+		.where((RecordToken.chat_uid == uid) & RecordToken.token.in_(tokens)) \
+		.group_by(RecordToken.record_uid).having(fn.COUNT(RecordToken.token) == len(set(tokens)))
+	records = Record.select(Record.id, Record.timestamp, Record.data_size, Record.label) \
+		.where(Record.id.in_(matches)).order_by(Record.timestamp.desc(), Record.id.desc()).limit(limit)
+	return [{
+		'uid': r.id,
+		'timestamp': r.timestamp,
+		'size': r.data_size,
+		'label': r.label
+	} for r in records.execute()]
+
+# Returns serialized session state of given chat, None - if nothing is stored
+def load_chat_state(chat_id):
+	return ChatState.select(ChatState.data).where(ChatState.chat_id == chat_id).scalar()
+
+# Stores serialized session states given as dict {chat_id: data} in one transaction
+def save_chat_states(states):
+	if len(states) == 0:
+		return
+	with db.atomic():
+		for chat_id, data in states.items():
+			ChatState.insert(chat_id=chat_id, data=data) \
+				.on_conflict(conflict_target=[ChatState.chat_id], update={ChatState.data: EXCLUDED.data}).execute()
+
+# Returns state of given conversation, None - if there is none
+def load_conversation(name, key):
+	return ConversationState.select(ConversationState.state) \
+		.where((ConversationState.name == name) & (ConversationState.key == key)).scalar()
+
+# Stores states of conversations given as dict {(name, key): state} in one transaction, state None removes conversation
+def save_conversations(states):
+	if len(states) == 0:
+		return
+	with db.atomic():
+		for (name, key), state in states.items():
+			if state is None:
+				ConversationState.delete() \
+					.where((ConversationState.name == name) & (ConversationState.key == key)).execute()
+			else:
+				ConversationState.insert(name=name, key=key, state=state) \
+					.on_conflict(conflict_target=[ConversationState.name, ConversationState.key],
+								 update={ConversationState.state: EXCLUDED.state}).execute()
+
+# Returns tuple (failures, blocked_until) of failed logins of given chat, None - if there are none
+def load_login_attempt(chat_id):
+	return LoginAttempt.select(LoginAttempt.failures, LoginAttempt.blocked_until) \
+		.where(LoginAttempt.chat_id == chat_id).tuples().first()
+
+def save_login_attempt(chat_id, failures, blocked_until):
+	LoginAttempt.insert(chat_id=chat_id, failures=failures, blocked_until=blocked_until) \
+		.on_conflict(conflict_target=[LoginAttempt.chat_id],
+					 update={LoginAttempt.failures: EXCLUDED.failures, LoginAttempt.blocked_until: EXCLUDED.blocked_until}) \
+		.execute()
+
+def delete_login_attempt(chat_id):
+	return LoginAttempt.delete().where(LoginAttempt.chat_id == chat_id).execute()
+
+# Removes failed logins of chats, which are not blocked since given unix time
+def prune_login_attempts(before):
+	return LoginAttempt.delete().where(LoginAttempt.blocked_until < before).execute()
@@ -1,6 +1,7 @@
 import db_handler as dbh
 
+dbh.init()
 dbh.create_chat_if_not_exist(12, 'adf')
-dbh.create_record(12, 'data1')
-dbh.create_record(12, 'data2')
+dbh.create_record(12, b'data1', 5)
+dbh.create_record(12, b'data2', 5)
 print (dbh.delete_all(12))
\ No newline at end of file
@@ -0,0 +1,86 @@
+import threading, logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+
+from constants import *
+
+logger = logging.getLogger(__name__)
+
+# Dedicated executor for CPU-heavy password hashing, so that PBKDF2 never holds the dispatcher thread.
+# Admission is bounded globally (queue_limit) and per chat (per_chat_limit), so one chat cannot flood it.
+class KdfPool:
+	def __init__(self, kind=KDF_POOL_KIND, workers=KDF_POOL_WORKERS,
+				 queue_limit=KDF_QUEUE_LIMIT, per_chat_limit=KDF_PER_CHAT_LIMIT):
+		if kind not in ('thread', 'process', 'inline'):
+			raise ValueError('Unknown KDF pool kind \'{0}\''.format(kind))
+		self.kind = kind
+		self.workers = workers
+		self.queue_limit = queue_limit
+		self.per_chat_limit = per_chat_limit
+		self._executor = None
+		self._lock = threading.Lock()
+		self._pending = 0
+		self._per_chat = {}
+
+	# Executor is created on first use, so importing this module stays cheap (and fork-safe for process pools)
+	def _get_executor(self):
+		with self._lock:
+			if self._executor is None:
+				if self.kind == 'process':
+					self._executor = ProcessPoolExecutor(max_workers=self.workers)
+				else:
+					self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='kdf')
+			return self._executor
+
+	def _admit(self, chat_id):
+		with self._lock:
+			if self._pending >= self.queue_limit:
+				logger.warning('KDF queue is full ({0} jobs)! Job for chat_id=\'{1}\' rejected'.format(self._pending, chat_id))
+				return False
+			if self._per_chat.get(chat_id, 0) >= self.per_chat_limit:
+				return False
+			self._pending += 1
+			self._per_chat[chat_id] = self._per_chat.get(chat_id, 0) + 1
+			return True
+
+	def _release(self, chat_id):
+		with self._lock:
+			self._pending -= 1
+			left = self._per_chat.get(chat_id, 1) - 1
+			if left > 0:
+				self._per_chat[chat_id] = left
+			else:
+				self._per_chat.pop(chat_id, None)
+
+	# Schedules fn(*args) on behalf of chat_id. Returns Future with the result, None - if admission was refused
+	def submit(self, chat_id, fn, *args):
+		if not self._admit(chat_id):
+			return None
+
+		if self.kind == 'inline':
+			future = Future()
+			try: future.set_result(fn(*args))
+			except Exception as e: future.set_exception(e)
+			self._release(chat_id)
+			return future
+
+		try:
+			future = self._get_executor().submit(fn, *args)
+		except Exception:
+			self._release(chat_id)
+			raise
+		# Registered before any caller callback, so the slot is free again when continuation runs
+		future.add_done_callback(lambda f: self._release(chat_id))
+		return future
+
+	# Returns number of jobs in flight (over all chats if chat_id is None)
+	def pending(self, chat_id=None):
+		with self._lock:
+			return self._pending if chat_id is None else self._per_chat.get(chat_id, 0)
+
+	def shutdown(self, wait=True):
+		with self._lock:
+			executor, self._executor = self._executor, None
+		if executor is not None:
+			executor.shutdown(wait=wait)
+
+pool = KdfPool()
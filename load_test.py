@@ -0,0 +1,179 @@
+# Offline load test of the bot: synthetic chats go through start -> password (twice) -> records (add and save)
+# -> browse -> back -> logout, handled by the real handlers of main.py in a Dispatcher whose Bot answers every
+# API call locally. Reports handler latency (p50/p99), updates/sec, DB queries per update and peak RSS
+# (and breakdown by handler, query and crypto call, if METRICS_ENABLED).
+# Password hashing runs inline with KDF_ITERATIONS of PBKDF2, so that it does not hide everything else (set it to
+# constants.KDF_ITERATIONS or calibrate crypto to measure the real cost)
+# Usage: python load_test.py [chats]
+import os, queue, resource, shutil, sys, tempfile, threading, time
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+from telegram.utils.request import Request
+
+import db_handler as dbh
+import kdf_pool
+import crypto
+import metrics
+import outbox
+import main
+from cleanup import cleaner
+from persistence import SqlitePersistence
+from db_bench import QueryCounter
+from constants import *
+
+CHATS = 1000
+DRIVERS = 4
+RECORDS = 3
+KDF_ITERATIONS = 1000
+PASSWORD = 'LoadTestPassw0rd'
+SECRET = 'login: user, password: secret ' * 4
+
+# Answers Bot API calls without network: sent messages get ids from the chat's message counter
+class FakeRequest(Request):
+	def __init__(self, bot):
+		super().__init__()
+		self.bot = bot
+
+	def _answer(self, url, data):
+		method = url.rsplit('/', 1)[-1]
+		self.bot.record(method)
+		if method in ('sendMessage', 'editMessageText'):
+			chat_id = data['chat_id']
+			message_id = data['message_id'] if method == 'editMessageText' else self.bot.next_message_id(chat_id)
+			return {'message_id': message_id, 'date': int(time.time()), 'text': data.get('text', ''),
+					'chat': {'id': chat_id, 'type': 'private'}}
+		if method == 'getMe':
+			return {'id': 123456, 'is_bot': True, 'first_name': 'SecureStore', 'username': 'securestore_bot'}
+		if method == 'getMyCommands':
+			return []
+		return True
+
+	def post(self, url, data, timeout=None):
+		return self._answer(url, data)
+
+	def get(self, url, timeout=None):
+		return self._answer(url, {})
+
+# Bot which records outgoing calls instead of sending them
+class FakeBot(Bot):
+	def __init__(self):
+		super().__init__('123456:load-test', request=FakeRequest(self))
+		self._lock = threading.Lock()
+		self._message_ids = {}
+		self.calls = {}
+
+	def record(self, method):
+		with self._lock:
+			self.calls[method] = self.calls.get(method, 0) + 1
+
+	def next_message_id(self, chat_id):
+		with self._lock:
+			message_id = self._message_ids[chat_id] = self._message_ids.get(chat_id, 0) + 1
+			return message_id
+
+# Builds updates of one chat, as user actions arrive
+class User:
+	def __init__(self, bot, chat_id):
+		self.bot = bot
+		self.chat_id = chat_id
+		self.update_id = chat_id * 1000
+
+	def _chat(self):
+		return {'id': self.chat_id, 'type': 'private'}
+
+	def _from(self):
+		return {'id': self.chat_id, 'is_bot': False, 'first_name': 'user{0}'.format(self.chat_id)}
+
+	def message(self, text):
+		self.update_id += 1
+		message = {'message_id': self.bot.next_message_id(self.chat_id), 'date': int(time.time()), 'text': text,
+				   'chat': self._chat(), 'from': self._from()}
+		if text.startswith('/'):
+			message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+		return Update.de_json({'update_id': self.update_id, 'message': message}, self.bot)
+
+	def click(self, data):
+		self.update_id += 1
+		message = {'message_id': self.bot.next_message_id(self.chat_id), 'date': int(time.time()), 'text': 'page',
+				   'chat': self._chat()}
+		query = {'id': str(self.update_id), 'chat_instance': str(self.chat_id), 'data': data, 'from': self._from(),
+				 'message': message}
+		return Update.de_json({'update_id': self.update_id, 'callback_query': query}, self.bot)
+
+	# Yields updates of the whole session
+	def session(self):
+		yield self.message('/start')
+		yield self.message(PASSWORD)
+		yield self.message(PASSWORD)
+		for i in range(RECORDS):
+			yield self.message(BTN_RECORD)
+			yield self.message(SECRET)
+			yield self.message(BTN_RECORD_SAVE)
+		yield self.message(BTN_BROWSE)
+		yield self.click(CB_BROWSE_BACK)
+		yield self.message(BTN_LOGOUT)
+
+def percentile(values, p):
+	return values[min(len(values) - 1, int(len(values) * p))]
+
+# Feeds sessions of given chats to the dispatcher interleaved, as they would arrive. Returns latencies of updates
+def drive(dp, chat_ids, latencies):
+	sessions = [User(dp.bot, chat_id).session() for chat_id in chat_ids]
+	while sessions:
+		for session in list(sessions):
+			update = next(session, None)
+			if update is None:
+				sessions.remove(session)
+				continue
+			start = time.perf_counter()
+			dp.process_update(update)
+			latencies.append(time.perf_counter() - start)
+
+if __name__ == '__main__':
+	chats = int(sys.argv[1]) if len(sys.argv) > 1 else CHATS
+	directory = tempfile.mkdtemp()
+	dbh.init(os.path.join(directory, 'load.db'))
+	crypto.set_kdf_params(crypto.make_kdf_params(crypto.KDF_PBKDF2, i=KDF_ITERATIONS))
+	kdf_pool.pool = kdf_pool.KdfPool(kind='inline')
+	# Replies are sent by the outbox after handlers return, the fake Bot API has no flood limits
+	outbox.scheduler = outbox.Outbox(rate=None, chat_rate=None)
+	if METRICS_ENABLED:
+		metrics.instrument_db(dbh.db)
+
+	bot = FakeBot()
+	dp = Dispatcher(bot, queue.Queue(), use_context=True, persistence=SqlitePersistence() if PERSISTENCE_ENABLED else None)
+	main.register_handlers(dp)
+
+	latencies = []
+	drivers = [threading.Thread(target=drive, args=(dp, range(1 + i, chats + 1, DRIVERS), latencies))
+			   for i in range(DRIVERS)]
+	with QueryCounter(dbh.db) as counter:
+		start = time.perf_counter()
+		for thread in drivers:
+			thread.start()
+		for thread in drivers:
+			thread.join()
+		elapsed = time.perf_counter() - start
+		flush_start = time.perf_counter()
+		if dp.persistence:
+			dp.persistence.flush()
+		flush = time.perf_counter() - flush_start
+	cleaner.join()
+	outbox.scheduler.join()
+
+	latencies.sort()
+	print('chats: {0}, updates: {1}, drivers: {2}, KDF iterations: {3}'.format(chats, len(latencies), DRIVERS, KDF_ITERATIONS))
+	print('  {0:<20}{1:>12.0f}'.format('updates/sec', len(latencies) / elapsed))
+	print('  {0:<20}{1:>12.2f}'.format('p50 latency, ms', percentile(latencies, 0.5) * 1e3))
+	print('  {0:<20}{1:>12.2f}'.format('p99 latency, ms', percentile(latencies, 0.99) * 1e3))
+	print('  {0:<20}{1:>12.2f}'.format('queries/update', counter.count / len(latencies)))
+	print('  {0:<20}{1:>12.2f}'.format('flush, ms', flush * 1e3))
+	print('  {0:<20}{1:>12.1f}'.format('peak RSS, MiB', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+	print('  Bot API calls: {0}'.format(', '.join('{0}={1}'.format(k, v) for k, v in sorted(bot.calls.items()))))
+	if METRICS_ENABLED:
+		metrics.log_snapshot()
+
+	dp.stop()
+	kdf_pool.pool.shutdown()
+	shutil.rmtree(directory)
@@ -6,16 +6,35 @@
 SecureStore
 """
 # TODO: clear all keyboards after each usage
-import logging
+import time
+_started = time.perf_counter()	# imports of main are timed from here (see profile_startup())
+import datetime, logging, io, sys, threading
+from uuid import uuid4
+from concurrent.futures import Future
 
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, ConversationHandler, CallbackQueryHandler)
+from telegram import Bot, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, ConversationHandler,
+						  DispatcherHandlerStop)
 
 import db_handler as dbh
+import kdf_pool
+import metrics
+import outbox
+from session_timer import InactivityTracker
+from rate_limit import LoginLimiter
+from cleanup import cleaner
+from outbox import PRIORITY_AUTH, PRIORITY_NORMAL
+from msg_ids import MsgIds
+from router import ButtonRouter
+from persistence import SqlitePersistence
+from rekey import start_rekey, finish_rekey, rekey_pending
+import archive
+from metrics import timed
 from api_token import TOKEN
 from crypto import *
 from util import *
 from constants import *
+_imported = time.perf_counter()
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -23,15 +42,40 @@ logger = logging.getLogger(__name__)
 
 
 conv_handler = None
+inactivity = InactivityTracker()
+login_limiter = LoginLimiter(store=dbh if LOGIN_PERSISTENT else None)
 markup_idle = [[BTN_RECORD, BTN_BROWSE], [BTN_SETTINGS, BTN_LOGOUT]]
+markup_confirm = [[BTN_RECORD_SAVE, BTN_RECORD_CANCEL], [BTN_RECORD_LABEL]]
+
+# Guards msg_ids of chats, which are appended by threads of the outbox once messages are sent
+msg_ids_lock = threading.Lock()
 
 # Keep track of IDs of all messages created during session in order to be able to clear all of them on logout
 def store_msg_id(ctx, msg):
-	if 'msg_ids' not in ctx.chat_data or ctx.chat_data['msg_ids'] is None:
-		ctx.chat_data['msg_ids'] = []
-	ctx.chat_data['msg_ids'].append(msg.message_id)
+	with msg_ids_lock:
+		if 'msg_ids' not in ctx.chat_data or ctx.chat_data['msg_ids'] is None:
+			ctx.chat_data['msg_ids'] = MsgIds()
+		ctx.chat_data['msg_ids'].append(msg.message_id)
+
+# Sends message to the chat through the outbox (see outbox.py) without waiting for it. Its id is stored once it is sent
+def send(ctx, chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+	return outbox.scheduler.send(ctx.bot, chat_id, text, priority=priority, on_sent=lambda msg: store_msg_id(ctx, msg),
+								 **kwargs)
+
+def reply(upd, ctx, text, **kwargs):
+	return send(ctx, upd.effective_chat.id, text, **kwargs)
+
+# Replies with a password prompt, which goes ahead of other messages
+def prompt(upd, ctx, text, **kwargs):
+	return send(ctx, upd.effective_chat.id, text, priority=PRIORITY_AUTH, **kwargs)
+
+# Deletes message of the user (e.g. with password or secret) ahead of other messages
+def delete_message(ctx, msg):
+	outbox.scheduler.call(msg.chat_id, ctx.bot.delete_message, msg.chat_id, msg.message_id, priority=PRIORITY_AUTH,
+						  per_chat=False)
 
 # Checks and actions needed to be performed on each atomic signal received from user
+@timed('handler')
 def every_signal_checks(upd, ctx):
 	# Leave all groups/channels and stay only in private chats
 	if not upd.message.chat.type == upd.message.chat.PRIVATE:
@@ -42,51 +86,128 @@ def every_signal_checks(upd, ctx):
 	elif is_authorized(ctx):
 		update_authorization_timer(upd, ctx)
 
+	# Authorization expired while nobody was watching (bot was restarted) or its end was not saved, while the chat is
+	# not asked for password: this update is not handled further
+	elif not entering_password(upd, ctx) and upd.effective_chat.id not in inactivity \
+			and chat_password(ctx, upd.effective_chat.id) is not None:
+		store_msg_id(ctx, upd.message)
+		authorization_alarm(upd, ctx)
+		raise DispatcherHandlerStop()
+
 	# Collect all message-ids in context in order to remove everything on logout
 	store_msg_id(ctx, upd.message)
 
+# Returns True if the chat is in the middle of entering or setting up password
+def entering_password(upd, ctx):
+	if ctx.chat_data.get('password_mode') in (MODE_PWD_SET, MODE_PWD_TEST):
+		return True
+	state = conv_handler.conversations.get(conv_handler._get_key(upd))
+	# Not an int while a handler is still running asynchronously
+	if state is not None and not isinstance(state, int):
+		return True
+	return state in (STATE_TYPING_PASSWORD, STATE_CHOOSE_PASSWORD_ACTION)
+
+# Marks chat_data changed outside of handling an update (it is persisted only when an update is handled otherwise)
+def save_chat_data(ctx, chat_id):
+	if ctx.dispatcher.persistence is not None:
+		ctx.dispatcher.persistence.update_chat_data(chat_id, ctx.chat_data)
+
 # Checks if authorization expired and returns True - is still authorized, False - o\w
 def is_authorized(ctx):
 	return 'authorized' in ctx.chat_data \
 			and ctx.chat_data['authorized'] is not None \
 			and timestamp_now() - ctx.chat_data['authorized'] <= DEFAULT_UNAUTH_TIMER
 
-# Is called when user is inactive for specified time. Shows corresponding msg and TODO: changes conversation state
-def authorization_alarm(alarm_ctx):
+# Is called when user is inactive for specified time. Shows corresponding msg and changes conversation state
+@timed('handler')
+def authorization_alarm(upd, ctx):
 	global conv_handler
-	job = alarm_ctx.job
-	upd = job.context['upd']
-	ctx = job.context['ctx']
 	chat_id = upd.message.chat_id
 
 	if DEFAULT_CLEAR_ON_ALARM:
 		clear_history(upd, ctx)
-	msg = ctx.bot.send_message(chat_id, text='You were inactive for {0} seconds, so now you need to prove your identity.\n'
-									   'Enter the password, please.'.format(DEFAULT_UNAUTH_TIMER), reply_markup=ReplyKeyboardRemove())
-	store_msg_id(ctx, msg)
-	ctx.chat_data.pop('authorized_job', None)
+	drop_pending_record(ctx)
+	forget_key(password_key(ctx.chat_data.get('password')))
+	send(ctx, chat_id, 'You were inactive for {0} seconds, so now you need to prove your identity.\n'
+					   'Enter the password, please.'.format(DEFAULT_UNAUTH_TIMER),
+		 priority=PRIORITY_AUTH, reply_markup=ReplyKeyboardRemove())
 	update_authorization_timer(upd, ctx, unauthorize=True)
 	ctx.chat_data['password_mode'] = MODE_PWD_TEST
 	logger.debug('authorization_alarm')
 
 	conv_handler.update_state(STATE_TYPING_PASSWORD, conv_handler._get_key(upd))
-
-# Called each time, when user makes action. Sets up new alarm instead of prev and updates authorization timestamp
+	save_chat_data(ctx, chat_id)
+
+# Periodic job: raises alarm for every chat whose inactivity deadline has passed
+@timed('handler')
+def sweep_inactive(job_ctx):
+	for chat_id, (upd, ctx) in inactivity.sweep():
+		try:
+			authorization_alarm(upd, ctx)
+		except Exception as e:
+			logger.warning('Authorization alarm for chat_id=\'{0}\' failed: {1}'.format(chat_id, e))
+
+# Called each time, when user makes action. Moves inactivity deadline of this chat and updates authorization timestamp
 def update_authorization_timer(upd, ctx, unauthorize=False):
 	ctx.chat_data['authorized'] = None if unauthorize else timestamp_now()
-	logger.debug('update_authorization_timer: authorized={0}   unauthorize={1}'.format(ctx.chat_data['authorized'], unauthorize))
+	logger.debug('update_authorization_timer: authorized=%s   unauthorize=%s', ctx.chat_data['authorized'], unauthorize)
 	if unauthorize:
-		for job in ctx.job_queue.jobs():
-			job.schedule_removal()
-		logger.debug('update_authorization_timer: all jobs removed'.format(ctx.chat_data['authorized'], unauthorize))
+		inactivity.cancel(upd.effective_chat.id)
 	else:
-		if 'authorized_job' in ctx.chat_data:
-			logger.debug('update_authorization_timer: job removed'.format(ctx.chat_data['authorized'], unauthorize))
-			ctx.chat_data['authorized_job'].schedule_removal()
-		ctx.chat_data['authorized_job'] = ctx.job_queue.run_once(authorization_alarm, DEFAULT_UNAUTH_TIMER, context={'upd': upd, 'ctx': ctx})
-		logger.debug('update_authorization_timer: job created'.format(ctx.chat_data['authorized'], unauthorize))
+		inactivity.touch(upd.effective_chat.id, DEFAULT_UNAUTH_TIMER, (upd, ctx))
+
+# Returns password-hash of the chat, reading it from DB if it is not in context (it is never persisted)
+def chat_password(ctx, chat_id):
+	if ctx.chat_data.get('password') is None:
+		pwd = dbh.get_password(chat_id)
+		if pwd is None:
+			return None
+		ctx.chat_data['password'] = pwd.encode() if isinstance(pwd, str) else pwd
+	return ctx.chat_data['password']
+
+# Replaces password-hash of the chat by upgraded one (see crypto.needs_upgrade). Its records are re-encrypted with
+# new key in background (see rekey.py). Record being added is dropped (the session ended before login anyway)
+def upgrade_password(ctx, chat_id, upgraded):
+	drop_pending_record(ctx)
+	try:
+		start_rekey(chat_id, chat_password(ctx, chat_id), upgraded)
+	except Exception as e:
+		logger.warning('Upgrading password-hash of chat_id=\'{0}\' failed: {1}'.format(chat_id, e))
+		return
+	ctx.chat_data['password'] = upgraded
+
+# Re-encrypts records of the chat left by upgrade of its password-hash (now or before restart), batch by batch
+def rekey_in_background(ctx, chat_id):
+	def run():
+		try:
+			finish_rekey(chat_id)
+		except Exception as e:
+			logger.warning('Re-encrypting records of chat_id=\'{0}\' failed: {1}'.format(chat_id, e))
+	ctx.dispatcher.run_async(run)
+
+# Replies, if records of the chat are still being re-encrypted (so they are not all under one key yet), and makes
+# sure it goes on. Returns True in that case
+def still_rekeying(upd, ctx):
+	chat_id = upd.effective_chat.id
+	if not rekey_pending(chat_id):
+		return False
+	rekey_in_background(ctx, chat_id)
+	reply(upd, ctx, 'Your records are still being re-encrypted with your new password. Please try again shortly.',
+		  reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
+	return True
+
+# Periodic job: forgets password attempts of chats, which are not limited anymore
+@timed('handler')
+def prune_login_attempts(job_ctx):
+	login_limiter.prune()
+
+# Periodic job: writes state of chats changed since previous flush
+@timed('handler')
+def flush_state(job_ctx):
+	job_ctx.dispatcher.persistence.flush()
 
 # Entry point
+@timed('handler')
 def start(upd, ctx):
 	# ctx.chat_data contains 4 password fields:
 	#	'start_password'- True if password was given instead of /start command
@@ -100,7 +221,7 @@ def start(upd, ctx):
 	pwd = dbh.get_password(chat_id)
 
 	if 'msg_ids' not in ctx.chat_data or ctx.chat_data['msg_ids'] is None:
-		ctx.chat_data['msg_ids'] = []
+		ctx.chat_data['msg_ids'] = MsgIds()
 
 	# if pwd is None: # Seems to be redundant
 	# 	logger.warning('Chat #{0} could not be found. Creating new entry.'.format(chat_id))
@@ -121,34 +242,41 @@ def start(upd, ctx):
 		# If authorization still valid
 		if is_authorized(ctx):
 			ctx.chat_data['password_mode'] = MODE_PWD_AUTHORIZED
-			msg = upd.message.reply_text(
+			prompt(upd, ctx,
 				"Hi again! My name is Charles. You can trust me all your secrets and nobody will ever have known about them except you.\n"
 				"Use menu buttons to start securely storing your data.",
 				reply_markup=ReplyKeyboardMarkup([[BTN_RECORD, BTN_BROWSE],
 												  [BTN_PWD_CHANGE]], one_time_keyboard=True))
-			store_msg_id(ctx, msg)
 			return STATE_IDLE
 		# If no authorization or expired
 		else:
 			ctx.chat_data['password_mode'] = MODE_PWD_TEST
 			update_authorization_timer(upd, ctx, unauthorize=True)
-			msg = upd.message.reply_text(
+			prompt(upd, ctx,
 				"Hi again! My name is Charles. You can trust me all your secrets and nobody will ever have known about them except you.\n"
 				"Please, send me the password first, so I can trust you")
-			store_msg_id(ctx, msg)
 			return STATE_TYPING_PASSWORD
 
 	# If password need to be set
 	ctx.chat_data['password_mode'] = MODE_PWD_SET
 	update_authorization_timer(upd, ctx, unauthorize=True)
-	msg = upd.message.reply_text(
+	prompt(upd, ctx,
 		"Hi! My name is Charles. You can trust me all your secrets and nobody will ever have known about them except you. "
 		"Please send me the password to start.\n\n"
 		"Notice, there is no way recover data if the password is lost! So, please, remember it for sure!!!")
-	store_msg_id(ctx, msg)
 	return STATE_TYPING_PASSWORD
 
-# Checks given password
+# Feeds state returned by continuation of a handler (run after its future resolved) back into conversation
+def continue_async(upd, ctx, callback, *args):
+	def run():
+		state = callback(upd, ctx, *args)
+		if state is not None:
+			conv_handler.update_state(state, conv_handler._get_key(upd))
+		save_chat_data(ctx, upd.effective_chat.id)
+	ctx.dispatcher.run_async(run)
+
+# Receives password and schedules its hashing on KDF pool. The check itself continues in password_hashed()
+@timed('handler')
 def received_password(upd, ctx):
 	# this is triggered for every signal, filter here only those, which have text
 	if upd.message.text is None or len(upd.message.text) == 0:
@@ -156,9 +284,41 @@ def received_password(upd, ctx):
 
 	chat_id = upd.message.chat_id
 
+	# Too many attempts: password is not even hashed
+	wait = login_limiter.check(chat_id)
+	if wait > 0:
+		delete_message(ctx, upd.message)
+		prompt(upd, ctx, 'Too many attempts. Please wait {0} seconds and try again.'.format(int(wait) + 1))
+		return
+
+	# New password is hashed with fresh salt, repeated or entered one - as the hash it is compared with
+	if ctx.chat_data.get('password_mode') == MODE_PWD_SET:
+		reference = ctx.chat_data.get('password')
+	else:
+		reference = chat_password(ctx, chat_id)
 	is_weak = is_password_weak(upd.message.text)
-	hash = get_hash(upd.message.text)
-	upd.message.delete()
+	future = kdf_pool.pool.submit(chat_id, check_password, upd.message.text, reference, kdf_params())
+	delete_message(ctx, upd.message)
+
+	# Either previous password of this chat is still being checked or the pool is overloaded
+	if future is None:
+		prompt(upd, ctx, 'I\'m busy checking passwords at the moment. Please wait a few seconds and try again.')
+		return
+
+	# Hash is already there (inline pool), no need to leave current thread
+	if future.done():
+		return password_hashed(upd, ctx, future, is_weak)
+	future.add_done_callback(lambda f: continue_async(upd, ctx, password_hashed, f, is_weak))
+
+# Checks given password, once its hash has been calculated
+@timed('handler')
+def password_hashed(upd, ctx, future, is_weak):
+	try:
+		hash, upgraded = future.result()
+	except Exception as e:
+		logger.warning('Hashing password for chat_id=\'{0}\' failed: {1}'.format(upd.message.chat_id, e))
+		prompt(upd, ctx, 'Error occured while checking your password. Please try again later')
+		return
 
 	# Case when entry point is not /start but password
 	if 'password_mode' not in ctx.chat_data:
@@ -168,275 +328,610 @@ def received_password(upd, ctx):
 
 	# Nothing to do if already authorized
 	if ctx.chat_data['password_mode'] == MODE_PWD_AUTHORIZED:
-		msg = upd.message.reply_text('Authorized successfully! Use menu buttons to securely store your secrets',
+		prompt(upd, ctx, 'Authorized successfully! Use menu buttons to securely store your secrets',
 							   reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
-		store_msg_id(ctx, msg)
 		return STATE_IDLE
 
 	# Entered password needs to be used for authorization
 	if ctx.chat_data['password_mode'] == MODE_PWD_TEST:
 		# Entered password is correct
-		if ctx.chat_data['password'] == hash:
+		if same_hash(chat_password(ctx, upd.message.chat_id), hash):
+			login_limiter.succeeded(upd.message.chat_id)
+			if upgraded is not None:
+				upgrade_password(ctx, upd.message.chat_id, upgraded)
+			rekey_in_background(ctx, upd.message.chat_id)
 			ctx.chat_data['password_mode'] = MODE_PWD_AUTHORIZED
 			update_authorization_timer(upd, ctx)
-			msg = upd.message.reply_text('Successfully authorized! You can now begin securely storing your data',
+			prompt(upd, ctx, 'Successfully authorized! You can now begin securely storing your data',
 								   reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
-			store_msg_id(ctx, msg)
 			return STATE_IDLE
 		# Entered password is incorrect
 		else:
-			# TODO: add here counter and only show keyboard on 3rd attempt
+			# TODO: only show keyboard on 3rd attempt
+			blocked = login_limiter.failed(upd.message.chat_id)
 			update_authorization_timer(upd, ctx, unauthorize=True)
-			msg = upd.message.reply_text('Ooopsie... Entered password is incorrect! You can try again or set up a new password.\n',
+			prompt(upd, ctx, 'Ooopsie... Entered password is incorrect! You can try again in {0} seconds '
+								   'or set up a new password.\n'.format(int(blocked)),
 								   reply_markup=ReplyKeyboardMarkup([[BTN_PWD_TRYAGAIN, BTN_PWD_NEW]], one_time_keyboard=True))
-			store_msg_id(ctx, msg)
 			return STATE_CHOOSE_PASSWORD_ACTION
 
 	# User needs to set up the password
 	if ctx.chat_data['password_mode'] == MODE_PWD_SET:
 		# First entry of password
-		if 'password' not in ctx.chat_data:
+		if ctx.chat_data.get('password') is None:
 			ctx.chat_data['password'] = hash
 			if is_weak:
-				msg = upd.message.reply_text('The password you entered is weak and does not provide enough security!\n'
+				prompt(upd, ctx, 'The password you entered is weak and does not provide enough security!\n'
 									   'It is highly recommended to come up with reliable password, which satisfies:\n'
 									   '- At least 8 symbols\n'
 									   '- Consist of a-z, A-Z, 0-9 and/or special symbols @#$%^&+=\n\n'
 									   'Do you want to change your opinion and create stronger password?',
 									   reply_markup=ReplyKeyboardMarkup([[BTN_PWD_STRONGER, BTN_PWD_LEAVEWEAK]], one_time_keyboard=True))
-				store_msg_id(ctx, msg)
 				return STATE_CHOOSE_PASSWORD_ACTION
 			else:
-				msg = upd.message.reply_text('Please send me the password again (and remember it properly!).')
-				store_msg_id(ctx, msg)
+				prompt(upd, ctx, 'Please send me the password again (and remember it properly!).')
 				return STATE_TYPING_PASSWORD
 		# Repetition of password
 		else:
-			if ctx.chat_data['password'] != hash:
-				msg = upd.message.reply_text('Ooopsie! The passwords do not match! Please try again or create new password.',
+			if not same_hash(ctx.chat_data['password'], hash):
+				prompt(upd, ctx, 'Ooopsie! The passwords do not match! Please try again or create new password.',
 									   reply_markup=ReplyKeyboardMarkup([[BTN_PWD_TRYAGAIN, BTN_PWD_STARTOVER]], one_time_keyboard=True))
-				store_msg_id(ctx, msg)
 				return STATE_CHOOSE_PASSWORD_ACTION
 			else:
 				dbh.set_password(upd.message.chat_id, ctx.chat_data['password'])
 				ctx.chat_data['password_mode'] = MODE_PWD_AUTHORIZED
 				update_authorization_timer(upd, ctx)
-				msg = upd.message.reply_text('Password successfully created! You can now begin securely storing your data',
+				prompt(upd, ctx, 'Password successfully created! You can now begin securely storing your data',
 									   reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
-				store_msg_id(ctx, msg)
 				return STATE_IDLE
 
-# TODO: change elifs to handlers (or just somehow reorganize properly)
-# Handles user input password
-def password_btn_clicked(upd, ctx):
-	text = upd.message.text
-	chat_id = upd.message.chat_id
+# Handles click on BTN_PWD_STRONGER: forgets weak password and asks for new one
+@timed('handler')
+def password_stronger_clicked(upd, ctx):
+	ctx.chat_data.pop('password', None)
+	prompt(upd, ctx, 'Very nice decision! Please send me strong password now.\n'
+						   'Notice, there is no way recover data if the password is lost! So, please, remember it carefully!!!')
+	return STATE_TYPING_PASSWORD
 
-	if text == BTN_PWD_STRONGER:
-		ctx.chat_data.pop('password', None)
-		msg = upd.message.reply_text('Very nice decision! Please send me strong password now.\n'
-							   'Notice, there is no way recover data if the password is lost! So, please, remember it carefully!!!')
-		store_msg_id(ctx, msg)
-		return STATE_TYPING_PASSWORD
-	elif text == BTN_PWD_LEAVEWEAK:
-		msg = upd.message.reply_text('I\'m only offering and it is your responsibility for this decision.\n'
-							   'Please repeat the password again, so I can check that you remembered it properly')
-		store_msg_id(ctx, msg)
-		return STATE_TYPING_PASSWORD
-	elif text == BTN_PWD_TRYAGAIN:
-		msg = upd.message.reply_text('Send me the password again (and remember it properly!).\n'
-							   'Please check if [CAPS Lock] is off and you are using correct keyboard layout.')
-		store_msg_id(ctx, msg)
-		return STATE_TYPING_PASSWORD
-	elif text == BTN_PWD_STARTOVER:
-		ctx.chat_data.pop('password', None)
-		msg = upd.message.reply_text('That\'s a good idea. Create a new strong password, remember it and send it to me.')
-		store_msg_id(ctx, msg)
-		return STATE_TYPING_PASSWORD
-	elif text == BTN_PWD_NEW:
-		records = dbh.get_records_overview(chat_id)
-		ctx.chat_data['number_of_records'] = len(records)
-		msg = upd.message.reply_text('This will completely destroy all stored information '
-							   '(incl. current password fingerprint and all records) '
-							   'and start over from scratch.\n'
-							   'If you really want to continue send me the following message: \'{0}\''
-							   .format(CONSCIOUS_CONFIRMATION_MSG.format(len(records))))
-		store_msg_id(ctx, msg)
-		return STATE_CHOOSE_PASSWORD_ACTION
-	else:
-		if 'number_of_records' not in ctx.chat_data or ctx.chat_data['number_of_records'] is None:
-			records = dbh.get_records_overview(chat_id)
-			ctx.chat_data['number_of_records'] = len(records)
-		if text == CONSCIOUS_CONFIRMATION_MSG.format(ctx.chat_data['number_of_records']):
-			ndel_chat, ndel_recs = dbh.delete_all(chat_id)
-			if DEFAULT_CLEAR_ON_LOGOUT:
-				clear_history(upd, ctx)
-			update_authorization_timer(upd, ctx, unauthorize=True)
-			ctx.chat_data.clear()
-			msg = upd.message.reply_text('Your data was successfully destroyed! Our database now is by {0} records thinner ;)\n'
-								   'Have a nice day and feel free to come back any time you want.\n'
-								   'Use command /start (or the button below) to start over.'.format(ndel_recs),
-								   reply_markup=ReplyKeyboardMarkup([[BTN_START]], one_time_keyboard=True))
-			store_msg_id(ctx, msg)
-			return STATE_START
-
-# Delete all messages by their ids stored in chat_data['msg_ids'] for current session
+# Handles click on BTN_PWD_LEAVEWEAK: asks to repeat weak password
+@timed('handler')
+def password_leave_weak_clicked(upd, ctx):
+	prompt(upd, ctx, 'I\'m only offering and it is your responsibility for this decision.\n'
+						   'Please repeat the password again, so I can check that you remembered it properly')
+	return STATE_TYPING_PASSWORD
+
+# Handles click on BTN_PWD_TRYAGAIN
+@timed('handler')
+def password_try_again_clicked(upd, ctx):
+	prompt(upd, ctx, 'Send me the password again (and remember it properly!).\n'
+						   'Please check if [CAPS Lock] is off and you are using correct keyboard layout.')
+	return STATE_TYPING_PASSWORD
+
+# Handles click on BTN_PWD_STARTOVER: forgets entered password and asks for new one
+@timed('handler')
+def password_start_over_clicked(upd, ctx):
+	ctx.chat_data.pop('password', None)
+	prompt(upd, ctx, 'That\'s a good idea. Create a new strong password, remember it and send it to me.')
+	return STATE_TYPING_PASSWORD
+
+# Handles click on BTN_PWD_NEW: asks for conscious confirmation of destroying all data
+@timed('handler')
+def password_new_clicked(upd, ctx):
+	ctx.chat_data['number_of_records'] = dbh.count_records(upd.message.chat_id)
+	prompt(upd, ctx, 'This will completely destroy all stored information '
+						   '(incl. current password fingerprint and all records) '
+						   'and start over from scratch.\n'
+						   'If you really want to continue send me the following message: \'{0}\''
+						   .format(CONSCIOUS_CONFIRMATION_MSG.format(ctx.chat_data['number_of_records'])))
+	return STATE_CHOOSE_PASSWORD_ACTION
+
+# Handles any other text in STATE_CHOOSE_PASSWORD_ACTION: destroys all data if it is the conscious confirmation
+@timed('handler')
+def destroy_confirmation_received(upd, ctx):
+	chat_id = upd.message.chat_id
+	if 'number_of_records' not in ctx.chat_data or ctx.chat_data['number_of_records'] is None:
+		ctx.chat_data['number_of_records'] = dbh.count_records(chat_id)
+	if upd.message.text == CONSCIOUS_CONFIRMATION_MSG.format(ctx.chat_data['number_of_records']):
+		ndel_chat, ndel_recs = dbh.delete_all(chat_id)
+		login_limiter.succeeded(chat_id)
+		if DEFAULT_CLEAR_ON_LOGOUT:
+			clear_history(upd, ctx)
+		update_authorization_timer(upd, ctx, unauthorize=True)
+		forget_key(password_key(ctx.chat_data.get('password')))
+		ctx.chat_data.clear()
+		reply(upd, ctx, 'Your data was successfully destroyed! Our database now is by {0} records thinner ;)\n'
+							   'Have a nice day and feel free to come back any time you want.\n'
+							   'Use command /start (or the button below) to start over.'.format(ndel_recs),
+							   reply_markup=ReplyKeyboardMarkup([[BTN_START]], one_time_keyboard=True))
+		return STATE_START
+
+# Drops record being added (unconfirmed data, unfinished upload and label), e.g. if session ends before it is saved,
+# so that none of it is taken for the next record
+def drop_pending_record(ctx):
+	multipart = ctx.chat_data.pop('multipart', None)
+	if multipart is not None:
+		dbh.cancel_upload(multipart['upload'])
+	for key in ('data', 'data_size', 'label'):
+		ctx.chat_data.pop(key, None)
+
+# Delete all messages by their ids stored in chat_data['msg_ids'] for current session (in background)
 def clear_history(upd, ctx):
-	for msg_id in ctx.chat_data['msg_ids']:
-		try: ctx.bot.delete_message(upd.message.chat_id, msg_id)
-		except: pass
-	ctx.chat_data['msg_ids'] = []
+	with msg_ids_lock:
+		msg_ids = list(ctx.chat_data.get('msg_ids') or [])
+		ctx.chat_data['msg_ids'] = MsgIds()
+	cleaner.schedule(ctx.bot, upd.effective_chat.id, msg_ids)
 
 # Logs user out, making him unauthorized
+@timed('handler')
 def logout(upd, ctx):
 	if DEFAULT_CLEAR_ON_LOGOUT:
 		clear_history(upd, ctx)
-	msg = ctx.bot.send_message(upd.message.chat_id,
-						 text='You were successfully logged out!\n'
-							  'Just send me your password whenever you want log in back again.', reply_markup=ReplyKeyboardRemove())
-	store_msg_id(ctx, msg)
+	drop_pending_record(ctx)
+	forget_key(password_key(ctx.chat_data.get('password')))
+	send(ctx, upd.message.chat_id, 'You were successfully logged out!\n'
+								   'Just send me your password whenever you want log in back again.',
+		 priority=PRIORITY_AUTH, reply_markup=ReplyKeyboardRemove())
 	update_authorization_timer(upd, ctx, unauthorize=True)
 	ctx.chat_data['password_mode'] = MODE_PWD_TEST
 	return STATE_TYPING_PASSWORD
 
 # Requests user to enter data
 # TODO: only supports text messages now. Extend!
+@timed('handler')
 def idle_button_clicked(upd, ctx):
 	if upd.message.text == BTN_RECORD:
-		msg = upd.message.reply_text(
-			"Tell me your secret")
-		store_msg_id(ctx, msg)
+		reply(upd, ctx,
+			"Tell me your secret. If it does not fit one message, send it in parts (texts or files)",
+			reply_markup=ReplyKeyboardMarkup([[BTN_RECORD_PARTS]], one_time_keyboard=True))
 		return STATE_TYPING_RECORD
 
-# TODO: handle case when 1 msg is not enough to deliver all data
+# Starts multi-part record: its parts are encrypted chunk by chunk as they arrive and stored as an unfinished upload
+@timed('handler')
+def start_parts(upd, ctx):
+	drop_pending_record(ctx)
+	ctx.chat_data['multipart'] = {'upload': uuid4().hex, 'header': new_stream_header(), 'seq': 0, 'size': 0, 'parts': 0}
+	if upd.message.document is not None:
+		return part_received(upd, ctx)
+	reply(upd, ctx,
+		"Send me the parts one by one and press '{0}' when you are done".format(BTN_FINISH),
+		reply_markup=ReplyKeyboardMarkup([[BTN_FINISH]], one_time_keyboard=True))
+	return STATE_TYPING_PARTS
+
+# Opens file sent by user for reading. urllib.request is imported by the first download rather than at startup
+def open_file(document):
+	import urllib.request
+	return urllib.request.urlopen(document.get_file().file_path, timeout=60)
+
+# Receives one part (text or file) of multi-part record. Only one chunk of it is kept in memory at a time
+@timed('handler')
+def part_received(upd, ctx):
+	multipart = ctx.chat_data['multipart']
+	key = password_key(dbh.get_password(upd.message.chat_id))
+
+	if upd.message.document is not None:
+		stream = open_file(upd.message.document)
+	else:
+		stream = io.BytesIO(upd.message.text.encode())
+	ln = 0
+	with stream:
+		for chunk in split_stream(stream):
+			seq = multipart['seq']
+			dbh.append_chunks(multipart['upload'], seq, encrypt_chunks(key, multipart['header'], seq, [chunk]))
+			multipart['seq'] = seq + 1
+			ln += len(chunk)
+	multipart['size'] += ln
+	multipart['parts'] += 1
+	delete_message(ctx, upd.effective_message)
+
+	reply(upd, ctx,
+		"Part #{0} of length {1} has been successfully encrypted. Send me the next one or press '{2}'".format(
+			multipart['parts'], ln, BTN_FINISH),
+		reply_markup=ReplyKeyboardMarkup([[BTN_FINISH]], one_time_keyboard=True))
+	return STATE_TYPING_PARTS
+
+# Handles /export in STATE_IDLE: sends archive of all records (still encrypted) as a document. Archive is written to
+# a temporary file record by record, which is closed once the outbox has sent it or given up. Its message is not
+# deleted on logout, so that it stays as a backup
+@timed('handler')
+def export_command(upd, ctx):
+	import tempfile
+	chat_id = upd.message.chat_id
+	if still_rekeying(upd, ctx):
+		return STATE_IDLE
+	out = tempfile.TemporaryFile()
+	try:
+		records = archive.export_records(chat_id, dbh.get_password(chat_id), out)
+	except Exception:
+		out.close()
+		raise
+	size = out.tell()
+	if size > ARCHIVE_MAX_SIZE:
+		out.close()
+		reply(upd, ctx, 'Your records take {0} bytes, which is more than I can send back to you '
+						'({1} bytes max). Please delete some of them first.'.format(size, ARCHIVE_MAX_SIZE))
+		return STATE_IDLE
+
+	# Is rewound on every attempt, as the outbox may repeat the call
+	def send_archive():
+		out.seek(0)
+		return ctx.bot.send_document(chat_id, out, filename=ARCHIVE_FILENAME.format(datetime.date.today().isoformat()),
+									 caption='Archive of your {0} records. Send it to me to import them back. If your '
+											 'password changes, I will ask for the one of the archive'.format(records))
+
+	def sent(future):
+		out.close()
+		if future.exception() is not None:
+			reply(upd, ctx, 'The archive could not be sent. Please try /export again later.',
+				  reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
+	outbox.scheduler.call(chat_id, send_archive, idempotent=False).add_done_callback(sent)
+	return STATE_IDLE
+
+# Receives document in STATE_IDLE: imports records from archive made by /export, reading it chunk by chunk.
+# Archive made with another key of records asks for its password first
+@timed('handler')
+def import_received(upd, ctx):
+	document = upd.message.document
+	if document.file_size is not None and document.file_size > ARCHIVE_MAX_SIZE:
+		reply(upd, ctx, 'The file is too large to be an archive of records.')
+		return STATE_IDLE
+	return import_archive(upd, ctx, document)
+
+# Imports records from archive, whose records are encrypted with source_key (None - with current key of the chat)
+def import_archive(upd, ctx, document, source_key=None):
+	chat_id = upd.message.chat_id
+	hash = dbh.get_password(chat_id)
+	try:
+		with open_file(document) as stream:
+			header = archive.read_header(stream)
+			if source_key is None and not archive.made_with(header, hash):
+				ctx.chat_data['archive'] = (document, header)
+				prompt(upd, ctx, 'This archive was made before your password was changed or upgraded. '
+								 'Please send me the password it was made with.')
+				return STATE_TYPING_ARCHIVE_PASSWORD
+			records = archive.import_records(chat_id, password_key(hash), stream, header, source_key)
+	except (ValueError, primitives().InvalidToken, primitives().InvalidTag) as e:
+		reply(upd, ctx, 'Records could not be imported: {0}.'.format(str(e) or 'archive is corrupted'),
+			  reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
+		return STATE_IDLE
+	ctx.chat_data.pop('number_of_records', None)
+	reply(upd, ctx, '{0} records have been successfully imported!'.format(records),
+								 reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
+	return STATE_IDLE
+
+# Receives password of archive and schedules derivation of its key on KDF pool. Import continues in
+# archive_key_derived()
+@timed('handler')
+def archive_password_received(upd, ctx):
+	chat_id = upd.message.chat_id
+	delete_message(ctx, upd.message)
+	pending = ctx.chat_data.pop('archive', None)
+	if pending is None or not upd.message.text:
+		prompt(upd, ctx, 'Please send me the archive again.',
+			   reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
+		return STATE_IDLE
+	document, (_, params, salt, _) = pending
+	future = kdf_pool.pool.submit(chat_id, derive_key, upd.message.text, params, salt)
+	if future is None:
+		prompt(upd, ctx, 'I\'m busy checking passwords at the moment. Please send me the archive again in a few seconds.',
+			   reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
+		return STATE_IDLE
+	if future.done():
+		return archive_key_derived(upd, ctx, future, document)
+	future.add_done_callback(lambda f: continue_async(upd, ctx, archive_key_derived, f, document))
+
+# Imports archive, once key has been derived from its password
+@timed('handler')
+def archive_key_derived(upd, ctx, future, document):
+	try:
+		source_key = future.result()
+	except Exception as e:
+		logger.warning('Deriving key of archive for chat_id=\'{0}\' failed: {1}'.format(upd.message.chat_id, e))
+		reply(upd, ctx, 'Error occured while checking the password. Please send me the archive again later.',
+			  reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
+		return STATE_IDLE
+	return import_archive(upd, ctx, document, source_key)
+
+# Handles click on 'Finish' in STATE_TYPING_PARTS: seals the stream and asks for confirmation
+@timed('handler')
+def finish_parts(upd, ctx):
+	multipart = ctx.chat_data['multipart']
+	key = password_key(dbh.get_password(upd.message.chat_id))
+	seq = multipart['seq']
+	dbh.append_chunks(multipart['upload'], seq, encrypt_chunks(key, multipart['header'], seq, [b''], last=True), last=True)
+	multipart['seq'] = seq + 1
+
+	reply(upd, ctx,
+		"Your secret of {0} parts and total length {1} has been successfully encrypted. Do you want to store it?".format(
+			multipart['parts'], multipart['size']),
+		reply_markup=ReplyKeyboardMarkup(markup_confirm, one_time_keyboard=True))
+	return STATE_CONFIRMING_RECORD
+
 # Receives message, encrypts and stores into DB
+@timed('handler')
 def encrypt_data(upd, ctx):
-	key = dbh.get_password(upd.message.chat_id)
-	ln = len(upd.message.text)
-	encrypted = encrypt_string(upd.message.text, key)
-	upd.effective_message.delete()
+	drop_pending_record(ctx)
+	key = password_key(dbh.get_password(upd.message.chat_id))
+	data = upd.message.text.encode()
+	ln = len(data)
+	encrypted = seal_record(data, key)
+	delete_message(ctx, upd.effective_message)
 
 	ctx.chat_data['data'] = encrypted
+	ctx.chat_data['data_size'] = ln
 
-	msg = upd.message.reply_text(
+	reply(upd, ctx,
 		"Your message of length {0} has been successfully encrypted. Do you want to store it?".format(ln),
+		reply_markup=ReplyKeyboardMarkup(markup_confirm, one_time_keyboard=True))
+	return STATE_CONFIRMING_RECORD
+
+# Handles click on 'Add label' in STATE_CONFIRMING_RECORD: asks for label of the record
+@timed('handler')
+def label_clicked(upd, ctx):
+	reply(upd, ctx,
+		'Send me a label of your secret (up to {0} characters). It is stored encrypted, '
+		'but you will be able to find the record by its words with /search'.format(LABEL_MAX_LENGTH),
+		reply_markup=ReplyKeyboardRemove())
+	return STATE_TYPING_LABEL
+
+# Receives label of the record being added, encrypts it together with index tokens of its words
+@timed('handler')
+def label_received(upd, ctx):
+	label = upd.message.text
+	delete_message(ctx, upd.effective_message)
+	if len(label) > LABEL_MAX_LENGTH:
+		reply(upd, ctx, 'The label is too long ({0} characters max). Please send a shorter one.'.format(LABEL_MAX_LENGTH))
+		return STATE_TYPING_LABEL
+
+	ctx.chat_data['label'] = seal_label(label, password_key(dbh.get_password(upd.message.chat_id)))
+	reply(upd, ctx,
+		'The label has been successfully encrypted. Do you want to store the record?',
 		reply_markup=ReplyKeyboardMarkup([[BTN_RECORD_SAVE, BTN_RECORD_CANCEL]], one_time_keyboard=True))
-	store_msg_id(ctx, msg)
 	return STATE_CONFIRMING_RECORD
 
-# Handles user confirmation for storing created record
+# Handles user confirmation for storing created record. Bot confirms once DB acknowledged it in record_saved()
+@timed('handler')
 def confirm_adding_record(upd, ctx):
+	if 'multipart' in ctx.chat_data:
+		multipart = ctx.chat_data.pop('multipart')
+		rec = dbh.finish_upload(upd.message.chat_id, multipart['upload'], multipart['header'], multipart['size'],
+								ctx.chat_data.pop('label', None))
+		future = Future()
+		future.set_result(rec)
+		return record_saved(upd, ctx, future, multipart['size'])
+
 	# Should never be true due to code consistency
 	if 'data' not in ctx.chat_data or ctx.chat_data['data'] is None:
 		logger.warning('No data found in context for \'chat_id\'={}! Continuing without storing data!'.format(upd.message.chat_id))
-		msg = upd.message.reply_text(
+		reply(upd, ctx,
 			"Error occured while saving your data. This case is already reported. Please try again later",
 			reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
-		store_msg_id(ctx, msg)
+		return STATE_IDLE
+
+	# Taken out of context at once, so that repeated click cannot save it twice
+	data = ctx.chat_data.pop('data')
+	ln = ctx.chat_data.pop('data_size', len(data))
+	future = dbh.create_record_async(upd.message.chat_id, data, ln, ctx.chat_data.pop('label', None))
 
-	rec = dbh.create_record(upd.message.chat_id, ctx.chat_data['data'])
+	if future.done():
+		return record_saved(upd, ctx, future, ln)
+	future.add_done_callback(lambda f: continue_async(upd, ctx, record_saved, f, ln))
+
+# Reports result of saving the record of given length
+@timed('handler')
+def record_saved(upd, ctx, future, ln):
+	try:
+		rec = future.result()
+	except Exception as e:
+		logger.warning('Saving record for chat_id=\'{0}\' failed: {1}'.format(upd.message.chat_id, e))
+		rec = 0
 
 	if rec != 1:
 		logger.warning(
-			'Could not save record to database. chat_id=\'{0}\', data=\'{1}\''.format(upd.message.chat_id, ctx.chat_data['data']))
-		msg = upd.message.reply_text(
+			'Could not save record to database. chat_id=\'{0}\', length=\'{1}\''.format(upd.message.chat_id, ln))
+		reply(upd, ctx,
 			"Error occured while saving your data. This case is already reported. Please try again later",
 			reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
-		store_msg_id(ctx, msg)
 		return STATE_IDLE
 
-	ln = len(ctx.chat_data['data'])
-	ctx.chat_data.pop('data', None)
-	msg = upd.message.reply_text(
+	reply(upd, ctx,
 		"Your message of length {0} has been successfully saved".format(ln),
 		reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
-	store_msg_id(ctx, msg)
 	return STATE_IDLE
 
 # Handles user cancellation for storing created record
+@timed('handler')
 def cancel_adding_record(upd, ctx):
-	ln = len(ctx.chat_data['data'])
-	ctx.chat_data.pop('data', None)
-	msg = upd.message.reply_text(
+	if 'multipart' in ctx.chat_data:
+		multipart = ctx.chat_data.pop('multipart')
+		dbh.cancel_upload(multipart['upload'])
+		ln = multipart['size']
+	else:
+		ln = ctx.chat_data.pop('data_size', None)
+		ctx.chat_data.pop('data', None)
+	ctx.chat_data.pop('label', None)
+	reply(upd, ctx,
 		"Your message of length {0} has been successfully deleted.".format(ln),
 		reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
-	store_msg_id(ctx, msg)
 	return STATE_IDLE
 
+# Handles /search in STATE_IDLE: finds records whose labels contain all given words by their index tokens
+# and decrypts labels of found records only
+@timed('handler')
+def search_command(upd, ctx):
+	chat_id = upd.message.chat_id
+	words = label_words(' '.join(ctx.args or []))
+	delete_message(ctx, upd.effective_message)
+	if len(words) == 0:
+		reply(upd, ctx, 'Tell me what to look for, e.g. /search bank card')
+		return STATE_IDLE
+
+	if still_rekeying(upd, ctx):
+		return STATE_IDLE
+	key = password_key(dbh.get_password(chat_id))
+	records = dbh.search_records(chat_id, label_tokens(words, key))
+	if len(records) == 0:
+		text = 'No records with such label found.'
+	else:
+		text = 'Found records:\n[uid] datetime {length} label'
+		for r, label in zip(records, open_labels([r['label'] for r in records], key)):
+			text += '\n[{0}] {1} {{{2}}} {3}'.format(r['uid'], timestamp_format(r['timestamp']), r['size'], label)
+	reply(upd, ctx, text, reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
+	return STATE_IDLE
+
+# Renders page of records overview described by ctx.chat_data['browse'] into message text and inline keyboard
+def browse_view(records, browse):
+	first = browse['offset']
+	msg_list = '[index] datetime {length}'
+	for i, r in enumerate(records):
+		msg_list += '\n[{0}] {1} {{{2}}}'.format(
+			first + i,
+			timestamp_format(r['timestamp']),
+			r['size'])
+
+	keyboard = [[InlineKeyboardButton(BTN_BROWSE_BACK, callback_data=CB_BROWSE_BACK)]]
+	nav = []
+	if first > 0:
+		nav.append(InlineKeyboardButton(BTN_BROWSE_PREV, callback_data=CB_BROWSE_PREV))
+	if first + len(records) < browse['total']:
+		nav.append(InlineKeyboardButton(BTN_BROWSE_NEXT, callback_data=CB_BROWSE_NEXT))
+	if len(nav) > 0:
+		keyboard.insert(0, nav)
+	markup = InlineKeyboardMarkup(keyboard)
+
+	text = "Last {0}-{1}/{2} records are:\n{3}".format(
+		first,
+		first + len(records) - 1,
+		browse['total'],
+		msg_list)
+	return text, markup
+
+# Remembers keyset cursors of the shown page, so neighbour pages can be fetched with an indexed range scan
+def browse_remember(records, browse):
+	browse['first'] = (records[0]['timestamp'], records[0]['uid'])
+	browse['last'] = (records[-1]['timestamp'], records[-1]['uid'])
+
 # Handles click on button 'Browse' from STATE_IDLE
+@timed('handler')
 def browse_records(upd, ctx):
 	chat_id = upd.message.chat_id
 
-	records = dbh.get_records_overview(chat_id)
+	total = dbh.count_records(chat_id)
+	records = dbh.get_records_page(chat_id, limit=BROWSE_PAGE_LIMIT) if total > 0 else []
 
 	# Should probably never happen ;)
 	if records == None:
-		msg = upd.message.reply_text(
+		reply(upd, ctx,
 			"Some error happend while trying to retrieve your data. This case has already been reported. Try again later",
 			reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
-		store_msg_id(ctx, msg)
 		return STATE_IDLE
 	# If no data found in DB
 	elif len(records) == 0:
-		msg = upd.message.reply_text(
+		reply(upd, ctx,
 			"You don't have any records yet. Use menu buttons to add new.",
 			reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
-		store_msg_id(ctx, msg)
 		return STATE_IDLE
 
-	# If data has been found
-	ctx.chat_data['data_overview'] = records
+	# If data has been found, keep only the cursors of shown page
+	browse = {'offset': 0, 'total': total}
+	browse_remember(records, browse)
+	ctx.chat_data['browse'] = browse
 
-	if 'browse_page' not in ctx.chat_data or ctx.chat_data['browse_page'] is None:
-		ctx.chat_data['browse_page'] = 0
-	page = ctx.chat_data['browse_page']
+	text, markup = browse_view(records, browse)
+	reply(upd, ctx, text, reply_markup=markup)
+	return STATE_BROWSING
 
-	msg_list = '[index] datetime {length}'
-	i = 0
-	for r in records:
-		if i >= BROWSE_PAGE_LIMIT:
-			break
-		msg_list += '\n[{0}] {1} {{2}}'.format(
-			i,
-			timestamp_format(records[i]['timestamp']),
-			records[i]['size'])
-		i += 1
-
-	keyboard = []
-	if page * BROWSE_PAGE_LIMIT < len(records):
-		keyboard = [[InlineKeyboardButton(BTN_BROWSE_NEXT, callback_data=str(1))]]
-	if page > 0:
-		keyboard.insert(0, [InlineKeyboardButton(BTN_BROWSE_PREV, callback_data=str(2))])
-	btnBack = InlineKeyboardButton(BTN_BROWSE_BACK, callback_data=str(3))
-	if len(keyboard) > 0:
-		keyboard.insert(1, [btnBack])
+# Handles clicks on inline buttons 'Next'/'Previous' in STATE_BROWSING
+@timed('handler')
+def browse_page_clicked(upd, ctx):
+	query = upd.callback_query
+	outbox.scheduler.call(query.message.chat_id, query.answer, priority=PRIORITY_AUTH, per_chat=False)
+	chat_id = query.message.chat_id
+
+	browse = ctx.chat_data.get('browse')
+	if browse is None:
+		return STATE_BROWSING
+
+	browse['total'] = dbh.count_records(chat_id)
+	if query.data == CB_BROWSE_NEXT:
+		records = dbh.get_records_page(chat_id, after=browse['last'], limit=BROWSE_PAGE_LIMIT)
+		offset = browse['offset'] + BROWSE_PAGE_LIMIT
 	else:
-		keyboard = [[btnBack]]
-
-	markup = InlineKeyboardMarkup(keyboard)
-
-	msg = upd.message.reply_text(
-		"Last {0}-{1}/{2} records are:\n{3}".format(
-			page * BROWSE_PAGE_LIMIT,
-			min(len(records), BROWSE_PAGE_LIMIT),
-			len(records),
-			msg_list),
-		reply_markup=markup)
-	store_msg_id(ctx, msg)
+		records = dbh.get_records_page(chat_id, before=browse['first'], limit=BROWSE_PAGE_LIMIT)
+		offset = max(browse['offset'] - BROWSE_PAGE_LIMIT, 0)
+		# Records may have been added meanwhile, then newest page is the one we are at
+		if len(records) < BROWSE_PAGE_LIMIT:
+			records = dbh.get_records_page(chat_id, limit=BROWSE_PAGE_LIMIT)
+			offset = 0
+
+	if not records:
+		return STATE_BROWSING
+
+	browse['offset'] = offset
+	browse_remember(records, browse)
+	text, markup = browse_view(records, browse)
+	# Quick clicks through pages are coalesced into one edit showing the last page
+	outbox.scheduler.edit(ctx.bot, chat_id, query.message.message_id, text, reply_markup=markup)
 	return STATE_BROWSING
 
+# Handles click on inline button 'Back' in STATE_BROWSING
+@timed('handler')
+def browse_back_clicked(upd, ctx):
+	query = upd.callback_query
+	outbox.scheduler.call(query.message.chat_id, query.answer, priority=PRIORITY_AUTH, per_chat=False)
+	ctx.chat_data.pop('browse', None)
+	send(ctx, query.message.chat_id, 'Use menu buttons to securely store your secrets',
+							   reply_markup=ReplyKeyboardMarkup(markup_idle, one_time_keyboard=True))
+	return STATE_IDLE
+
 def error(update, context):
 	"""Log Errors caused by Updates."""
 	logger.warning('Update "%s" caused error "%s"', update, context.error)
 
-def main():
+# Registers all handlers of the bot in given dispatcher. Conversation states are persisted if dispatcher has persistence
+def register_handlers(dp):
 	global conv_handler
 
-	updater = Updater(TOKEN, use_context=True)
-	dp = updater.dispatcher
-
 	# Handler for every signal checks: leave groups and check authorization
 	dp.add_handler(MessageHandler(Filters.all, every_signal_checks), group=0)
+	# Conversation states: buttons (text of reply keyboard button or callback data of inline one -> handler),
+	# handler of any other text and handlers of other messages. Buttons are routed by a dict lookup
+	table = {
+		STATE_START:					({BTN_START: start}, None, [CommandHandler('start', start)]),
+		STATE_TYPING_PASSWORD:			({}, None, [MessageHandler(Filters.all, received_password)]),
+		STATE_CHOOSE_PASSWORD_ACTION:	({
+											BTN_PWD_STRONGER: password_stronger_clicked,
+											BTN_PWD_LEAVEWEAK: password_leave_weak_clicked,
+											BTN_PWD_TRYAGAIN: password_try_again_clicked,
+											BTN_PWD_STARTOVER: password_start_over_clicked,
+											BTN_PWD_NEW: password_new_clicked,
+										}, destroy_confirmation_received, []),
+		STATE_IDLE:						({
+											BTN_RECORD: idle_button_clicked,
+											BTN_BROWSE: browse_records,
+											BTN_LOGOUT: logout,
+										}, None, [CommandHandler('export', export_command),
+												  CommandHandler('search', search_command),
+												  MessageHandler(Filters.document, import_received)]),
+		STATE_TYPING_RECORD:			({BTN_RECORD_PARTS: start_parts}, encrypt_data,
+										 [MessageHandler(Filters.document, start_parts)]),
+		STATE_TYPING_PARTS:				({BTN_FINISH: finish_parts}, part_received,
+										 [MessageHandler(Filters.document, part_received)]),
+		STATE_CONFIRMING_RECORD:		({
+											BTN_RECORD_SAVE: confirm_adding_record,
+											BTN_RECORD_CANCEL: cancel_adding_record,
+											BTN_RECORD_LABEL: label_clicked,
+										}, None, []),
+		STATE_TYPING_LABEL:				({}, label_received, []),
+		STATE_TYPING_ARCHIVE_PASSWORD:	({}, archive_password_received, []),
+		STATE_BROWSING:					({
+											CB_BROWSE_NEXT: browse_page_clicked,
+											CB_BROWSE_PREV: browse_page_clicked,
+											CB_BROWSE_BACK: browse_back_clicked,
+										}, None, []),
+	}
+	states = {state: ([ButtonRouter(routes, fallback)] if routes or fallback else []) + handlers
+			  for state, (routes, fallback, handlers) in table.items()}
+
 	# Main conversation handler
 	conv_handler = ConversationHandler(
 		# Entry point
@@ -445,51 +940,127 @@ def main():
 			MessageHandler(Filters.all, received_password)
 		],
 
-		states={
-			STATE_START: [
-				CommandHandler('start', start),
-				MessageHandler(Filters.regex('^{}$'.format(BTN_START)), start)
-			],
-			STATE_TYPING_PASSWORD: [
-				MessageHandler(Filters.all, received_password)
-			],
-			STATE_CHOOSE_PASSWORD_ACTION: [
-				MessageHandler(Filters.text, password_btn_clicked)
-			],
-			STATE_IDLE: [
-				MessageHandler(Filters.regex('^{0}$'.format(BTN_RECORD)), idle_button_clicked),
-				MessageHandler(Filters.regex('^{0}$'.format(BTN_LOGOUT)), logout),
-				MessageHandler(Filters.regex('^{0}$'.format(BTN_BROWSE)), browse_records)
-			],
-			STATE_TYPING_RECORD: [
-				MessageHandler(Filters.text, encrypt_data)
-			],
-			STATE_CONFIRMING_RECORD: [
-				MessageHandler(Filters.regex('^{0}$'.format(BTN_RECORD_SAVE)), confirm_adding_record),
-				MessageHandler(Filters.regex('^{0}$'.format(BTN_RECORD_CANCEL)), cancel_adding_record)
-			],
-			STATE_BROWSING: [
-				CallbackQueryHandler(browse_records, pattern='^{0}$'.format(BTN_BROWSE_NEXT))
-			]
-		},
+		states=states,
 
 		fallbacks=[
 			# MessageHandler(Filters.regex('^Done$'), done)
-		]
+		],
+
+		name='main',
+		persistent=dp.persistence is not None
 	)
 
 	dp.add_handler(conv_handler, group=1)
 
 	# log all errors
 	dp.add_error_handler(error)
+	return conv_handler
+
+# Creates updater of the bot with all handlers and periodic jobs (DB must be initialized already)
+def build_updater(metrics_port=METRICS_PORT):
+	# Bot API calls are counted by instrumented request (pool size as Updater would create for its 4 workers)
+	bot = Bot(TOKEN, request=metrics.instrumented_request(con_pool_size=8)) if METRICS_ENABLED else None
+	updater = Updater(None if bot else TOKEN, bot=bot, use_context=True,
+					  persistence=SqlitePersistence() if PERSISTENCE_ENABLED else None)
+	register_handlers(updater.dispatcher)
+
+	if METRICS_ENABLED:
+		metrics.instrument_db(dbh.db)
+		if metrics_port is not None:
+			metrics.serve(metrics_port)
+		if METRICS_LOG_INTERVAL > 0:
+			updater.job_queue.run_repeating(metrics.log_snapshot, interval=METRICS_LOG_INTERVAL, first=METRICS_LOG_INTERVAL)
+
+	# Single periodic sweep of inactivity deadlines instead of one job per chat
+	updater.job_queue.run_repeating(sweep_inactive, interval=SESSION_WHEEL_TICK, first=SESSION_WHEEL_TICK)
+	updater.job_queue.run_repeating(prune_login_attempts, interval=LOGIN_PRUNE_INTERVAL, first=LOGIN_PRUNE_INTERVAL)
+	if PERSISTENCE_ENABLED:
+		updater.job_queue.run_repeating(flush_state, interval=PERSISTENCE_FLUSH_INTERVAL, first=PERSISTENCE_FLUSH_INTERVAL)
+	return updater
+
+# Chooses cost of new password-hashes (see crypto.calibrate) and logs it
+def calibrate_kdf():
+	logger.info('Parameters of new password-hashes: {0}'.format(calibrate()))
+
+# Reports how long a cold start takes: imports of main, opening of a new and of an existing database, calibration of
+# KDF and building of the bot, and latency of the first updates handled by a bot answering Bot API calls locally
+# (see load_test.py) in a temporary database. Nothing is sent to Telegram. Passwords are hashed with cheap parameters
+# and inline, as in the load test, so that first-use costs are not hidden by hashing
+def profile_startup():
+	import os, shutil, queue, tempfile
+	from telegram.ext import Dispatcher
+	# load_test imports main, which is this module when it runs as a script
+	sys.modules.setdefault('main', sys.modules[__name__])
+	import load_test
+
+	def measure(fn, *args):
+		start = time.perf_counter()
+		fn(*args)
+		return time.perf_counter() - start
+
+	directory = tempfile.mkdtemp()
+	path = os.path.join(directory, 'startup.db')
+	results = [('imports of main', _imported - _started),
+			   ('new database', measure(dbh.init, path)),
+			   ('existing database', measure(dbh.init, path))]
+	if KDF_CALIBRATE:
+		results.append(('KDF calibration', measure(calibrate)))
+	results.append(('build bot', measure(build_updater, None)))
+
+	set_kdf_params(make_kdf_params(KDF_PBKDF2, i=load_test.KDF_ITERATIONS))
+	kdf_pool.pool = kdf_pool.KdfPool(kind='inline')
+	outbox.scheduler = outbox.Outbox(rate=None, chat_rate=None)
+	bot = load_test.FakeBot()
+	dp = Dispatcher(bot, queue.Queue(), use_context=True)
+	register_handlers(dp)
+	updates = list(load_test.User(bot, 1).session())
+	results.append(('first update', measure(dp.process_update, updates[0])))
+	results.append(('first reply sent', measure(outbox.scheduler.join)))
+	results.append(('rest of 1st session', sum(measure(dp.process_update, update) for update in updates[1:])))
+	results.append(('2nd session', sum(measure(dp.process_update, update) for update in load_test.User(bot, 2).session())))
+	outbox.scheduler.join()
+
+	print('startup, {0} updates per session:'.format(len(updates)))
+	for name, seconds in results:
+		print('  {0:<22}{1:>10.1f} ms'.format(name, seconds * 1e3))
+	dbh.record_batcher.flush()
+	kdf_pool.pool.shutdown()
+	dbh.close()
+	shutil.rmtree(directory)
+
+def main():
+	if '--profile-startup' in sys.argv[1:]:
+		profile_startup()
+		return
 
-	# Start the Bot
-	updater.start_polling()
+	# Front process of sharded mode has no database and no handlers, its worker processes run the bot
+	if RUNTIME_MODE == 'sharded':
+		import sharding
+		sharding.run()
+		return
 
-	# Run the bot until you press Ctrl-C or the process receives SIGINT,
-	# SIGTERM or SIGABRT. This should be used most of the time, since
-	# start_polling() is non-blocking and will stop the bot gracefully.
-	updater.idle()
+	dbh.init()
+	if KDF_CALIBRATE:
+		# Not awaited, so that a restart does not wait for it: passwords hashed meanwhile get the configured cost
+		threading.Thread(target=calibrate_kdf, name='calibration', daemon=True).start()
+	updater = build_updater()
+
+	if RUNTIME_MODE == 'webhook':
+		import webhook
+		webhook.run(updater)
+	else:
+		# Start the Bot
+		updater.start_polling()
+
+		# Run the bot until you press Ctrl-C or the process receives SIGINT,
+		# SIGTERM or SIGABRT. This should be used most of the time, since
+		# start_polling() is non-blocking and will stop the bot gracefully.
+		updater.idle()
+
+	if not outbox.scheduler.join(OUTBOX_DRAIN_TIMEOUT):
+		logger.warning('{0} Bot API calls were not made before shutdown'.format(outbox.scheduler.pending()))
+	dbh.record_batcher.flush()
+	kdf_pool.pool.shutdown()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,192 @@
+import functools, logging, threading, time
+
+from constants import *
+
+logger = logging.getLogger(__name__)
+
+# Lightweight metrics of the bot: latency of handlers, DB queries, crypto calls and Bot API calls.
+# Everything is instrumented at import/startup time only if METRICS_ENABLED, otherwise decorators return functions
+# as they are and nothing is hooked, so disabled metrics cost nothing at runtime.
+# Metrics are exported as Prometheus text (METRICS_PORT) and/or logged periodically (METRICS_LOG_INTERVAL)
+
+PREFIX = 'securestore_'
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5.)	# upper bounds of latency histograms, seconds
+
+def _key(name, labels):
+	return name, tuple(sorted(labels.items()))
+
+def _format_labels(labels, extra=()):
+	labels = list(labels) + list(extra)
+	if len(labels) == 0:
+		return ''
+	return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + '}'
+
+# Thread-safe storage of counters and latency histograms, by name and labels
+class Registry:
+	def __init__(self, buckets=BUCKETS):
+		self.buckets = buckets
+		self._lock = threading.Lock()
+		self._counters = {}		# (name, labels) -> value
+		self._timers = {}		# (name, labels) -> [count, sum, count per bucket...]
+
+	def inc(self, name, value=1, **labels):
+		key = _key(name, labels)
+		with self._lock:
+			self._counters[key] = self._counters.get(key, 0) + value
+
+	def observe(self, name, seconds, **labels):
+		key = _key(name, labels)
+		with self._lock:
+			timer = self._timers.get(key)
+			if timer is None:
+				timer = self._timers[key] = [0, 0.] + [0] * len(self.buckets)
+			timer[0] += 1
+			timer[1] += seconds
+			for i, bound in enumerate(self.buckets):
+				if seconds <= bound:
+					timer[2 + i] += 1
+					break
+
+	# Returns copies of counters and timers
+	def snapshot(self):
+		with self._lock:
+			return dict(self._counters), {key: list(timer) for key, timer in self._timers.items()}
+
+	def clear(self):
+		with self._lock:
+			self._counters.clear()
+			self._timers.clear()
+
+	# Renders metrics in Prometheus text exposition format
+	def render(self):
+		counters, timers = self.snapshot()
+		lines = []
+		for name in sorted(set(name for name, _ in counters)):
+			lines.append('# TYPE {0}{1}_total counter'.format(PREFIX, name))
+			for (n, labels), value in sorted(counters.items()):
+				if n == name:
+					lines.append('{0}{1}_total{2} {3}'.format(PREFIX, name, _format_labels(labels), value))
+		for name in sorted(set(name for name, _ in timers)):
+			lines.append('# TYPE {0}{1}_seconds histogram'.format(PREFIX, name))
+			for (n, labels), timer in sorted(timers.items()):
+				if n != name:
+					continue
+				cumulative = 0
+				for bound, count in zip(self.buckets, timer[2:]):
+					cumulative += count
+					lines.append('{0}{1}_seconds_bucket{2} {3}'.format(
+						PREFIX, name, _format_labels(labels, [('le', bound)]), cumulative))
+				lines.append('{0}{1}_seconds_bucket{2} {3}'.format(
+					PREFIX, name, _format_labels(labels, [('le', '+Inf')]), timer[0]))
+				lines.append('{0}{1}_seconds_sum{2} {3:.6f}'.format(PREFIX, name, _format_labels(labels), timer[1]))
+				lines.append('{0}{1}_seconds_count{2} {3}'.format(PREFIX, name, _format_labels(labels), timer[0]))
+		return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+# Increments counter if metrics are enabled, e.g. to count decisions of some component
+def count(name, value=1, **labels):
+	if METRICS_ENABLED:
+		registry.inc(name, value, **labels)
+
+# Decorator measuring latency (and counting exceptions) of the function, labeled by its name
+def timed(name, enabled=None):
+	def decorator(fn):
+		if not (METRICS_ENABLED if enabled is None else enabled):
+			return fn
+
+		@functools.wraps(fn)
+		def wrapper(*args, **kwargs):
+			start = time.perf_counter()
+			try:
+				return fn(*args, **kwargs)
+			except Exception:
+				registry.inc(name + '_errors', fn=fn.__name__)
+				raise
+			finally:
+				registry.observe(name, time.perf_counter() - start, fn=fn.__name__)
+		return wrapper
+	return decorator
+
+# Hooks statement execution of given peewee database: counts and times queries by their kind (SELECT, INSERT, ...)
+def instrument_db(db):
+	execute_sql = db.execute_sql
+
+	def timed_execute_sql(sql, params=None, *args, **kwargs):
+		start = time.perf_counter()
+		try:
+			return execute_sql(sql, params, *args, **kwargs)
+		finally:
+			registry.observe('db_query', time.perf_counter() - start, statement=sql.split(None, 1)[0].upper())
+	db.execute_sql = timed_execute_sql
+
+# Returns Request of Bot API counting and timing calls by API method and outcome. The class is made on first use,
+# so that modules timing their functions (crypto, db_handler, ...) do not import telegram
+def instrumented_request(**kwargs):
+	global _InstrumentedRequest
+	if _InstrumentedRequest is None:
+		from telegram.error import TelegramError
+		from telegram.utils.request import Request
+
+		class InstrumentedRequest(Request):
+			def _call(self, fn, url, *args, **kwargs):
+				method = url.rsplit('/', 1)[-1]
+				outcome = 'ok'
+				start = time.perf_counter()
+				try:
+					return fn(url, *args, **kwargs)
+				except TelegramError as e:
+					outcome = type(e).__name__
+					raise
+				finally:
+					registry.observe('bot_api', time.perf_counter() - start, method=method)
+					registry.inc('bot_api_calls', method=method, outcome=outcome)
+
+			def post(self, url, data, timeout=None):
+				return self._call(super().post, url, data, timeout=timeout)
+
+			def get(self, url, timeout=None):
+				return self._call(super().get, url, timeout=timeout)
+		_InstrumentedRequest = InstrumentedRequest
+	return _InstrumentedRequest(**kwargs)
+
+_InstrumentedRequest = None
+
+# Serves GET /metrics at given port in a background thread. Returns the server
+def serve(port=METRICS_PORT, host=METRICS_HOST):
+	from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+	class MetricsHandler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			if self.path != '/metrics':
+				self.send_response(404)
+				self.send_header('Content-Length', '0')
+				self.end_headers()
+				return
+			body = registry.render().encode()
+			self.send_response(200)
+			self.send_header('Content-Type', 'text/plain; version=0.0.4')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			pass
+
+	httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+	httpd.daemon_threads = True
+	threading.Thread(target=httpd.serve_forever, name='metrics', daemon=True).start()
+	logger.info('Serving metrics at port {0}'.format(httpd.server_address[1]))
+	return httpd
+
+# Periodic job: logs count, average and total time of every timer and values of counters
+def log_snapshot(job_ctx=None):
+	counters, timers = registry.snapshot()
+	lines = []
+	for (name, labels), timer in sorted(timers.items()):
+		lines.append('{0}{1}: {2} calls, avg {3:.2f} ms, total {4:.1f} s'.format(
+			name, _format_labels(labels), timer[0], timer[1] / timer[0] * 1e3, timer[1]))
+	for (name, labels), value in sorted(counters.items()):
+		lines.append('{0}{1}: {2}'.format(name, _format_labels(labels), value))
+	if lines:
+		logger.info('Metrics:\n  ' + '\n  '.join(lines))
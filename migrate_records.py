@@ -0,0 +1,44 @@
+# Migrates single-part records of version 1 (base64 Fernet token of text in Record.data) to RECORD_VERSION
+# (compressed plaintext, raw ciphertext in Record.payload). Rows are converted batch by batch, one transaction each,
+# so migration can be interrupted and started again at any time.
+# Usage: python migrate_records.py [path to database]
+import sys, logging
+
+import db_handler as dbh
+from db_handler import Chat, Record
+from crypto import open_record, seal_record, password_key
+from constants import DB_PATH, RECORD_VERSION
+
+logger = logging.getLogger(__name__)
+
+BATCH = 500
+
+# Returns tuple (number of migrated records, number of records which could not be decrypted)
+def migrate(batch=BATCH):
+	migrated, failed = 0, 0
+	last = 0
+	while True:
+		rows = list(Record.select(Record.id, Record.data, Chat.password).join(Chat)
+					.where((Record.version == 1) & (Record.id > last) & Record.data.is_null(False))
+					.order_by(Record.id).limit(batch).tuples())
+		if len(rows) == 0:
+			break
+
+		with dbh.db.atomic():
+			for uid, data, pwd in rows:
+				key = password_key(pwd)
+				try:
+					plain = open_record(1, data, None, key)
+				except Exception as e:
+					logger.warning('Record uid=\'{0}\' could not be decrypted and stays in version 1: {1}'.format(uid, e))
+					failed += 1
+					continue
+				Record.update(payload=seal_record(plain, key), data=None, data_size=len(plain), version=RECORD_VERSION) \
+					.where(Record.id == uid).execute()
+				migrated += 1
+		last = rows[-1][0]
+	return migrated, failed
+
+if __name__ == '__main__':
+	dbh.init(sys.argv[1] if len(sys.argv) > 1 else DB_PATH)
+	print('Migrated: {0}, failed: {1}'.format(*migrate()))
@@ -0,0 +1,92 @@
+from array import array
+
+from constants import MSG_IDS_CAP
+
+# Compact list of message ids of a session. Ids of one chat are mostly consecutive, so they are kept as runs
+# (start, length) in two arrays of int64, which costs 16 bytes per run instead of a Python int per id.
+# At most cap ids are kept, the oldest ones are evicted first
+class MsgIds:
+	__slots__ = ('cap', '_starts', '_lengths', '_head', '_count')
+
+	# Called with change of nbytes() on every resize of storage, if set (e.g. to account memory of all sessions)
+	accounting = None
+
+	def __init__(self, ids=(), cap=MSG_IDS_CAP):
+		self.cap = cap
+		self._starts = array('q')
+		self._lengths = array('q')
+		self._head = 0		# index of the oldest run, runs before it are already evicted
+		self._count = 0
+		for msg_id in ids:
+			self.append(msg_id)
+
+	def __len__(self):
+		return self._count
+
+	def __iter__(self):
+		for i in range(self._head, len(self._starts)):
+			start = self._starts[i]
+			for msg_id in range(start, start + self._lengths[i]):
+				yield msg_id
+
+	def __repr__(self):
+		return 'MsgIds({0} ids in {1} runs)'.format(self._count, len(self._starts) - self._head)
+
+	# Returns amount of bytes occupied by the arrays
+	def nbytes(self):
+		return (self._starts.buffer_info()[1] + self._lengths.buffer_info()[1]) * self._starts.itemsize
+
+	def append(self, msg_id):
+		if len(self._starts) > self._head and self._starts[-1] + self._lengths[-1] == msg_id:
+			self._lengths[-1] += 1
+		else:
+			self._starts.append(msg_id)
+			self._lengths.append(1)
+			self._account(self._starts.itemsize * 2)
+		self._count += 1
+		while self._count > self.cap:
+			self._evict()
+
+	# Drops the oldest id
+	def _evict(self):
+		head = self._head
+		self._starts[head] += 1
+		self._lengths[head] -= 1
+		self._count -= 1
+		if self._lengths[head] == 0:
+			self._head += 1
+			# Compact arrays once evicted runs make up their half
+			if self._head * 2 >= len(self._starts):
+				before = self.nbytes()
+				del self._starts[:self._head]
+				del self._lengths[:self._head]
+				self._head = 0
+				self._account(self.nbytes() - before)
+
+	def clear(self):
+		before = self.nbytes()
+		self._starts = array('q')
+		self._lengths = array('q')
+		self._head = 0
+		self._count = 0
+		self._account(-before)
+
+	# Returns list of runs [start, length], e.g. to serialize
+	def runs(self):
+		return [[self._starts[i], self._lengths[i]] for i in range(self._head, len(self._starts))]
+
+	@classmethod
+	def from_runs(cls, runs, cap=MSG_IDS_CAP):
+		ids = cls(cap=cap)
+		for start, length in runs:
+			ids._starts.append(start)
+			ids._lengths.append(length)
+			ids._count += length
+		ids._account(ids.nbytes())
+		while ids._count > ids.cap:
+			ids._evict()
+		return ids
+
+	def _account(self, delta):
+		if MsgIds.accounting is not None and delta != 0:
+			MsgIds.accounting(delta)
@@ -0,0 +1,278 @@
+import collections, logging, threading, time
+from concurrent.futures import Future
+
+from telegram.error import RetryAfter, TimedOut, NetworkError, BadRequest
+
+import metrics
+from constants import *
+
+logger = logging.getLogger(__name__)
+
+# Outgoing queue of Bot API calls, so that handlers do not wait for HTTP and the bot stays within flood limits.
+# Calls are made by OUTBOX_WORKERS threads as tokens of the global bucket (OUTBOX_RATE) and of the chat's bucket
+# (OUTBOX_CHAT_RATE, messages only) allow. Calls of one chat are made one at a time and in the order they were
+# scheduled, whatever their priority: it only chooses which chat goes next (the chat waiting with a password prompt
+# before chats waiting with ordinary replies). Deletion of old messages is queued apart from other calls of the chat,
+# so that it neither holds them up nor goes before any of them.
+# Flood control (RetryAfter) pauses all calls for the requested time, network errors are retried with exponential
+# backoff (timeouts only if the call can be repeated safely). A queued edit of a message is replaced by a newer edit
+# of the same message instead of being made too
+
+PRIORITY_AUTH, PRIORITY_NORMAL, PRIORITY_CLEANUP = range(3)
+
+# Token bucket: rate tokens per second, at most burst of them. rate None means unlimited
+class TokenBucket:
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+		self._tokens = burst
+		self._stamp = time.monotonic()
+
+	def _refill(self, now):
+		self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+		self._stamp = now
+
+	# Returns amount of seconds until a token is available
+	def delay(self, now):
+		if self.rate is None:
+			return 0
+		self._refill(now)
+		return 0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+	def take(self):
+		if self.rate is not None:
+			self._tokens -= 1
+
+	# Returns True if the bucket is as good as a new one (so it may be dropped)
+	def full(self, now):
+		if self.rate is None:
+			return True
+		self._refill(now)
+		return self._tokens >= self.burst
+
+class _Call:
+	__slots__ = ('chat_id', 'fn', 'args', 'kwargs', 'priority', 'per_chat', 'idempotent', 'retries', 'coalesce',
+				 'callbacks', 'future', 'attempt', 'not_before')
+
+	def __init__(self, chat_id, fn, args, kwargs, priority, per_chat, idempotent, retries, coalesce):
+		self.chat_id = chat_id
+		self.fn = fn
+		self.args = args
+		self.kwargs = kwargs
+		self.priority = priority
+		self.per_chat = per_chat
+		self.idempotent = idempotent
+		self.retries = retries
+		self.coalesce = coalesce
+		self.callbacks = []
+		self.future = Future()
+		self.attempt = 0
+		self.not_before = 0
+
+class Outbox:
+	def __init__(self, workers=OUTBOX_WORKERS, rate=OUTBOX_RATE, burst=OUTBOX_BURST, chat_rate=OUTBOX_CHAT_RATE,
+				 chat_burst=OUTBOX_CHAT_BURST, retries=OUTBOX_RETRIES, backoff=OUTBOX_BACKOFF):
+		self.workers = workers
+		self.chat_rate = chat_rate
+		self.chat_burst = chat_burst
+		self.retries = retries
+		self.backoff = backoff
+		self._bucket = TokenBucket(rate, burst)
+		self._buckets = {}			# chat_id -> TokenBucket
+		self._lanes = {}			# (chat_id, is cleanup) -> deque of calls waiting
+		self._ready = [collections.OrderedDict() for _ in range(PRIORITY_CLEANUP + 1)]	# lanes, which may go next
+		self._priorities = {}		# lane -> its index in _ready (the highest priority of its calls)
+		self._coalesced = {}		# coalesce key -> call waiting
+		self._cond = threading.Condition()
+		self._threads = []
+		self._pending = 0
+		self._finished = 0
+		self._paused_until = 0
+
+	def _start(self):
+		if self._threads:
+			return
+		for i in range(self.workers):
+			thread = threading.Thread(target=self._work, name='outbox:{0}'.format(i), daemon=True)
+			thread.start()
+			self._threads.append(thread)
+
+	# Schedules call fn(*args, **kwargs) on behalf of given chat and returns immediately. Returns Future of its result.
+	# per_chat - if the call is limited by the chat's bucket (messages are, deletions are not),
+	# idempotent - if the call may be repeated after a timeout (the first attempt might have succeeded),
+	# coalesce - key of the call: a waiting call with the same key is updated with these arguments instead,
+	# on_done - called with the result once the call succeeds (on a thread of the outbox)
+	def call(self, chat_id, fn, *args, priority=PRIORITY_NORMAL, per_chat=True, idempotent=True, retries=None,
+			 coalesce=None, on_done=None, **kwargs):
+		with self._cond:
+			self._start()
+			waiting = self._coalesced.get(coalesce) if coalesce is not None else None
+			if waiting is not None:
+				waiting.fn, waiting.args, waiting.kwargs = fn, args, kwargs
+				if on_done is not None:
+					waiting.callbacks.append(on_done)
+				metrics.count('outbox_coalesced')
+				return waiting.future
+
+			call = _Call(chat_id, fn, args, kwargs, priority, per_chat, idempotent,
+						 self.retries if retries is None else retries, coalesce)
+			if on_done is not None:
+				call.callbacks.append(on_done)
+			if coalesce is not None:
+				self._coalesced[coalesce] = call
+			lane = (chat_id, priority == PRIORITY_CLEANUP)
+			if lane not in self._lanes:
+				self._lanes[lane] = collections.deque()
+				self._schedule(lane, priority)
+			elif priority < self._priorities.get(lane, priority):
+				# Waiting lane goes ahead of other chats, but the call still waits for earlier ones of its chat
+				del self._ready[self._priorities[lane]][lane]
+				self._schedule(lane, priority)
+			self._lanes[lane].append(call)
+			self._pending += 1
+			self._cond.notify()
+			return call.future
+
+	# Sends text message to given chat, on_sent is called with the sent message
+	def send(self, bot, chat_id, text, priority=PRIORITY_NORMAL, on_sent=None, **kwargs):
+		return self.call(chat_id, bot.send_message, chat_id, text, priority=priority, idempotent=False, on_done=on_sent,
+						 **kwargs)
+
+	# Changes text (and inline keyboard) of given message. Only the latest of edits waiting in the queue is made
+	def edit(self, bot, chat_id, message_id, text, priority=PRIORITY_NORMAL, **kwargs):
+		return self.call(chat_id, bot.edit_message_text, text, chat_id, message_id, priority=priority,
+						 coalesce=('edit', chat_id, message_id), **kwargs)
+
+	# Returns number of calls queued or being made
+	def pending(self):
+		with self._cond:
+			return self._pending
+
+	# Blocks until everything scheduled so far is done (or timeout elapses). Returns True if nothing is pending
+	def join(self, timeout=None):
+		deadline = None if timeout is None else time.monotonic() + timeout
+		with self._cond:
+			while self._pending > 0:
+				wait = None if deadline is None else deadline - time.monotonic()
+				if wait is not None and wait <= 0:
+					return False
+				self._cond.wait(wait)
+			return True
+
+	# Marks lane ready to go next with given priority. Holds the lock
+	def _schedule(self, lane, priority):
+		self._ready[priority][lane] = None
+		self._priorities[lane] = priority
+
+	# Returns next call allowed to be made, or (None, seconds to wait - None if nothing is queued). Holds the lock
+	def _next(self, now):
+		if now < self._paused_until:
+			return None, self._paused_until - now
+		if not any(self._ready):
+			return None, None
+		wait = self._bucket.delay(now)
+		if wait > 0:
+			return None, wait
+		for ready in self._ready:
+			for lane in ready:
+				call = self._lanes[lane][0]
+				delay = call.not_before - now
+				if call.per_chat:
+					bucket = self._buckets.get(call.chat_id)
+					if bucket is None:
+						bucket = self._buckets[call.chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+					delay = max(delay, bucket.delay(now))
+				if delay > 0:
+					wait = delay if wait == 0 else min(wait, delay)
+					continue
+				del ready[lane]
+				del self._priorities[lane]
+				self._lanes[lane].popleft()
+				if call.coalesce is not None:
+					self._coalesced.pop(call.coalesce, None)
+				self._bucket.take()
+				if call.per_chat:
+					bucket.take()
+				return call, None
+		return None, wait
+
+	def _take(self):
+		with self._cond:
+			while True:
+				call, wait = self._next(time.monotonic())
+				if call is not None:
+					return call
+				self._cond.wait(wait)
+
+	# Returns lane of the call to the queue: with the call at its head again (retry) or with the next call, if any
+	def _release(self, call, retry=False):
+		lane = (call.chat_id, call.priority == PRIORITY_CLEANUP)
+		with self._cond:
+			if retry:
+				self._lanes[lane].appendleft(call)
+			else:
+				self._pending -= 1
+				self._finished += 1
+			if self._lanes[lane]:
+				self._schedule(lane, min(waiting.priority for waiting in self._lanes[lane]))
+			else:
+				del self._lanes[lane]
+				self._drop_bucket(call.chat_id)
+			if self._finished % 1024 == 0:
+				now = time.monotonic()
+				for chat_id in [c for c, bucket in self._buckets.items() if bucket.full(now)]:
+					self._drop_bucket(chat_id)
+			self._cond.notify_all()
+
+	# Forgets bucket of a chat, which has nothing queued and may burst again anyway
+	def _drop_bucket(self, chat_id):
+		bucket = self._buckets.get(chat_id)
+		if bucket is not None and bucket.full(time.monotonic()) \
+				and (chat_id, False) not in self._lanes and (chat_id, True) not in self._lanes:
+			del self._buckets[chat_id]
+
+	def _work(self):
+		while True:
+			call = self._take()
+			try:
+				result = call.fn(*call.args, **call.kwargs)
+			except RetryAfter as e:
+				logger.info('Flood control: pausing calls for {0} seconds'.format(e.retry_after))
+				with self._cond:
+					self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+				self._retry(call, e, 'retry_after')
+			except (TimedOut, NetworkError) as e:
+				if isinstance(e, BadRequest) or (isinstance(e, TimedOut) and not call.idempotent):
+					self._fail(call, e)
+				else:
+					call.not_before = time.monotonic() + self.backoff * 2 ** call.attempt
+					self._retry(call, e, 'network')
+			except Exception as e:
+				self._fail(call, e)
+			else:
+				for callback in call.callbacks:
+					try:
+						callback(result)
+					except Exception as e:
+						logger.warning('Callback of {0} for chat_id=\'{1}\' failed: {2}'.format(
+							getattr(call.fn, '__name__', call.fn), call.chat_id, e))
+				call.future.set_result(result)
+				self._release(call)
+
+	def _retry(self, call, error, reason):
+		if call.attempt >= call.retries:
+			self._fail(call, error)
+			return
+		call.attempt += 1
+		metrics.count('outbox_retries', reason=reason)
+		self._release(call, retry=True)
+
+	def _fail(self, call, error):
+		# Cleanup waits for its calls and handles their errors itself
+		if call.priority != PRIORITY_CLEANUP:
+			logger.warning('Call of {0} for chat_id=\'{1}\' failed: {2}'.format(
+				getattr(call.fn, '__name__', call.fn), call.chat_id, error))
+		call.future.set_exception(error)
+		self._release(call)
+
+scheduler = Outbox()
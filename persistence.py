@@ -0,0 +1,166 @@
+import base64, hashlib, json, logging, threading
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+import db_handler as dbh
+from msg_ids import MsgIds
+from util import LruCache
+from constants import PERSISTENCE_FLUSHED_CACHE
+
+logger = logging.getLogger(__name__)
+
+def _b64(value):
+	return base64.b64encode(value).decode()
+
+def _unb64(value):
+	return base64.b64decode(value)
+
+# Returns digest of serialized state, which is enough to tell if the state has changed
+def _digest(text):
+	return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+# Keys of chat_data which survive restart, with their (serialize, deserialize) converters.
+# Nothing else is stored: neither password-hash (it is read from DB again) nor any plaintext
+PERSISTENT_KEYS = {
+	'password_mode':		(None, None),
+	'authorized':			(None, None),
+	'number_of_records':	(None, None),
+	'data_size':			(None, None),
+	'browse':				(None, None),
+	'msg_ids':				(lambda v: v.runs(), MsgIds.from_runs),
+	'data':					(_b64, _unb64),		# ciphertext of unconfirmed record
+	'label':				(lambda v: [_b64(v[0]), [_b64(t) for t in v[1]]],	# ciphertext and index tokens of label
+							 lambda v: (_unb64(v[0]), [_unb64(t) for t in v[1]])),
+	'multipart':			(lambda v: dict(v, header=_b64(v['header'])), lambda v: dict(v, header=_unb64(v['header']))),
+}
+
+def serialize_chat_data(data):
+	state = {}
+	for key, value in list(data.items()):
+		if key in PERSISTENT_KEYS and value is not None:
+			serialize = PERSISTENT_KEYS[key][0]
+			state[key] = value if serialize is None else serialize(value)
+	return json.dumps(state, sort_keys=True)
+
+def deserialize_chat_data(text):
+	data = {}
+	for key, value in json.loads(text).items():
+		if key in PERSISTENT_KEYS:
+			deserialize = PERSISTENT_KEYS[key][1]
+			data[key] = value if deserialize is None else deserialize(value)
+	return data
+
+# chat_data of the dispatcher, which loads state of a chat on its first update
+class LazyChatData(defaultdict):
+	def __init__(self, loader):
+		super().__init__(dict)
+		self._loader = loader
+
+	def __missing__(self, chat_id):
+		data = self._loader(chat_id)
+		self[chat_id] = data
+		return data
+
+# Conversations of ConversationHandler, which loads state of a conversation on its first lookup
+class LazyConversations(dict):
+	def __init__(self, loader):
+		super().__init__()
+		self._loader = loader
+		self._loaded = set()
+
+	def get(self, key, default=None):
+		if key not in self._loaded:
+			self._loaded.add(key)
+			if not dict.__contains__(self, key):
+				state = self._loader(key)
+				if state is not None:
+					self[key] = state
+		return super().get(key, default)
+
+	def __contains__(self, key):
+		self.get(key)
+		return super().__contains__(key)
+
+# Persistence of chat_data and conversation states in the bot's database. Nothing is read at startup: state of a chat
+# is loaded on its first update. Updates only mark chats dirty, flush() (periodic and on shutdown) writes the chats
+# which actually changed since previous flush in one transaction
+class SqlitePersistence(BasePersistence):
+	def __init__(self):
+		super().__init__(store_user_data=False, store_chat_data=True, store_bot_data=False)
+		self._lock = threading.Lock()
+		self._dirty_chats = {}			# chat_id -> chat_data
+		self._dirty_conversations = {}	# (name, key) -> state
+		self._flushed = LruCache(PERSISTENCE_FLUSHED_CACHE)	# chat_id -> digest of serialized state, as it is in DB
+
+	def _load_chat_data(self, chat_id):
+		try:
+			text = dbh.load_chat_state(chat_id)
+		except Exception as e:
+			logger.warning('Loading state of chat_id=\'{0}\' failed: {1}'.format(chat_id, e))
+			return {}
+		if text is None:
+			return {}
+		self._flushed.put(chat_id, _digest(text))
+		return deserialize_chat_data(text)
+
+	def get_chat_data(self):
+		return LazyChatData(self._load_chat_data)
+
+	def get_user_data(self):
+		return defaultdict(dict)
+
+	def get_bot_data(self):
+		return {}
+
+	def get_conversations(self, name):
+		return LazyConversations(lambda key: dbh.load_conversation(name, json.dumps(key)))
+
+	def update_chat_data(self, chat_id, data):
+		with self._lock:
+			self._dirty_chats[chat_id] = data
+
+	def update_conversation(self, name, key, new_state):
+		# Promises of run_async handlers are resolved later, the resolved state will be updated again
+		if new_state is not None and not isinstance(new_state, int):
+			return
+		with self._lock:
+			self._dirty_conversations[(name, json.dumps(key))] = new_state
+
+	def update_user_data(self, user_id, data):
+		pass
+
+	def update_bot_data(self, data):
+		pass
+
+	def flush(self):
+		with self._lock:
+			chats, self._dirty_chats = self._dirty_chats, {}
+			conversations, self._dirty_conversations = self._dirty_conversations, {}
+
+		states, digests = {}, {}
+		for chat_id, data in chats.items():
+			try:
+				text = serialize_chat_data(data)
+			except Exception as e:
+				# chat_data was changed meanwhile, it will be marked dirty again anyway
+				logger.warning('Serializing state of chat_id=\'{0}\' failed: {1}'.format(chat_id, e))
+				continue
+			digest = _digest(text)
+			if self._flushed.get(chat_id) != digest:
+				states[chat_id], digests[chat_id] = text, digest
+
+		try:
+			dbh.save_chat_states(states)
+			dbh.save_conversations(conversations)
+		except Exception as e:
+			logger.warning('Flushing state of {0} chats failed: {1}'.format(len(states), e))
+			with self._lock:
+				for chat_id, data in chats.items():
+					self._dirty_chats.setdefault(chat_id, data)
+				for key, state in conversations.items():
+					self._dirty_conversations.setdefault(key, state)
+			return
+
+		for chat_id, digest in digests.items():
+			self._flushed.put(chat_id, digest)
@@ -0,0 +1,107 @@
+import logging, threading, time
+
+import metrics
+from constants import *
+
+logger = logging.getLogger(__name__)
+
+# Limiter of password attempts, which is checked before the password is hashed, so that a flooding chat cannot make
+# the bot burn PBKDF2 iterations. Every chat has a token bucket (burst attempts, restored by rate per second) and
+# every wrong password blocks the chat for exponentially growing time (backoff * 2^(failures - 1), up to backoff_max).
+# Wrong passwords are also counted in store (db_handler), if given, so that restart of the bot does not reset backoff
+class LoginLimiter:
+	def __init__(self, rate=LOGIN_RATE, burst=LOGIN_BURST, backoff=LOGIN_BACKOFF, backoff_max=LOGIN_BACKOFF_MAX,
+				 forget_after=LOGIN_FORGET_AFTER, store=None, clock=time.time):
+		self.rate = rate
+		self.burst = burst
+		self.backoff = backoff
+		self.backoff_max = backoff_max
+		self.forget_after = forget_after
+		self.store = store
+		self.clock = clock
+		self._lock = threading.Lock()
+		self._chats = {}	# chat_id -> [tokens, time of last attempt, failures, blocked until]
+
+	def __len__(self):
+		return len(self._chats)
+
+	# Returns state of given chat, loading its failures from store on first use
+	def _entry(self, chat_id, now):
+		with self._lock:
+			entry = self._chats.get(chat_id)
+		if entry is not None:
+			return entry
+		failures, blocked_until = 0, 0
+		if self.store is not None:
+			try:
+				failures, blocked_until = self.store.load_login_attempt(chat_id) or (0, 0)
+			except Exception as e:
+				logger.warning('Loading login attempts of chat_id=\'{0}\' failed: {1}'.format(chat_id, e))
+		with self._lock:
+			return self._chats.setdefault(chat_id, [self.burst, now, failures, blocked_until])
+
+	# Takes one attempt of given chat. Returns 0 if it may check password now, otherwise amount of seconds to wait
+	def check(self, chat_id):
+		now = self.clock()
+		entry = self._entry(chat_id, now)
+		with self._lock:
+			if entry[3] > now:
+				wait, decision = entry[3] - now, 'blocked'
+			else:
+				entry[0] = min(self.burst, entry[0] + (now - entry[1]) * self.rate)
+				entry[1] = now
+				if entry[0] < 1:
+					wait, decision = (1 - entry[0]) / self.rate, 'throttled'
+				else:
+					entry[0] -= 1
+					wait, decision = 0, 'allowed'
+		metrics.count('login_attempts', decision=decision)
+		return wait
+
+	# Registers wrong password of given chat and blocks it. Returns amount of seconds it is blocked for
+	def failed(self, chat_id):
+		now = self.clock()
+		entry = self._entry(chat_id, now)
+		with self._lock:
+			entry[2] += 1
+			entry[3] = now + min(self.backoff * 2 ** (entry[2] - 1), self.backoff_max)
+			failures, blocked_until = entry[2], entry[3]
+		metrics.count('login_attempts', decision='failed')
+		if self.store is not None:
+			try:
+				self.store.save_login_attempt(chat_id, failures, blocked_until)
+			except Exception as e:
+				logger.warning('Saving login attempts of chat_id=\'{0}\' failed: {1}'.format(chat_id, e))
+		return blocked_until - now
+
+	# Forgets wrong passwords of given chat after successful login
+	def succeeded(self, chat_id):
+		with self._lock:
+			entry = self._chats.get(chat_id)
+			if entry is None or entry[2] == 0:
+				return
+			entry[2] = 0
+			entry[3] = 0
+		if self.store is not None:
+			try:
+				self.store.delete_login_attempt(chat_id)
+			except Exception as e:
+				logger.warning('Deleting login attempts of chat_id=\'{0}\' failed: {1}'.format(chat_id, e))
+
+	# Drops chats whose bucket is full again and which have no wrong passwords to remember. Returns number of them
+	def prune(self):
+		now = self.clock()
+		refill = self.burst / self.rate
+		with self._lock:
+			stale = [chat_id for chat_id, (tokens, updated, failures, blocked_until) in self._chats.items()
+					 if now - updated >= refill and blocked_until <= now
+					 and (failures == 0 or now - blocked_until >= self.forget_after)]
+			for chat_id in stale:
+				del self._chats[chat_id]
+		if self.store is not None:
+			try:
+				self.store.prune_login_attempts(now - self.forget_after)
+			except Exception as e:
+				logger.warning('Pruning login attempts failed: {0}'.format(e))
+		metrics.count('login_limiter_pruned', len(stale))
+		return len(stale)
@@ -0,0 +1,150 @@
+# Moves a chat to another shard of the sharded mode (see sharding.py). The bot must be stopped.
+# The chat is copied with all its data (records, chunks, index tokens, session state, login attempts) to database
+# of the target shard in one transaction, then the shard map is updated and finally the chat is deleted from all
+# other shards. Every step can be repeated, so an interrupted move is completed by running the tool again.
+# If the chat is not where the shard map says (e.g. the map was lost), it is looked for in all shards. Nothing is
+# changed, if it is found nowhere or in several shards other than the target, and nothing is deleted, before the
+# target shard holds the chat.
+# Usage: python rebalance.py <chat_id> <shard>
+import json, logging, os, sys
+
+import db_handler as dbh
+from rekey import finish_rekey
+from db_handler import Chat, Record, RecordChunk, RecordToken, ChatState, ConversationState, LoginAttempt
+from sharding import shard_db_path, shard_of, load_overrides, save_overrides
+from constants import *
+
+logger = logging.getLogger(__name__)
+
+# Copies rows of model from attached database 'src' matching given condition, replacing values of given columns.
+# Returns row id of the last copied row
+def _copy(model, where, params, replace=None):
+	replace = replace or {}
+	columns = [f.column_name for f in model._meta.sorted_fields if f.column_name != model._meta.primary_key.column_name]
+	sql = 'INSERT INTO main."{0}" ({1}) SELECT {2} FROM src."{0}" WHERE {3}'.format(
+		model._meta.table_name, ', '.join('"{0}"'.format(c) for c in columns),
+		', '.join('?' if c in replace else '"{0}"'.format(c) for c in columns), where)
+	return dbh.db.execute_sql(sql, [replace[c] for c in columns if c in replace] + list(params)).lastrowid
+
+def _column(field):
+	return '"{0}"'.format(field.column_name)
+
+# Returns ids of unfinished uploads referenced by saved session state of the chat
+def _uploads(state):
+	if state is None:
+		return []
+	multipart = json.loads(state).get('multipart')
+	return [multipart['upload']] if multipart else []
+
+# Returns conversation keys (see persistence.py) of given chat: JSON of (chat_id, user_id)
+def _conversation_prefix(chat_id):
+	return json.dumps([chat_id])[:-1] + ',%'
+
+# Copies given chat from database attached as 'src' to the current one. Returns number of copied records
+def _copy_chat(chat_id):
+	row = dbh.db.execute_sql('SELECT id FROM src."{0}" WHERE {1} = ?'.format(Chat._meta.table_name, _column(Chat.chat_id)),
+							 (chat_id,)).fetchone()
+	if row is None:
+		return None
+	old_uid = row[0]
+	uid = _copy(Chat, '{0} = ?'.format(_column(Chat.chat_id)), (chat_id,))
+	records = dbh.db.execute_sql('SELECT id FROM src."{0}" WHERE {1} = ?'.format(
+		Record._meta.table_name, _column(Record.chat_uid)), (old_uid,)).fetchall()
+	for (old_record_uid,) in records:
+		record_uid = _copy(Record, 'id = ?', (old_record_uid,), {Record.chat_uid.column_name: uid})
+		_copy(RecordChunk, '{0} = ?'.format(_column(RecordChunk.record_uid)), (old_record_uid,),
+			  {RecordChunk.record_uid.column_name: record_uid})
+		_copy(RecordToken, '{0} = ?'.format(_column(RecordToken.record_uid)), (old_record_uid,),
+			  {RecordToken.record_uid.column_name: record_uid, RecordToken.chat_uid.column_name: uid})
+
+	_copy(ChatState, '{0} = ?'.format(_column(ChatState.chat_id)), (chat_id,))
+	state = dbh.db.execute_sql('SELECT {0} FROM src."{1}" WHERE {2} = ?'.format(
+		_column(ChatState.data), ChatState._meta.table_name, _column(ChatState.chat_id)), (chat_id,)).fetchone()
+	for upload in _uploads(state[0] if state else None):
+		_copy(RecordChunk, '{0} = ?'.format(_column(RecordChunk.upload)), (upload,))
+	_copy(ConversationState, '{0} LIKE ?'.format(_column(ConversationState.key)), (_conversation_prefix(chat_id),))
+	_copy(LoginAttempt, '{0} = ?'.format(_column(LoginAttempt.chat_id)), (chat_id,))
+	return len(records)
+
+# Deletes given chat with all its data from the current database
+def _purge_chat(chat_id):
+	with dbh.db.atomic():
+		for upload in _uploads(dbh.load_chat_state(chat_id)):
+			dbh.cancel_upload(upload)
+		if dbh.get_chat_uid(chat_id) is not None:
+			dbh.delete_all(chat_id)
+		ChatState.delete().where(ChatState.chat_id == chat_id).execute()
+		ConversationState.delete().where(ConversationState.key ** _conversation_prefix(chat_id)).execute()
+		dbh.delete_login_attempt(chat_id)
+
+# Returns shards, whose databases contain given chat
+def _holders(chat_id, count):
+	holders = []
+	for shard in range(count):
+		if os.path.exists(shard_db_path(shard)):
+			dbh.init(shard_db_path(shard))
+			if dbh.get_chat_uid(chat_id) is not None:
+				holders.append(shard)
+			dbh.close()
+	return holders
+
+# Moves chat to given shard. Returns number of moved records, None - if the chat was already there.
+# Raises ValueError if the chat cannot be found for sure
+def move_chat(chat_id, target, count=SHARD_COUNT):
+	overrides = load_overrides(count=count)
+	source = shard_of(chat_id, overrides, count)
+	holders = _holders(chat_id, count)
+	if source not in holders:
+		others = [shard for shard in holders if shard != target]
+		if len(others) > 1:
+			raise ValueError('Chat {0} is not in shard {1}, but in shards {2}'.format(chat_id, source, others))
+		if not others and target not in holders:
+			raise ValueError('Chat {0} was found in no shard'.format(chat_id))
+		logger.warning('Chat with chat_id=\'{0}\' is not in shard {1}, but in shard {2}'.format(
+			chat_id, source, others[0] if others else target))
+		source = others[0] if others else target
+
+	moved = None
+	if source != target:
+		# Ranges of re-encryption are row ids, which change on copy
+		dbh.init(shard_db_path(source))
+		finish_rekey(chat_id)
+		dbh.close()
+		dbh.init(shard_db_path(target))
+		# Leftovers of an interrupted move are replaced by a fresh copy
+		_purge_chat(chat_id)
+		dbh.db.execute_sql('ATTACH DATABASE ? AS src', (shard_db_path(source),))
+		try:
+			with dbh.db.atomic():
+				moved = _copy_chat(chat_id)
+		finally:
+			dbh.db.execute_sql('DETACH DATABASE src')
+		dbh.close()
+
+	if shard_of(chat_id, overrides, count) != target or not os.path.exists(SHARD_MAP_PATH):
+		overrides.pop(chat_id, None)
+		if target != chat_id % count:
+			overrides[chat_id] = target
+		save_overrides(overrides, count=count)
+
+	for shard in range(count):
+		if shard != target and os.path.exists(shard_db_path(shard)):
+			dbh.init(shard_db_path(shard))
+			_purge_chat(chat_id)
+			dbh.close()
+	return moved
+
+if __name__ == '__main__':
+	if len(sys.argv) != 3 or not 0 <= int(sys.argv[2]) < SHARD_COUNT:
+		print('Usage: python rebalance.py <chat_id> <shard: 0..{0}>'.format(SHARD_COUNT - 1))
+		sys.exit(1)
+	chat_id, target = int(sys.argv[1]), int(sys.argv[2])
+	try:
+		moved = move_chat(chat_id, target)
+	except ValueError as e:
+		print('Nothing was changed: {0}'.format(e))
+		sys.exit(1)
+	if moved is None:
+		print('Chat {0} is in shard {1} already'.format(chat_id, target))
+	else:
+		print('Moved chat {0} with {1} records to shard {2}'.format(chat_id, moved, target))
@@ -0,0 +1,88 @@
+# Re-encryption of all records of a chat with a new key. Key of a chat is part of its password-hash, so it changes
+# when the hash is upgraded to new KDF parameters (see crypto.needs_upgrade).
+# start_rekey() stores the new hash and remembers the old one with ranges of row ids of records and chunks existing
+# at that moment (see db_handler.Rekey) in one short transaction, everything written later is encrypted with the new
+# key. rekey_batch() then re-encrypts at most REKEY_BATCH records (with their labels and index tokens) or chunks per
+# transaction in order of row ids and moves the ranges on, so the write lock is never held for long and interrupted
+# re-encryption goes on where it stopped. Search and export need all records of a chat under one key, so they
+# are refused while re-encryption of the chat is pending (see rekey_pending())
+import logging, threading
+
+from peewee import fn
+
+import db_handler as dbh
+from db_handler import Record, RecordChunk, RecordToken, Rekey
+from crypto import open_record, seal_record, rekey_chunk, open_label, seal_label, password_key, forget_key
+from constants import RECORD_VERSION, REKEY_BATCH
+
+logger = logging.getLogger(__name__)
+
+# Batches of a chat may be run by its handler and by a background thread at once
+_lock = threading.Lock()
+
+# Stores new password-hash of given chat and starts re-encryption of its records from key of the old one (it goes on
+# by rekey_batch()). Re-encryption left unfinished is finished first
+def start_rekey(chat_id, old_hash, new_hash):
+	finish_rekey(chat_id)
+	dbh.record_batcher.flush()
+	uid = dbh.get_chat_uid(chat_id)
+	with _lock, dbh.db.atomic():
+		if uid is not None:
+			Rekey.insert(chat_uid=uid, password=old_hash, record_from=0,
+						 record_to=Record.select(fn.MAX(Record.id)).scalar() or 0, chunk_from=0,
+						 chunk_to=RecordChunk.select(fn.MAX(RecordChunk.id)).scalar() or 0).execute()
+		dbh.set_password(chat_id, new_hash)
+
+# Re-encrypts next batch of records (or chunks, once records are done) of given chat in one transaction. Version 1
+# records are converted to RECORD_VERSION on the way. Returns True if anything is left to re-encrypt
+def rekey_batch(chat_id, batch=REKEY_BATCH):
+	uid = dbh.get_chat_uid(chat_id)
+	if uid is None:
+		return False
+	with _lock, dbh.db.atomic():
+		state = Rekey.get_or_none(Rekey.chat_uid == uid)
+		if state is None:
+			return False
+		old_key, new_key = password_key(state.password), password_key(dbh.get_password(chat_id))
+
+		rows = list(Record.select(Record.id, Record.version, Record.data, Record.payload, Record.header, Record.label)
+					.where((Record.chat_uid == uid) & (Record.id > state.record_from) & (Record.id <= state.record_to))
+					.order_by(Record.id).limit(batch).tuples())
+		for record_uid, version, data, payload, header, label in rows:
+			if label is not None:
+				label, tokens = seal_label(open_label(label, old_key), new_key)
+				RecordToken.delete().where(RecordToken.record_uid == record_uid).execute()
+				Record.update(label=label).where(Record.id == record_uid).execute()
+				dbh.add_tokens(uid, record_uid, tokens)
+			if header is None:
+				plain = open_record(version, data, payload, old_key)
+				Record.update(payload=seal_record(plain, new_key), data=None, data_size=len(plain),
+							  version=RECORD_VERSION).where(Record.id == record_uid).execute()
+			state.record_from = record_uid
+
+		if not rows:
+			chunks = list(RecordChunk.select(RecordChunk.id, RecordChunk.seq, RecordChunk.data, Record.header).join(Record)
+						  .where((Record.chat_uid == uid) & (RecordChunk.id > state.chunk_from)
+								 & (RecordChunk.id <= state.chunk_to))
+						  .order_by(RecordChunk.id).limit(batch).tuples())
+			for chunk_uid, seq, data, header in chunks:
+				RecordChunk.update(data=rekey_chunk(old_key, new_key, header, seq, data)) \
+					.where(RecordChunk.id == chunk_uid).execute()
+				state.chunk_from = chunk_uid
+			if not chunks:
+				state.delete_instance()
+				forget_key(old_key)
+				logger.info('Re-encrypted records of chat_id=\'{0}\''.format(chat_id))
+				return False
+		state.save()
+	return True
+
+# Returns True if records of given chat are still being re-encrypted
+def rekey_pending(chat_id):
+	uid = dbh.get_chat_uid(chat_id)
+	return uid is not None and Rekey.select().where(Rekey.chat_uid == uid).exists()
+
+# Re-encrypts everything left of given chat, batch by batch
+def finish_rekey(chat_id):
+	while rekey_batch(chat_id):
+		pass
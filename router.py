@@ -0,0 +1,25 @@
+from telegram import Update
+from telegram.ext import Handler
+
+# Handler of keyboard buttons of one conversation state. Exact text of a message (reply keyboard) or data of a callback
+# query (inline keyboard) is looked up in a dict of routes (text -> callback), so routing costs one lookup however
+# many buttons the state has. Text matching no button goes to fallback (if any), other updates are left to other
+# handlers of the state
+class ButtonRouter(Handler):
+	def __init__(self, routes, fallback=None):
+		super().__init__(fallback)
+		self.routes = dict(routes)
+		self.fallback = fallback
+
+	def check_update(self, update):
+		if not isinstance(update, Update):
+			return None
+		if update.callback_query is not None:
+			return self.routes.get(update.callback_query.data)
+		if update.message is None or update.message.text is None:
+			return None
+		return self.routes.get(update.message.text, self.fallback)
+
+	# check_result is the callback chosen by check_update()
+	def handle_update(self, update, dispatcher, check_result, context=None):
+		return check_result(update, context)
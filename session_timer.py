@@ -0,0 +1,64 @@
+import threading, time
+
+from constants import SESSION_WHEEL_SLOTS, SESSION_WHEEL_TICK
+
+# Hashed timer wheel of inactivity deadlines by chat_id. touch() and cancel() are O(1) and independent for each chat;
+# sweep() only visits slots passed since previous sweep, so its cost depends on the number of expired sessions.
+# Deadlines further away than the wheel span stay in their slot for another round
+class InactivityTracker:
+	def __init__(self, slots=SESSION_WHEEL_SLOTS, tick=SESSION_WHEEL_TICK, clock=time.monotonic):
+		self.tick = tick
+		self.clock = clock
+		self._slots = [{} for _ in range(slots)]	# chat_id -> (deadline, payload)
+		self._where = {}							# chat_id -> index of slot
+		self._swept = None							# number of the last swept tick
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._where)
+
+	def __contains__(self, chat_id):
+		return chat_id in self._where
+
+	# (Re)sets deadline of given chat to timeout seconds from now. payload is handed back by sweep() on expiry
+	def touch(self, chat_id, timeout, payload=None):
+		now = self.clock()
+		deadline = now + timeout
+		slot = int(-(-deadline // self.tick)) % len(self._slots)
+		with self._lock:
+			if self._swept is None:
+				self._swept = int(now // self.tick)
+			old = self._where.get(chat_id)
+			if old is not None and old != slot:
+				self._slots[old].pop(chat_id, None)
+			self._slots[slot][chat_id] = (deadline, payload)
+			self._where[chat_id] = slot
+
+	# Forgets deadline of given chat. Returns True if there was one
+	def cancel(self, chat_id):
+		with self._lock:
+			slot = self._where.pop(chat_id, None)
+			if slot is None:
+				return False
+			self._slots[slot].pop(chat_id, None)
+			return True
+
+	# Removes expired chats and returns them as list of (chat_id, payload)
+	def sweep(self):
+		now = self.clock()
+		current = int(now // self.tick)
+		expired = []
+		with self._lock:
+			if self._swept is None:
+				self._swept = current
+				return expired
+			first = max(self._swept + 1, current - len(self._slots) + 1)
+			for tick in range(first, current + 1):
+				slot = self._slots[tick % len(self._slots)]
+				for chat_id, (deadline, payload) in list(slot.items()):
+					if deadline <= now:
+						del slot[chat_id]
+						del self._where[chat_id]
+						expired.append((chat_id, payload))
+			self._swept = current
+		return expired
@@ -0,0 +1,162 @@
+import json, logging, multiprocessing, os, signal, threading
+
+from telegram import Bot, Update
+from telegram.error import TelegramError
+
+from api_token import TOKEN
+from constants import *
+
+logger = logging.getLogger(__name__)
+
+# Sharded execution mode of the bot (RUNTIME_MODE = 'sharded').
+# The front process only ingests updates (long polling or webhook, SHARD_INGEST) and routes each of them by chat_id
+# to one of SHARD_COUNT worker processes through a bounded queue. Every worker is a whole bot of its own: dispatcher,
+# job queue, KDF pool, chat_data and its own database file (SHARD_DB_PATH), so chats of different shards share
+# neither GIL nor SQLite write lock. Updates of one chat are handled in order by its worker.
+# A chat lives in shard chat_id % SHARD_COUNT, unless it was moved by rebalance.py (SHARD_MAP_PATH is read at start).
+# The shard map also keeps the number of shards it was made for: with another SHARD_COUNT chats would be routed to
+# shards without their data, so neither the bot nor rebalance.py starts then.
+# Metrics of a worker are served at METRICS_PORT + 1 + its shard
+
+# Returns path of database file of given shard
+def shard_db_path(shard):
+	return SHARD_DB_PATH.format(shard)
+
+# Returns dict of chats moved from their default shard: chat_id -> shard.
+# Raises ValueError if the map was made for another number of shards
+def load_overrides(path=SHARD_MAP_PATH, count=SHARD_COUNT):
+	if not os.path.exists(path):
+		return {}
+	with open(path) as f:
+		data = json.load(f)
+	if data.get('count') != count:
+		raise ValueError('Shard map {0} was made for {1} shards, but SHARD_COUNT is {2}. Restore SHARD_COUNT '
+						 'or move the chats to new shards first'.format(path, data.get('count'), count))
+	return {int(chat_id): shard for chat_id, shard in data['chats'].items()}
+
+# Writes dict of moved chats atomically (a crash leaves either old or new file)
+def save_overrides(overrides, path=SHARD_MAP_PATH, count=SHARD_COUNT):
+	with open(path + '.tmp', 'w') as f:
+		json.dump({'count': count, 'chats': {str(chat_id): shard for chat_id, shard in sorted(overrides.items())}},
+				  f, indent=1)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(path + '.tmp', path)
+
+# Returns shard of given chat
+def shard_of(chat_id, overrides=None, count=SHARD_COUNT):
+	if overrides and chat_id in overrides:
+		return overrides[chat_id]
+	return chat_id % count
+
+# Returns chat_id of given update (user id if it has no chat, update_id if it has neither)
+def _update_chat_id(update):
+	if update.effective_chat is not None:
+		return update.effective_chat.id
+	if update.effective_user is not None:
+		return update.effective_user.id
+	return update.update_id
+
+# Routes updates to queues of worker processes. Has process_update(), so it can serve as dispatcher of
+# webhook.WebhookServer: a full queue of a worker blocks its webhook thread and so turns into 503s
+class ShardRouter:
+	def __init__(self, queues, overrides=None):
+		self.queues = queues
+		self.overrides = overrides or {}
+
+	def process_update(self, update):
+		self.queues[shard_of(_update_chat_id(update), self.overrides, len(self.queues))].put(update.to_dict())
+
+# Worker process: runs the bot on database of given shard, handling updates from the queue until None
+def _worker(shard, updates, params):
+	# Front process stops workers, once they are not fed anymore
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+	import main, crypto, kdf_pool, outbox
+	import db_handler as dbh
+	crypto.set_kdf_params(params)
+	dbh.init(shard_db_path(shard))
+	updater = main.build_updater(None if METRICS_PORT is None else METRICS_PORT + 1 + shard)
+	dp = updater.dispatcher
+	# Dispatcher thread itself stays idle, but its workers serve run_async (continuations of KDF jobs)
+	threading.Thread(target=dp.start, name='dispatcher', daemon=True).start()
+	updater.job_queue.start()
+	logger.info('Shard {0} is running on {1}'.format(shard, shard_db_path(shard)))
+	try:
+		while True:
+			data = updates.get()
+			if data is None:
+				break
+			try:
+				dp.process_update(Update.de_json(data, updater.bot))
+			except Exception as e:
+				logger.warning('Update "%s" caused error "%s"', data, e)
+	finally:
+		updater.job_queue.stop()
+		dp.stop()
+		if dp.persistence:
+			dp.update_persistence()
+			dp.persistence.flush()
+		outbox.scheduler.join(OUTBOX_DRAIN_TIMEOUT)
+		dbh.record_batcher.flush()
+		kdf_pool.pool.shutdown()
+		logger.info('Shard {0} stopped'.format(shard))
+
+# Feeds updates received by long polling to the router until stop is set
+def _poll(bot, router, stop):
+	bot.delete_webhook()
+	offset = None
+	while not stop.is_set():
+		try:
+			updates = bot.get_updates(offset=offset, timeout=SHARD_POLL_TIMEOUT)
+		except TelegramError as e:
+			logger.warning('Getting updates failed: {0}'.format(e))
+			stop.wait(1)
+			continue
+		for update in updates:
+			router.process_update(update)
+			offset = update.update_id + 1
+	# Confirms updates routed so far, so that they are not received again after restart
+	if offset is not None:
+		bot.get_updates(offset=offset, timeout=0)
+
+# Runs the front process and SHARD_COUNT worker processes until SIGINT/SIGTERM
+def run():
+	import crypto, webhook
+
+	# Calibrated once here, so that workers do not calibrate competing for CPU
+	params = crypto.calibrate() if KDF_CALIBRATE else crypto.kdf_params()
+	logger.info('Parameters of new password-hashes: {0}'.format(params))
+	overrides = load_overrides()
+	if not os.path.exists(SHARD_MAP_PATH):
+		# Pins the number of shards, which chats are distributed over from now on
+		save_overrides(overrides)
+
+	# Workers start from scratch instead of inheriting threads and connections of the front
+	context = multiprocessing.get_context('spawn')
+	queues = [context.Queue(SHARD_QUEUE_SIZE) for _ in range(SHARD_COUNT)]
+	workers = [context.Process(target=_worker, args=(shard, queues[shard], params), name='shard:{0}'.format(shard))
+			   for shard in range(SHARD_COUNT)]
+	for worker in workers:
+		worker.start()
+	logger.info('Started {0} shards, {1} chats moved'.format(SHARD_COUNT, len(overrides)))
+
+	router = ShardRouter(queues, overrides)
+	bot = Bot(TOKEN)
+	stop = webhook.stop_event()
+	try:
+		if SHARD_INGEST == 'webhook':
+			server = webhook.WebhookServer(router, bot)
+			server.start()
+			logger.info('Listening to webhook at port {0}'.format(server.port))
+			webhook.register(bot)
+			stop.wait()
+			server.stop()
+		else:
+			_poll(bot, router, stop)
+	finally:
+		for updates in queues:
+			updates.put(None)
+		for worker in workers:
+			worker.join()
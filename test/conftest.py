@@ -0,0 +1,73 @@
+import os, queue, sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Opens a fresh database in a temporary directory
+@pytest.fixture
+def database(tmp_path):
+	import db_handler as dbh
+	dbh.init(str(tmp_path / 'test.db'))
+	yield dbh
+	dbh.record_batcher.flush()
+	dbh.close()
+
+# Clock of tests, which stands still until they move it by its now attribute
+class Clock:
+	def __init__(self):
+		self.now = 1000.
+
+	def __call__(self):
+		return self.now
+
+@pytest.fixture
+def clock():
+	return Clock()
+
+# Handles given updates one by one and waits till everything they wrote and sent is done
+@pytest.fixture
+def feed():
+	import db_handler as dbh
+	import outbox
+	def feed(dp, updates):
+		for update in updates:
+			dp.process_update(update)
+		dbh.record_batcher.flush()
+		outbox.scheduler.join()
+	return feed
+
+def _dispatcher(persistence=None):
+	from telegram.ext import Dispatcher
+	import crypto, kdf_pool, outbox, main, load_test
+	from rate_limit import LoginLimiter
+	from session_timer import InactivityTracker
+	crypto.set_kdf_params(crypto.make_kdf_params(crypto.KDF_PBKDF2, i=load_test.KDF_ITERATIONS))
+	kdf_pool.pool = kdf_pool.KdfPool(kind='inline')
+	outbox.scheduler = outbox.Outbox(rate=None, chat_rate=None)
+	main.login_limiter = LoginLimiter()
+	main.inactivity = InactivityTracker()
+	dp = Dispatcher(load_test.FakeBot(), queue.Queue(), use_context=True, persistence=persistence)
+	main.register_handlers(dp)
+	return dp
+
+# Dispatcher with all handlers of the bot, whose Bot answers API calls locally (see load_test.py). Passwords are
+# hashed inline with cheap parameters, messages are sent by an unlimited outbox. Login attempts and sessions of
+# previous tests are forgotten
+@pytest.fixture
+def dispatcher(database):
+	import outbox
+	dp = _dispatcher()
+	yield dp
+	outbox.scheduler.join()
+	dp.stop()
+
+# The same dispatcher, which keeps state of chats in the database
+@pytest.fixture
+def persistent_dispatcher(database):
+	import outbox
+	from persistence import SqlitePersistence
+	dp = _dispatcher(SqlitePersistence())
+	yield dp
+	outbox.scheduler.join()
+	dp.stop()
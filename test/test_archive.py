@@ -0,0 +1,141 @@
+import io
+
+import pytest
+from telegram import Update
+from telegram.error import BadRequest
+
+import main, archive, crypto
+import db_handler as dbh
+from db_handler import Record
+from crypto import hash_password, password_key, seal_record, seal_label, open_record, open_label, label_tokens, \
+	make_kdf_params
+from rekey import finish_rekey
+from load_test import User, PASSWORD, KDF_ITERATIONS
+from constants import *
+
+CHAT_ID = 1
+
+PARAMS = make_kdf_params(crypto.KDF_PBKDF2, i=KDF_ITERATIONS)
+
+def document(user):
+	user.update_id += 1
+	message = {'message_id': user.bot.next_message_id(user.chat_id), 'date': 0, 'chat': user._chat(),
+			   'from': user._from(), 'document': {'file_id': 'archive', 'file_unique_id': 'archive', 'file_size': 1}}
+	return Update.de_json({'update_id': user.update_id, 'message': message}, user.bot)
+
+def make_chat(chat_id, pwd='password'):
+	hash = hash_password(pwd, params=PARAMS)
+	dbh.create_chat_if_not_exist(chat_id, hash)
+	key = password_key(hash)
+	dbh.create_record(chat_id, seal_record(b'plain', key), 5)
+	dbh.create_record(chat_id, seal_record(b'labelled', key), 8, seal_label('my note', key))
+	return hash
+
+def export(chat_id):
+	out = io.BytesIO()
+	archive.export_records(chat_id, dbh.get_password(chat_id), out)
+	return out.getvalue()
+
+def import_(chat_id, data, source_key=None):
+	stream = io.BytesIO(data)
+	header = archive.read_header(stream)
+	return archive.import_records(chat_id, password_key(dbh.get_password(chat_id)), stream, header, source_key)
+
+def contents(chat_id):
+	key = password_key(dbh.get_password(chat_id))
+	records = Record.select().where(Record.chat_uid == dbh.get_chat_uid(chat_id)).order_by(Record.id)
+	return [(open_record(r.version, r.data, r.payload, key), r.label and open_label(r.label, key)) for r in records]
+
+def found(chat_id, word):
+	key = password_key(dbh.get_password(chat_id))
+	return len(dbh.search_records(chat_id, label_tokens([word], key)))
+
+def test_round_trip(database):
+	hash = make_chat(1)
+	dbh.create_chat_if_not_exist(2, hash)
+	assert import_(2, export(1)) == 2
+	assert contents(2) == contents(1) == [(b'plain', None), (b'labelled', 'my note')]
+	assert found(2, 'note') == 1
+
+def test_archive_of_rotated_key_needs_its_password(database):
+	make_chat(1)
+	header = archive.read_header(io.BytesIO(export(1)))
+	dbh.create_chat_if_not_exist(2, hash_password('other', params=PARAMS))
+	assert not archive.made_with(header, dbh.get_password(2))
+	with pytest.raises(ValueError):
+		import_(2, export(1))
+	with pytest.raises(ValueError):
+		import_(2, export(1), crypto.derive_key('wrong', header[1], header[2]))
+
+	assert import_(2, export(1), crypto.derive_key('password', header[1], header[2])) == 2
+	assert contents(2) == [(b'plain', None), (b'labelled', 'my note')]
+	assert found(2, 'note') == 1
+
+@pytest.mark.parametrize('damage', [
+	lambda data: data[:-10],
+	lambda data: data[:len(data) // 2] + bytes(b ^ 0xff for b in data[len(data) // 2:len(data) // 2 + 8])
+				 + data[len(data) // 2 + 8:],
+	lambda data: data[:20],
+])
+def test_damaged_archive_imports_nothing(database, damage):
+	hash = make_chat(1)
+	dbh.create_chat_if_not_exist(2, hash)
+	with pytest.raises(ValueError):
+		import_(2, damage(export(1)))
+	assert dbh.count_records(2) == 0
+
+# Archive made before password-hash was upgraded is imported with its password, and re-encrypted with the new key
+def test_import_after_upgrade(dispatcher, feed, monkeypatch):
+	user = User(dispatcher.bot, CHAT_ID)
+	feed(dispatcher, [user.message('/start'), user.message(PASSWORD), user.message(PASSWORD),
+					  user.message(BTN_RECORD), user.message('old secret'), user.message(BTN_RECORD_SAVE)])
+	data = export(CHAT_ID)
+
+	old = dbh.get_password(CHAT_ID)
+	crypto.set_kdf_params(make_kdf_params(crypto.KDF_PBKDF2, i=KDF_ITERATIONS * 4))
+	feed(dispatcher, [user.message(BTN_LOGOUT), user.message(PASSWORD)])
+	assert dbh.get_password(CHAT_ID) != old
+
+	monkeypatch.setattr(main, 'open_file', lambda document: io.BytesIO(data))
+	feed(dispatcher, [document(user)])
+	assert main.conv_handler.conversations[(CHAT_ID, CHAT_ID)] == STATE_TYPING_ARCHIVE_PASSWORD
+	feed(dispatcher, [user.message(PASSWORD)])
+	assert main.conv_handler.conversations[(CHAT_ID, CHAT_ID)] == STATE_IDLE
+	# The stored record is re-encrypted in background
+	finish_rekey(CHAT_ID)
+	assert [plain for plain, _ in contents(CHAT_ID)] == [b'old secret', b'old secret']
+
+# Archive, whose ciphertext is damaged, is refused with a reply instead of failing the handler
+def test_import_of_corrupt_label(dispatcher, feed, monkeypatch):
+	user = User(dispatcher.bot, CHAT_ID)
+	feed(dispatcher, [user.message('/start'), user.message(PASSWORD), user.message(PASSWORD)])
+	dbh.create_record(CHAT_ID, seal_record(b'plain', password_key(dbh.get_password(CHAT_ID))), 5, (b'garbage', []))
+	data = export(CHAT_ID)
+
+	monkeypatch.setattr(main, 'open_file', lambda document: io.BytesIO(data))
+	replies = []
+	monkeypatch.setattr(main, 'reply', lambda upd, ctx, text, **kwargs: replies.append(text))
+	feed(dispatcher, [document(user)])
+	assert replies == ['Records could not be imported: archive is corrupted.']
+	assert dbh.count_records(CHAT_ID) == 1
+
+# Export does not wait for the upload: the archive file is closed once it is sent, failed upload is reported
+@pytest.mark.parametrize('error', [None, BadRequest('Request entity too large')])
+def test_export_is_sent_in_background(dispatcher, feed, monkeypatch, error):
+	user = User(dispatcher.bot, CHAT_ID)
+	feed(dispatcher, [user.message('/start'), user.message(PASSWORD), user.message(PASSWORD)])
+	make_chat(CHAT_ID)
+	documents = []
+	def send_document(chat_id, document, **kwargs):
+		documents.append((document, document.read()))
+		if error is not None:
+			raise error
+		return True
+	monkeypatch.setattr(dispatcher.bot, 'send_document', send_document)
+	replies = []
+	monkeypatch.setattr(main, 'reply', lambda upd, ctx, text, **kwargs: replies.append(text))
+
+	feed(dispatcher, [user.message('/export')])
+	[(document, data)] = documents
+	assert document.closed and data.startswith(archive.MAGIC)
+	assert replies == ([] if error is None else ['The archive could not be sent. Please try /export again later.'])
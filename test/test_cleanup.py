@@ -0,0 +1,56 @@
+from telegram.error import BadRequest, InvalidToken
+
+import outbox
+from cleanup import Cleaner
+
+class Request:
+	def __init__(self, error=None):
+		self.error = error
+		self.calls = []
+
+	def post(self, url, data):
+		self.calls.append(list(data['message_ids']))
+		if self.error is not None:
+			raise self.error
+		return True
+
+class Bot:
+	base_url = 'https://api.telegram.org/bot0'
+
+	def __init__(self, error=None):
+		self._request = Request(error)
+		self.deleted = []
+
+	def delete_message(self, chat_id, msg_id):
+		self.deleted.append(msg_id)
+		return True
+
+def cleaner(monkeypatch):
+	monkeypatch.setattr(outbox, 'scheduler', outbox.Outbox(rate=None, chat_rate=None))
+	return Cleaner(workers=2, batch=100)
+
+def test_messages_are_deleted_in_bulk(monkeypatch):
+	cleanup, bot = cleaner(monkeypatch), Bot()
+	cleanup.schedule(bot, 1, range(250))
+	cleanup.join()
+	assert sorted(len(ids) for ids in bot._request.calls) == [50, 100, 100]
+	assert sorted(sum(bot._request.calls, [])) == list(range(250))
+	assert bot.deleted == [] and cleanup.progress(1) is None
+
+# Bot API without deleteMessages answers 404, then messages are deleted one by one from now on
+def test_falls_back_to_single_deletions(monkeypatch):
+	cleanup, bot = cleaner(monkeypatch), Bot(InvalidToken())
+	cleanup.schedule(bot, 1, range(10))
+	cleanup.join()
+	assert not cleanup.bulk
+	assert sorted(bot.deleted) == list(range(10))
+	cleanup.schedule(bot, 1, range(10, 20))
+	cleanup.join()
+	assert len(bot._request.calls) == 1 and sorted(bot.deleted) == list(range(20))
+
+# Batch refused by bulk call (e.g. some messages are too old) is deleted one by one, bulk stays enabled
+def test_refused_batch_is_deleted_one_by_one(monkeypatch):
+	cleanup, bot = cleaner(monkeypatch), Bot(BadRequest('Message can\'t be deleted'))
+	cleanup.schedule(bot, 1, range(5))
+	cleanup.join()
+	assert cleanup.bulk and sorted(bot.deleted) == list(range(5))
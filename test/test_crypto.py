@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+import crypto
+from crypto import get_hash, get_cipher, forget_key, seal_label, open_label, open_labels, compress, decompress, \
+	seal_record, open_record, encrypt_string, CODEC_NONE, CODEC_ZLIB, CODEC_ZSTD
+
+KEY = get_hash('password')
+
+# One Fernet instance serves all messages of a key until the key is forgotten
+def test_cipher_is_reused():
+	assert get_cipher(KEY) is get_cipher(KEY.decode())
+	cipher = get_cipher(KEY)
+	forget_key(KEY)
+	assert get_cipher(KEY) is not cipher
+	assert crypto.ciphers.get(get_hash('other')) is None
+
+def test_open_labels():
+	labels = ['bank card', 'mail', '']
+	payloads = [seal_label(label, KEY)[0] for label in labels]
+	assert open_labels(payloads, KEY) == [open_label(payload, KEY) for payload in payloads] == labels
+
+# Small and incompressible records are stored as they are, large ones are compressed before encryption
+def test_compress():
+	assert compress(b'short') == bytes((CODEC_NONE,)) + b'short'
+	noise = os.urandom(4096)
+	assert compress(noise) == bytes((CODEC_NONE,)) + noise
+	text = b'password: hunter2\n' * 100
+	framed = compress(text)
+	assert framed[0] in (CODEC_ZLIB, CODEC_ZSTD) and len(framed) < len(text) // 4
+	assert decompress(framed) == text
+	with pytest.raises(ValueError):
+		decompress(b'\x09data')
+
+def test_records_of_both_versions_are_opened():
+	text = b'password: hunter2\n' * 100
+	payload = seal_record(text, KEY)
+	assert len(payload) < len(text) and open_record(2, None, payload, KEY) == text
+	assert open_record(1, encrypt_string('old record', KEY).decode(), None, KEY) == b'old record'
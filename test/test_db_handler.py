@@ -0,0 +1,83 @@
+import threading
+
+import db_handler as dbh
+
+# Chat is read from the database once, writes changing it are seen at once
+def test_chat_cache(database):
+	dbh.chat_cache.clear()
+	dbh.create_chat_if_not_exist(1, 'old')
+	uid = dbh.get_chat_uid(1)
+	assert dbh.get_password(1) == 'old'
+	assert dbh.cache_stats()['hits'] >= 1
+
+	dbh.set_password(1, 'new')
+	assert dbh.get_password(1) == 'new' and dbh.get_chat_uid(1) == uid
+	dbh.delete_chat(1)
+	assert dbh.get_chat_uid(1) is None and dbh.get_password(1) is None
+
+def pragmas():
+	return [dbh.db.execute_sql('PRAGMA {0}'.format(name)).fetchone()[0] for name in ('journal_mode', 'synchronous',
+																					 'busy_timeout')]
+
+# Pragmas of the profile are set on connections of every thread
+def test_tuning_profile(tmp_path):
+	dbh.init(str(tmp_path / 'tuned.db'), 'tuned')
+	try:
+		assert pragmas() == ['wal', 1, 5000]
+		seen = []
+		thread = threading.Thread(target=lambda: (seen.append(pragmas()), dbh.close()))
+		thread.start()
+		thread.join()
+		assert seen == [['wal', 1, 5000]]
+	finally:
+		dbh.close()
+
+	dbh.init(str(tmp_path / 'default.db'), 'default')
+	try:
+		assert pragmas()[:2] == ['delete', 2]
+	finally:
+		dbh.close()
+
+# Records submitted together are committed by few transactions, each of them gets its own result
+def test_record_batcher(database):
+	batcher = dbh.RecordBatcher(window=0.5, max_rows=10)
+	batches = []
+	commit = batcher._commit
+	batcher._commit = lambda batch: (batches.append(len(batch)), commit(batch))
+	dbh.create_chat_if_not_exist(1)
+	futures = [batcher.submit(1 + i % 2, b'payload', 7) for i in range(25)]
+	batcher.flush()
+	assert [future.result() for future in futures] == [1] * 25
+	assert batches == [10, 10, 5]
+	# Chat 2 is created by the batcher
+	assert (dbh.count_records(1), dbh.count_records(2)) == (13, 12)
+
+# Chat is created once, by whichever call comes first
+def test_chat_lookup(database):
+	assert dbh.get_chat_uid(1) is None
+	assert dbh.create_chat_if_not_exist(1, 'hash') == 1
+	assert dbh.create_chat_if_not_exist(1, 'other') == 0
+	assert dbh.get_password(1) == 'hash'
+	uid = dbh.ensure_chat_uid(2)
+	assert uid is not None and dbh.ensure_chat_uid(2) == uid != dbh.get_chat_uid(1)
+	assert dbh.get_password(2) is None
+
+# Pages follow each other newest first by (timestamp, id), records with equal timestamps are neither lost nor repeated
+def test_keyset_pages(database, monkeypatch):
+	dbh.create_chat_if_not_exist(1)
+	timestamps = iter([100, 100, 100, 200, 200, 300, 400])
+	monkeypatch.setattr(dbh, 'timestamp_now', lambda: next(timestamps))
+	for _ in range(7):
+		dbh.create_record(1, b'payload', 7)
+	everything = [r['uid'] for r in sorted(dbh.get_records_overview(1), key=lambda r: (r['timestamp'], r['uid']),
+											 reverse=True)]
+
+	pages = [dbh.get_records_page(1, limit=3)]
+	while len(pages[-1]) == 3:
+		last = pages[-1][-1]
+		pages.append(dbh.get_records_page(1, after=(last['timestamp'], last['uid']), limit=3))
+	assert [r['uid'] for page in pages for r in page] == everything
+	assert [len(page) for page in pages] == [3, 3, 1]
+
+	first = pages[1][0]
+	assert dbh.get_records_page(1, before=(first['timestamp'], first['uid']), limit=3) == pages[0]
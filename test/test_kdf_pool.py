@@ -0,0 +1,31 @@
+import threading
+
+import pytest
+
+from kdf_pool import KdfPool
+
+# Jobs over the limits are refused at once instead of queueing, finished jobs free their slots
+def test_admission_is_bounded():
+	pool = KdfPool(kind='thread', workers=2, queue_limit=3, per_chat_limit=2)
+	gate = threading.Event()
+	try:
+		futures = [pool.submit(1, gate.wait, 5), pool.submit(1, gate.wait, 5)]
+		assert pool.submit(1, gate.wait, 5) is None
+		futures.append(pool.submit(2, gate.wait, 5))
+		assert pool.submit(3, gate.wait, 5) is None
+		assert (pool.pending(), pool.pending(1), pool.pending(2)) == (3, 2, 1)
+		gate.set()
+		assert all(future.result(5) for future in futures)
+	finally:
+		gate.set()
+		pool.shutdown()
+	assert pool.pending() == 0
+
+def test_inline_pool():
+	pool = KdfPool(kind='inline', queue_limit=1)
+	assert pool.submit(1, len, 'abc').result() == 3
+	with pytest.raises(ZeroDivisionError):
+		pool.submit(1, divmod, 1, 0).result()
+	assert pool.pending() == 0
+	with pytest.raises(ValueError):
+		KdfPool(kind='fiber')
@@ -0,0 +1,24 @@
+import threading
+
+import outbox
+import db_handler as dbh
+from cleanup import cleaner
+from load_test import User, FakeBot, RECORDS, drive
+
+# Interleaved sessions of several drivers go through the real handlers, as the load test drives them
+def test_sessions_are_driven(dispatcher):
+	chats, drivers = 8, 2
+	latencies = []
+	threads = [threading.Thread(target=drive, args=(dispatcher, range(1 + i, chats + 1, drivers), latencies))
+			   for i in range(drivers)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	dbh.record_batcher.flush()
+	outbox.scheduler.join()
+	cleaner.join()
+
+	assert len(latencies) == chats * len(list(User(FakeBot(), 0).session()))
+	assert [dbh.count_records(chat_id) for chat_id in range(1, chats + 1)] == [RECORDS] * chats
+	assert dispatcher.bot.calls['sendMessage'] > 0
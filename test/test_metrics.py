@@ -0,0 +1,62 @@
+import urllib.request
+
+import pytest
+
+import metrics
+from metrics import Registry, timed
+
+@pytest.fixture
+def registry(monkeypatch):
+	registry = Registry(buckets=(0.1, 1.))
+	monkeypatch.setattr(metrics, 'registry', registry)
+	return registry
+
+def test_render(registry):
+	registry.inc('records', chat='1')
+	registry.inc('records', 2, chat='1')
+	registry.observe('handler', 0.05, fn='start')
+	registry.observe('handler', 0.5, fn='start')
+	registry.observe('handler', 5., fn='start')
+	assert registry.render().splitlines() == [
+		'# TYPE securestore_records_total counter',
+		'securestore_records_total{chat="1"} 3',
+		'# TYPE securestore_handler_seconds histogram',
+		'securestore_handler_seconds_bucket{fn="start",le="0.1"} 1',
+		'securestore_handler_seconds_bucket{fn="start",le="1.0"} 2',
+		'securestore_handler_seconds_bucket{fn="start",le="+Inf"} 3',
+		'securestore_handler_seconds_sum{fn="start"} 5.550000',
+		'securestore_handler_seconds_count{fn="start"} 3',
+	]
+
+# Disabled metrics leave functions as they are, enabled ones count calls and errors
+def test_timed(registry):
+	def fail():
+		raise ValueError()
+	assert timed('handler', enabled=False)(fail) is fail
+	with pytest.raises(ValueError):
+		timed('handler', enabled=True)(fail)()
+	counters, timers = registry.snapshot()
+	assert counters == {('handler_errors', (('fn', 'fail'),)): 1}
+	assert timers[('handler', (('fn', 'fail'),))][0] == 1
+
+def test_queries_are_counted(registry, database):
+	import db_handler as dbh
+	execute_sql = dbh.db.execute_sql
+	metrics.instrument_db(dbh.db)
+	try:
+		dbh.create_chat_if_not_exist(1, 'hash')
+		dbh.get_chat_uid(1)
+	finally:
+		dbh.db.execute_sql = execute_sql
+	_, timers = registry.snapshot()
+	assert timers[('db_query', (('statement', 'INSERT'),))][0] == 1
+	assert timers[('db_query', (('statement', 'SELECT'),))][0] >= 1
+
+def test_serve(registry):
+	registry.inc('records')
+	server = metrics.serve(port=0, host='127.0.0.1')
+	try:
+		url = 'http://127.0.0.1:{0}/metrics'.format(server.server_address[1])
+		assert 'securestore_records_total 1' in urllib.request.urlopen(url).read().decode()
+	finally:
+		server.shutdown()
@@ -0,0 +1,29 @@
+from msg_ids import MsgIds
+
+def test_consecutive_ids_make_runs():
+	ids = MsgIds([5, 6, 7, 10, 11, 3])
+	assert list(ids) == [5, 6, 7, 10, 11, 3]
+	assert len(ids) == 6
+	assert ids.runs() == [[5, 3], [10, 2], [3, 1]]
+	assert list(MsgIds.from_runs(ids.runs())) == list(ids)
+
+# The oldest ids are evicted over cap, evicted runs are compacted away
+def test_cap_evicts_oldest():
+	ids = MsgIds([1, 2, 3, 10, 20, 21], cap=4)
+	assert list(ids) == [3, 10, 20, 21]
+	for msg_id in range(30, 34):
+		ids.append(msg_id)
+	assert list(ids) == [30, 31, 32, 33]
+	assert ids.runs() == [[30, 4]]
+	assert list(MsgIds.from_runs([[1, 5], [9, 2]], cap=3)) == [5, 9, 10]
+
+# Accounting callback sees every change of the storage, so its sum is what is occupied
+def test_accounting(monkeypatch):
+	total = []
+	monkeypatch.setattr(MsgIds, 'accounting', total.append)
+	ids = MsgIds(range(100, 110), cap=5)
+	ids.append(200)
+	ids.append(300)
+	assert sum(total) == ids.nbytes() > 0
+	ids.clear()
+	assert sum(total) == 0 and len(ids) == 0
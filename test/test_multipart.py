@@ -0,0 +1,53 @@
+import main, outbox
+import db_handler as dbh
+from db_handler import Record, RecordChunk
+from crypto import get_hash, new_stream_header, encrypt_chunks, decrypt_chunks, open_record, password_key
+from load_test import User, PASSWORD
+from session_timer import InactivityTracker
+from constants import *
+
+CHAT_ID = 1
+
+# A record left unfinished by the inactivity alarm (upload with label) must not be saved instead of the next one
+def test_alarm_drops_unfinished_upload(dispatcher, clock, feed, monkeypatch):
+	monkeypatch.setattr(main, 'inactivity', InactivityTracker(clock=clock))
+	user = User(dispatcher.bot, CHAT_ID)
+	feed(dispatcher, [user.message('/start'), user.message(PASSWORD), user.message(PASSWORD),
+					  user.message(BTN_RECORD), user.message(BTN_RECORD_PARTS), user.message('old part'),
+					  user.message(BTN_FINISH), user.message(BTN_RECORD_LABEL), user.message('old label')])
+	assert RecordChunk.select().count() == 2
+
+	clock.now += DEFAULT_UNAUTH_TIMER + SESSION_WHEEL_TICK + 1
+	main.sweep_inactive(None)
+	outbox.scheduler.join()
+	assert RecordChunk.select().count() == 0
+
+	feed(dispatcher, [user.message(PASSWORD), user.message(BTN_RECORD), user.message('new text'),
+					  user.message(BTN_RECORD_SAVE)])
+	records = list(Record.select())
+	assert len(records) == 1
+	assert records[0].chunks == 0 and records[0].label is None
+	key = password_key(dbh.get_password(CHAT_ID))
+	assert open_record(records[0].version, records[0].data, records[0].payload, key) == b'new text'
+
+def test_finish_upload_refuses_unsealed_stream(database):
+	key = get_hash('password')
+	header = new_stream_header()
+	dbh.append_chunks('open', 0, encrypt_chunks(key, header, 0, [b'part']))
+	assert dbh.finish_upload(CHAT_ID, 'open', header, 4) == 0
+
+	dbh.append_chunks('sealed', 0, encrypt_chunks(key, header, 0, [b'part']))
+	dbh.append_chunks('sealed', 1, encrypt_chunks(key, header, 1, [b''], last=True), last=True)
+	assert dbh.finish_upload(CHAT_ID, 'sealed', header, 4) == 1
+	assert Record.select().where(Record.chunks == 2).count() == 1
+
+# Record sent in parts is read back chunk by chunk, in order
+def test_record_is_read_back(dispatcher, feed):
+	user = User(dispatcher.bot, CHAT_ID)
+	feed(dispatcher, [user.message('/start'), user.message(PASSWORD), user.message(PASSWORD),
+					  user.message(BTN_RECORD), user.message(BTN_RECORD_PARTS), user.message('first part'),
+					  user.message('second'), user.message(BTN_FINISH), user.message(BTN_RECORD_SAVE)])
+	record = Record.get()
+	key = password_key(dbh.get_password(CHAT_ID))
+	assert b''.join(decrypt_chunks(key, record.header, dbh.iter_chunks(record.id))) == b'first partsecond'
+	assert record.chunks == RecordChunk.select().count() == 3
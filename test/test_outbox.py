@@ -0,0 +1,60 @@
+import threading, time
+
+from outbox import Outbox, TokenBucket, PRIORITY_AUTH, PRIORITY_NORMAL, PRIORITY_CLEANUP
+
+# Calls of a chat are made in order whatever their priority, which only lets the chat go before other chats
+def test_chat_keeps_order_of_calls():
+	outbox = Outbox(workers=1, rate=None, chat_rate=None)
+	gate = threading.Event()
+	made = []
+	outbox.call(0, gate.wait)
+	outbox.call(1, made.append, 'a1')
+	outbox.call(1, made.append, 'a2', priority=PRIORITY_AUTH)
+	outbox.call(1, made.append, 'a-cleanup', priority=PRIORITY_CLEANUP, per_chat=False)
+	outbox.call(2, made.append, 'b1', priority=PRIORITY_NORMAL)
+	outbox.call(3, made.append, 'c1', priority=PRIORITY_AUTH)
+	gate.set()
+	assert outbox.join(5)
+	assert made == ['a1', 'c1', 'a2', 'b1', 'a-cleanup']
+
+def test_token_bucket():
+	bucket = TokenBucket(2, 2)
+	now = time.monotonic()
+	assert bucket.delay(now) == 0
+	bucket.take()
+	bucket.take()
+	assert bucket.delay(now) == 0.5
+	assert not bucket.full(now)
+	assert bucket.delay(now + 0.5) == 0
+	assert bucket.full(now + 1)
+
+	unlimited = TokenBucket(None, 1)
+	unlimited.take()
+	assert unlimited.delay(now) == 0 and unlimited.full(now)
+
+# Chat out of tokens waits, while other chats go on
+def test_chat_rate_lets_other_chats_go():
+	outbox = Outbox(workers=1, rate=None, chat_rate=20, chat_burst=1)
+	made = []
+	outbox.call(1, made.append, 'a1')
+	outbox.call(1, made.append, 'a2')
+	outbox.call(2, made.append, 'b1')
+	assert outbox.join(5)
+	assert made == ['a1', 'b1', 'a2']
+
+# Only the latest of waiting calls with the same coalesce key is made, all callers get its result
+def test_waiting_calls_are_coalesced():
+	outbox = Outbox(workers=1, rate=None, chat_rate=None)
+	gate = threading.Event()
+	made = []
+	def edit(text):
+		made.append(text)
+		return text
+	outbox.call(1, gate.wait)
+	first = outbox.call(1, edit, 'page 1', coalesce=('edit', 1, 5))
+	second = outbox.call(1, edit, 'page 2', coalesce=('edit', 1, 5))
+	other = outbox.call(1, edit, 'other', coalesce=('edit', 1, 6))
+	gate.set()
+	assert outbox.join(5)
+	assert made == ['page 2', 'other']
+	assert first is second and first.result() == 'page 2' and other.result() == 'other'
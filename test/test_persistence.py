@@ -0,0 +1,64 @@
+import json
+
+import main, outbox, persistence
+import db_handler as dbh
+from load_test import User, PASSWORD
+from persistence import deserialize_chat_data
+from session_timer import InactivityTracker
+from constants import *
+
+CHAT_ID = 1
+
+def saved_state():
+	dbh.record_batcher.flush()
+	return deserialize_chat_data(dbh.load_chat_state(CHAT_ID))
+
+def saved_conversation():
+	return dbh.load_conversation('main', json.dumps([CHAT_ID, CHAT_ID]))
+
+# Alarm raised by the job thread after the last update of the chat must survive restart
+def test_alarm_is_persisted(persistent_dispatcher, clock, feed, monkeypatch):
+	dp = persistent_dispatcher
+	monkeypatch.setattr(main, 'inactivity', InactivityTracker(clock=clock))
+	user = User(dp.bot, CHAT_ID)
+	feed(dp, [user.message('/start'), user.message(PASSWORD), user.message(PASSWORD)])
+	dp.persistence.flush()
+	assert saved_state()['password_mode'] == MODE_PWD_AUTHORIZED
+
+	clock.now += DEFAULT_UNAUTH_TIMER + SESSION_WHEEL_TICK + 1
+	main.sweep_inactive(None)
+	outbox.scheduler.join()
+	dp.persistence.flush()
+	state = saved_state()
+	assert state['password_mode'] == MODE_PWD_TEST and state.get('authorized') is None
+	assert saved_conversation() == STATE_TYPING_PASSWORD
+
+# Chat, whose end of authorization was lost, is asked for password instead of being served
+def test_unauthorized_chat_is_asked_for_password(dispatcher, feed):
+	user = User(dispatcher.bot, CHAT_ID)
+	feed(dispatcher, [user.message('/start'), user.message(PASSWORD), user.message(PASSWORD)])
+	chat_data = dispatcher.chat_data[CHAT_ID]
+	chat_data['password_mode'] = None
+	chat_data['authorized'] = None
+	main.inactivity.cancel(CHAT_ID)
+
+	feed(dispatcher, [user.message(BTN_RECORD)])
+	assert chat_data['password_mode'] == MODE_PWD_TEST
+	assert main.conv_handler.conversations[(CHAT_ID, CHAT_ID)] == STATE_TYPING_PASSWORD
+
+# Unchanged state is not written again, and digests of flushed states are kept for a bounded number of chats
+def test_unchanged_state_is_not_written(database, monkeypatch):
+	monkeypatch.setattr(persistence, 'PERSISTENCE_FLUSHED_CACHE', 2)
+	store = persistence.SqlitePersistence()
+	written = []
+	save_chat_states = dbh.save_chat_states
+	monkeypatch.setattr(dbh, 'save_chat_states', lambda states: (written.append(sorted(states)), save_chat_states(states)))
+	for chat_id in (1, 2, 3):
+		store.update_chat_data(chat_id, {'password_mode': MODE_PWD_AUTHORIZED})
+	store.flush()
+	store.update_chat_data(3, {'password_mode': MODE_PWD_AUTHORIZED})
+	store.update_chat_data(2, {'password_mode': MODE_PWD_TEST})
+	store.flush()
+	assert written == [[1, 2, 3], [2]]
+	assert store._flushed.stats()['size'] == 2
+	assert deserialize_chat_data(dbh.load_chat_state(2))['password_mode'] == MODE_PWD_TEST
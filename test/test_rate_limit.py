@@ -0,0 +1,47 @@
+import db_handler as dbh
+from rate_limit import LoginLimiter
+
+def limiter(clock, store=None):
+	return LoginLimiter(rate=0.5, burst=2, backoff=2, backoff_max=5, forget_after=100, store=store, clock=clock)
+
+def test_attempts_are_throttled(clock):
+	logins = limiter(clock)
+	assert logins.check(1) == logins.check(1) == 0
+	assert logins.check(1) == 2
+	assert logins.check(2) == 0
+	clock.now += 1
+	assert logins.check(1) == 1
+	clock.now += 1
+	assert logins.check(1) == 0
+
+# Every wrong password doubles the time chat is blocked for, up to the max, and login forgets them
+def test_backoff(clock):
+	logins = limiter(clock)
+	assert logins.failed(1) == 2
+	assert logins.check(1) == 2
+	assert logins.failed(1) == 4
+	assert logins.failed(1) == 5
+	clock.now += 5
+	assert logins.check(1) == 0
+	logins.succeeded(1)
+	assert logins.failed(1) == 2
+
+def test_prune(clock):
+	logins = limiter(clock)
+	logins.check(1)
+	logins.failed(2)
+	clock.now += 4
+	assert logins.prune() == 1 and len(logins) == 1
+	clock.now += 100
+	assert logins.prune() == 1 and len(logins) == 0
+
+# Wrong passwords are remembered in the database, so a new limiter (restarted bot) keeps the chat blocked
+def test_backoff_survives_restart(database, clock):
+	logins = limiter(clock, dbh)
+	logins.failed(1)
+	logins.failed(1)
+	restarted = limiter(clock, dbh)
+	assert restarted.check(1) == 4
+	assert restarted.failed(1) == 5
+	logins.succeeded(1)
+	assert dbh.load_login_attempt(1) is None
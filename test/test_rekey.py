@@ -0,0 +1,80 @@
+import main
+import db_handler as dbh
+from db_handler import Record, Rekey
+from crypto import hash_password, password_key, seal_record, seal_label, open_record, open_label, label_tokens, \
+	new_stream_header, encrypt_chunks, decrypt_chunks, make_kdf_params, KDF_PBKDF2
+from rekey import start_rekey, rekey_batch, finish_rekey, rekey_pending
+from load_test import User, PASSWORD, KDF_ITERATIONS
+
+CHAT_ID = 1
+
+PARAMS = make_kdf_params(KDF_PBKDF2, i=KDF_ITERATIONS)
+
+def fill(key, records):
+	for i in range(records):
+		dbh.create_record(CHAT_ID, seal_record('secret {0}'.format(i).encode(), key), 8,
+						  seal_label('note {0}'.format(i), key) if i % 2 else None)
+	header = new_stream_header()
+	dbh.append_chunks('upload', 0, encrypt_chunks(key, header, 0, [b'one', b'two']))
+	dbh.append_chunks('upload', 2, encrypt_chunks(key, header, 2, [b''], last=True), last=True)
+	dbh.finish_upload(CHAT_ID, 'upload', header, 6)
+
+def contents(key):
+	result = []
+	for record in Record.select().order_by(Record.id):
+		if record.header is not None:
+			result.append(b''.join(decrypt_chunks(key, record.header, dbh.iter_chunks(record.id))))
+		else:
+			result.append(open_record(record.version, record.data, record.payload, key))
+		if record.label is not None:
+			result.append(open_label(record.label, key))
+	return result
+
+# Records are re-encrypted in bounded batches, records added meanwhile are already encrypted with the new key
+def test_rekey_in_batches(database):
+	old, new = hash_password('password', params=PARAMS), hash_password('password', params=PARAMS)
+	dbh.create_chat_if_not_exist(CHAT_ID, old)
+	fill(password_key(old), 10)
+	expected = contents(password_key(old))
+
+	start_rekey(CHAT_ID, old, new)
+	assert dbh.get_password(CHAT_ID) == new.decode()
+	dbh.create_record(CHAT_ID, seal_record(b'added', password_key(new)), 5)
+	batches = 1
+	while rekey_batch(CHAT_ID, batch=3):
+		batches += 1
+	assert batches == 6		# 11 records and 3 chunks
+	assert Rekey.select().count() == 0
+
+	assert contents(password_key(new)) == expected + [b'added']
+	assert len(dbh.search_records(CHAT_ID, label_tokens(['note', '3'], password_key(new)))) == 1
+
+# Interrupted re-encryption is finished before the next one starts
+def test_rekey_resumes(database):
+	first, second, third = (hash_password('password', params=PARAMS) for _ in range(3))
+	dbh.create_chat_if_not_exist(CHAT_ID, first)
+	fill(password_key(first), 5)
+	expected = contents(password_key(first))
+
+	start_rekey(CHAT_ID, first, second)
+	rekey_batch(CHAT_ID, batch=2)
+	start_rekey(CHAT_ID, second, third)
+	finish_rekey(CHAT_ID)
+	assert contents(password_key(third)) == expected
+
+# Search is refused while records are under two keys, and re-encryption goes on in background meanwhile
+def test_search_waits_for_rekey(dispatcher, feed, monkeypatch):
+	user = User(dispatcher.bot, CHAT_ID)
+	feed(dispatcher, [user.message('/start'), user.message(PASSWORD), user.message(PASSWORD)])
+	old = dbh.get_password(CHAT_ID).encode()
+	dbh.create_record(CHAT_ID, seal_record(b'plain', password_key(old)), 5, seal_label('bank card', password_key(old)))
+	start_rekey(CHAT_ID, old, hash_password(PASSWORD, params=PARAMS))
+
+	replies = []
+	monkeypatch.setattr(main, 'reply', lambda upd, ctx, text, **kwargs: replies.append(text))
+	feed(dispatcher, [user.message('/search bank')])
+	assert replies[-1].startswith('Your records are still being re-encrypted')
+	finish_rekey(CHAT_ID)
+	assert not rekey_pending(CHAT_ID)
+	feed(dispatcher, [user.message('/search bank')])
+	assert replies[-1].startswith('Found records') and replies[-1].endswith('bank card')
@@ -0,0 +1,19 @@
+from load_test import User, FakeBot
+from router import ButtonRouter
+
+def test_buttons_are_routed():
+	user = User(FakeBot(), 1)
+	record, browse_back, fallback = (lambda upd, ctx: 'record'), (lambda upd, ctx: 'back'), (lambda upd, ctx: 'text')
+	router = ButtonRouter({'Add record': record, 'browse_back': browse_back}, fallback)
+	assert router.check_update(user.message('Add record')) is record
+	assert router.check_update(user.click('browse_back')) is browse_back
+	assert router.check_update(user.message('Add')) is fallback
+	assert router.check_update(user.click('unknown')) is None
+	assert router.check_update('not an update') is None
+	assert router.handle_update(user.message('Add record'), None, record, None) == 'record'
+
+# State without fallback leaves unknown text to its other handlers
+def test_no_fallback():
+	user = User(FakeBot(), 1)
+	router = ButtonRouter({'Add record': lambda upd, ctx: None})
+	assert router.check_update(user.message('something')) is None
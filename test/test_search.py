@@ -0,0 +1,37 @@
+import db_handler as dbh
+from db_handler import Record, RecordToken
+from crypto import get_hash, seal_record, seal_label, open_label, label_words, label_tokens
+
+KEY = get_hash('password')
+
+def add(chat_id, label, key=KEY):
+	dbh.create_record(chat_id, seal_record(b'secret', key), 6, seal_label(label, key))
+
+def found(chat_id, query, key=KEY):
+	return sorted(open_label(r['label'], key) for r in dbh.search_records(chat_id, label_tokens(label_words(query), key)))
+
+def test_label_words():
+	assert label_words('Bank card, bank PIN!') == ['bank', 'card', 'pin']
+	assert label_tokens(['bank'], KEY) == label_tokens(['bank'], KEY) != label_tokens(['bank'], get_hash('other'))
+
+# Records are found by all words of the query, in any case and order, and only in their own chat
+def test_search(database):
+	for chat_id in (1, 2):
+		dbh.create_chat_if_not_exist(chat_id)
+	add(1, 'Bank card')
+	add(1, 'bank account')
+	add(1, 'mail')
+	add(2, 'bank card')
+	assert found(1, 'BANK') == ['Bank card', 'bank account']
+	assert found(1, 'card bank') == ['Bank card']
+	assert found(1, 'bank mail') == [] and found(1, '') == []
+	assert found(2, 'bank') == ['bank card']
+
+# Neither labels nor their words are stored in clear
+def test_index_is_blind(database):
+	dbh.create_chat_if_not_exist(1)
+	add(1, 'bank card')
+	for label, in Record.select(Record.label).tuples():
+		assert b'bank' not in label
+	tokens = [token for token, in RecordToken.select(RecordToken.token).tuples()]
+	assert len(tokens) == 2 and all(b'bank' not in bytes(token) and b'card' not in bytes(token) for token in tokens)
@@ -0,0 +1,55 @@
+from session_timer import InactivityTracker
+
+def tracker(clock):
+	return InactivityTracker(slots=8, tick=1, clock=clock)
+
+def test_touch_and_cancel(clock):
+	sessions = tracker(clock)
+	sessions.touch(1, 5, 'one')
+	sessions.touch(2, 5, 'two')
+	assert 1 in sessions and len(sessions) == 2
+	assert sessions.cancel(2) and not sessions.cancel(2)
+	clock.now += 4.5
+	assert sessions.sweep() == []
+	assert 1 in sessions and 2 not in sessions
+
+# Touch moves the deadline, so the session does not expire at the old one
+def test_touch_moves_deadline(clock):
+	sessions = tracker(clock)
+	sessions.touch(1, 5, 'first')
+	clock.now += 3
+	sessions.touch(1, 5, 'second')
+	assert len(sessions) == 1
+	clock.now += 2
+	assert sessions.sweep() == []
+	clock.now += 3
+	assert sessions.sweep() == [(1, 'second')]
+	assert len(sessions) == 0
+
+# Session expires by the sweep made exactly at its deadline, deadline between ticks - by the sweep of the next tick
+def test_expiry_at_deadline(clock):
+	sessions = tracker(clock)
+	sessions.touch(1, 5)
+	sessions.touch(2, 5.5)
+	clock.now += 4.9
+	assert sessions.sweep() == []
+	clock.now += 0.1
+	assert sessions.sweep() == [(1, None)]
+	clock.now += 0.5
+	assert sessions.sweep() == []
+	clock.now += 0.5
+	assert sessions.sweep() == [(2, None)]
+
+# Deadline further than the wheel span waits for its round, and a sweep after a long gap visits every slot
+def test_expiry_after_long_gap(clock):
+	sessions = tracker(clock)
+	sessions.touch(1, 3)
+	sessions.touch(2, 20)
+	clock.now += 4
+	assert sessions.sweep() == [(1, None)]
+	clock.now += 8
+	assert sessions.sweep() == []
+	sessions.touch(3, 2)
+	clock.now += 100
+	assert sorted(sessions.sweep()) == [(2, None), (3, None)]
+	assert len(sessions) == 0
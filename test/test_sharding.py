@@ -0,0 +1,49 @@
+import pytest
+
+import db_handler as dbh
+from crypto import get_hash, seal_record, seal_label, label_tokens
+from sharding import shard_db_path, shard_of, load_overrides, save_overrides
+from rebalance import move_chat
+
+KEY = get_hash('password')
+
+def test_shard_map(tmp_path):
+	path = str(tmp_path / 'shards.json')
+	assert load_overrides(path, 4) == {}
+	save_overrides({5: 3}, path, 4)
+	overrides = load_overrides(path, 4)
+	assert overrides == {5: 3}
+	assert (shard_of(5, overrides, 4), shard_of(6, overrides, 4)) == (3, 2)
+	with pytest.raises(ValueError):
+		load_overrides(path, 8)
+
+def fill_shard(shard, chat_id):
+	dbh.init(shard_db_path(shard))
+	dbh.create_chat_if_not_exist(chat_id, KEY.decode())
+	dbh.create_record(chat_id, seal_record(b'secret', KEY), 6, seal_label('bank card', KEY))
+	dbh.create_record(chat_id, seal_record(b'other', KEY), 5)
+	dbh.close()
+
+def records(shard, chat_id):
+	dbh.init(shard_db_path(shard))
+	try:
+		return dbh.count_records(chat_id), len(dbh.search_records(chat_id, label_tokens(['bank'], KEY)))
+	finally:
+		dbh.close()
+
+# Chat moves with its records and index, the map follows it, and a repeated move changes nothing
+def test_move_chat(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	fill_shard(1, 5)
+	fill_shard(2, 6)
+	assert move_chat(5, 3, count=4) == 2
+	assert load_overrides(count=4) == {5: 3}
+	assert records(3, 5) == (2, 1) and records(1, 5) == (0, 0)
+	assert move_chat(5, 3, count=4) is None
+	assert records(3, 5) == (2, 1)
+
+	assert move_chat(5, 1, count=4) == 2
+	assert load_overrides(count=4) == {}
+	assert records(1, 5) == (2, 1) and records(3, 5) == (0, 0) and records(2, 6) == (2, 1)
+	with pytest.raises(ValueError):
+		move_chat(7, 0, count=4)
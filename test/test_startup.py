@@ -0,0 +1,39 @@
+import os, subprocess, sys
+
+import pytest
+
+import db_handler as dbh
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Database made by the current schema is opened without creating anything
+def test_schema_is_checked_once(tmp_path, monkeypatch):
+	path = str(tmp_path / 'test.db')
+	dbh.init(path)
+	assert dbh.db.execute_sql('PRAGMA user_version').fetchone()[0] == dbh.schema_version()
+	dbh.close()
+
+	monkeypatch.setattr(dbh.db, 'create_tables', lambda models: pytest.fail('tables are created again'))
+	dbh.init(path)
+	dbh.close()
+
+# Columns missing from tables made by an older version are added
+def test_missing_columns_are_added(tmp_path):
+	path = str(tmp_path / 'test.db')
+	dbh.init(path)
+	dbh.db.execute_sql('ALTER TABLE record DROP COLUMN label')
+	dbh.db.execute_sql('PRAGMA user_version = 0')
+	dbh.close()
+
+	dbh.init(path)
+	try:
+		assert 'label' in [c.name for c in dbh.db.get_columns('record')]
+	finally:
+		dbh.close()
+
+# Modules used by tools do not import heavy dependencies until they are needed
+def test_lazy_imports():
+	code = 'import sys, crypto, metrics, db_handler; print(sorted(m for m in ("cryptography", "telegram", "zstandard") ' \
+		   'if m in sys.modules))'
+	output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, stdout=subprocess.PIPE, check=True).stdout
+	assert output.decode().strip() == '[]'
@@ -0,0 +1,33 @@
+from util import LruCache
+
+def test_least_recently_used_is_evicted():
+	cache = LruCache(2)
+	cache.put('a', 1)
+	cache.put('b', 2)
+	assert cache.get('a') == 1
+	cache.put('c', 3)
+	assert cache.get('b') is None
+	assert (cache.get('a'), cache.get('c')) == (1, 3)
+	assert cache.stats() == {'size': 2, 'hits': 3, 'misses': 1, 'evictions': 1}
+
+# Value read before an invalidation is not cached after it, so a racing reader cannot bring stale value back
+def test_invalidation_refuses_stale_put():
+	cache = LruCache(10)
+	cache.put('a', 'old')
+	generation = cache.generation()
+	assert cache.invalidate('a')
+	assert not cache.put('a', 'old', generation)
+	assert cache.get('a') is None
+	assert cache.put('a', 'new', cache.generation())
+	assert cache.get('a') == 'new'
+
+	generation = cache.generation()
+	cache.clear()
+	assert not cache.put('b', 'old', generation)
+	assert cache.stats()['size'] == 0
+
+def test_expired_entry_is_dropped():
+	cache = LruCache(10, ttl=0)
+	cache.put('a', 1)
+	assert cache.get('a', 'missing') == 'missing'
+	assert cache.stats()['size'] == 0
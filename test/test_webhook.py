@@ -0,0 +1,58 @@
+import http.client, json
+
+from load_test import FakeBot
+from webhook import WebhookServer, webhook_path, webhook_secret
+
+class Sink:
+	def __init__(self):
+		self.updates = []
+
+	def process_update(self, update):
+		self.updates.append(update.update_id)
+
+BODY = json.dumps({'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'text': 'hi',
+											   'chat': {'id': 1, 'type': 'private'}}}).encode()
+
+def post(server, path, headers, length=None):
+	connection = http.client.HTTPConnection('127.0.0.1', server.port)
+	connection.putrequest('POST', path)
+	for name, value in dict(headers, **{'Content-Type': 'application/json'}).items():
+		connection.putheader(name, value)
+	connection.putheader('Content-Length', str(len(BODY)) if length is None else length)
+	connection.endheaders(BODY)
+	status = connection.getresponse().status
+	connection.close()
+	return status
+
+# Requests are accepted only at the path and with the secret token derived from the bot token
+def test_requests_need_secret_token():
+	bot = FakeBot()
+	path, secret = webhook_path(bot.token), webhook_secret(bot.token)
+	assert path != '/webhook' and secret not in (path, bot.token)
+	sink = Sink()
+	server = WebhookServer(sink, bot, host='127.0.0.1', port=0)
+	server.start()
+	try:
+		assert post(server, '/webhook', {'X-Telegram-Bot-Api-Secret-Token': secret}) == 404
+		assert post(server, path, {}) == 403
+		assert post(server, path, {'X-Telegram-Bot-Api-Secret-Token': secret[:-1] + 'x'}) == 403
+		assert post(server, path, {'X-Telegram-Bot-Api-Secret-Token': secret}) == 200
+	finally:
+		server.stop()
+	assert sink.updates == [1]
+
+# Declared size of the body is checked before it is read, and only after the secret token
+def test_body_size_is_checked():
+	bot = FakeBot()
+	path, secret = webhook_path(bot.token), webhook_secret(bot.token)
+	sink = Sink()
+	server = WebhookServer(sink, bot, host='127.0.0.1', port=0)
+	server.start()
+	try:
+		assert post(server, path, {}, length=str(1 << 40)) == 403
+		assert post(server, path, {'X-Telegram-Bot-Api-Secret-Token': secret}, length=str(1 << 40)) == 413
+		assert post(server, path, {'X-Telegram-Bot-Api-Secret-Token': secret}, length='many') == 400
+		assert post(server, path, {'X-Telegram-Bot-Api-Secret-Token': secret}, length='-5') == 400
+	finally:
+		server.stop()
+	assert sink.updates == []
@@ -1,4 +1,4 @@
-import datetime
+import datetime, collections, threading, time
 
 # Returns current timestamp as integer (number of seconds utc)
 def timestamp_now():
@@ -7,4 +7,61 @@ def timestamp_now():
 # Takes integer in utc and returns formated string of this datetime
 def timestamp_format(tstmp: int):
 	dt = datetime.datetime.fromtimestamp(tstmp)
-	return dt.strftime("%m/%d/%Y %H:%M:%S")
\ No newline at end of file
+	return dt.strftime("%m/%d/%Y %H:%M:%S")
+
+# Thread-safe bounded LRU cache with optional time-to-live of entries (in seconds) and hit/miss/eviction counters.
+# Fillers may pass generation() taken before reading the source to put(): if anything was invalidated
+# meanwhile, the (possibly stale) value is not stored
+class LruCache:
+	def __init__(self, size, ttl=None):
+		self.size = size
+		self.ttl = ttl
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+		self._generation = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def generation(self):
+		return self._generation
+
+	# Returns cached value, default - if absent or expired
+	def get(self, key, default=None):
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+				self._entries.move_to_end(key)
+				self.hits += 1
+				return entry[1]
+			if entry is not None:
+				del self._entries[key]
+				self.evictions += 1
+			self.misses += 1
+			return default
+
+	def put(self, key, value, generation=None):
+		with self._lock:
+			if generation is not None and generation != self._generation:
+				return False
+			expires = None if self.ttl is None else time.monotonic() + self.ttl
+			self._entries[key] = (expires, value)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.size:
+				self._entries.popitem(last=False)
+				self.evictions += 1
+			return True
+
+	def invalidate(self, key):
+		with self._lock:
+			self._generation += 1
+			return self._entries.pop(key, None) is not None
+
+	def clear(self):
+		with self._lock:
+			self._generation += 1
+			self._entries.clear()
+
+	def stats(self):
+		with self._lock:
+			return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
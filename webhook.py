@@ -0,0 +1,209 @@
+import hashlib, hmac, json, logging, queue, signal, ssl, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+from constants import *
+
+logger = logging.getLogger(__name__)
+
+# Webhook execution mode of the bot (RUNTIME_MODE = 'webhook').
+# Telegram POSTs updates to a local HTTP listener (TLS is optional, usually it is terminated by a reverse proxy).
+# Each update is put to one of WEBHOOK_WORKERS bounded queues chosen by chat_id, so updates of one chat are handled
+# in order by one worker, while different chats are handled in parallel. A full queue is answered with 503:
+# Telegram redelivers the update later, so the bot sheds load instead of growing memory.
+# Only requests carrying the secret token registered by setWebhook are accepted, so updates cannot be forged by
+# anyone who finds the listener. Both the token and the path are derived from the bot token by default
+
+# Returns value derived from the bot token for given purpose: stable over restarts, but not guessable
+def _derive(token, purpose):
+	return hmac.new(token.encode(), 'securestore webhook {0}'.format(purpose).encode(), hashlib.sha256).hexdigest()
+
+# Returns path of webhook requests of the bot with given token
+def webhook_path(token):
+	return WEBHOOK_PATH if WEBHOOK_PATH is not None else '/webhook/' + _derive(token, 'path')[:32]
+
+# Returns secret token, which Telegram sends in X-Telegram-Bot-Api-Secret-Token header of webhook requests
+def webhook_secret(token):
+	return WEBHOOK_SECRET if WEBHOOK_SECRET is not None else _derive(token, 'secret')
+
+# Returns key of the worker queue of given update
+def _update_key(update):
+	chat = update.effective_chat
+	return chat.id if chat is not None else update.update_id
+
+class _RequestHandler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_POST(self):
+		server = self.server.webhook
+		# Request is checked before its body is read, so that nobody but Telegram makes the bot allocate anything
+		if self.path != server.path:
+			self._reply(404, close=True)
+			return
+		if not hmac.compare_digest(self.headers.get('X-Telegram-Bot-Api-Secret-Token', '').encode(),
+								   server.secret.encode()):
+			logger.warning('Webhook request without valid secret token from {0}'.format(self.client_address[0]))
+			self._reply(403, close=True)
+			return
+		try:
+			length = int(self.headers.get('Content-Length', ''))
+		except ValueError:
+			length = -1
+		if length < 0:
+			self._reply(400, close=True)
+			return
+		if length > WEBHOOK_MAX_BODY:
+			logger.warning('Webhook request of {0} bytes refused'.format(length))
+			self._reply(413, close=True)
+			return
+		body = self.rfile.read(length)
+		try:
+			data = json.loads(body.decode('utf-8'))
+			update = Update.de_json(data, server.bot)
+		except Exception as e:
+			logger.warning('Malformed webhook request: {0}'.format(e))
+			self._reply(400)
+			return
+		if update is None:
+			self._reply(400)
+			return
+		self._reply(200 if server.put(update) else 503)
+
+	# Sends response without body. close - if body of the request is left unread, so the connection cannot be reused
+	def _reply(self, code, close=False):
+		self.send_response(code)
+		if code == 503:
+			self.send_header('Retry-After', str(WEBHOOK_RETRY_AFTER))
+		self.send_header('Content-Length', '0')
+		if close:
+			self.send_header('Connection', 'close')
+			self.close_connection = True
+		self.end_headers()
+
+	def log_message(self, format, *args):
+		logger.debug(format, *args)
+
+# HTTP listener feeding updates to the dispatcher (anything with process_update(update)) through bounded queues.
+# path and secret are derived from token of the bot by default
+class WebhookServer:
+	def __init__(self, dispatcher, bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=None, secret=None,
+				 workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE, cert=WEBHOOK_CERT, key=WEBHOOK_KEY):
+		self.dispatcher = dispatcher
+		self.bot = bot
+		self.path = path or webhook_path(bot.token)
+		self.secret = secret or webhook_secret(bot.token)
+		self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+		self._threads = []
+		self._lock = threading.Lock()
+		self._stats = {'accepted': 0, 'rejected': 0, 'handled': 0}
+
+		self._httpd = ThreadingHTTPServer((host, port), _RequestHandler)
+		self._httpd.daemon_threads = True
+		self._httpd.webhook = self
+		if cert is not None:
+			context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+			context.load_cert_chain(cert, key)
+			self._httpd.socket = context.wrap_socket(self._httpd.socket, server_side=True)
+
+	@property
+	def port(self):
+		return self._httpd.server_address[1]
+
+	# Queues given update. Returns False if the queue of its chat is full
+	def put(self, update):
+		try:
+			self._queues[hash(_update_key(update)) % len(self._queues)].put_nowait(update)
+		except queue.Full:
+			self._count('rejected')
+			return False
+		self._count('accepted')
+		return True
+
+	def _count(self, name):
+		with self._lock:
+			self._stats[name] += 1
+
+	# Returns dict of counters: accepted, rejected (503) and handled updates, and updates waiting in queues
+	def stats(self):
+		with self._lock:
+			stats = dict(self._stats)
+		stats['queued'] = sum(q.qsize() for q in self._queues)
+		return stats
+
+	def _work(self, updates):
+		while True:
+			update = updates.get()
+			try:
+				if update is None:
+					return
+				self.dispatcher.process_update(update)
+			except Exception as e:
+				logger.warning('Update "%s" caused error "%s"', update, e)
+			finally:
+				if update is not None:
+					self._count('handled')
+				updates.task_done()
+
+	def start(self):
+		for i, updates in enumerate(self._queues):
+			thread = threading.Thread(target=self._work, args=(updates,), name='webhook:{0}'.format(i), daemon=True)
+			thread.start()
+			self._threads.append(thread)
+		thread = threading.Thread(target=self._httpd.serve_forever, name='webhook:http', daemon=True)
+		thread.start()
+		self._threads.append(thread)
+
+	# Stops accepting requests, handles updates queued so far and stops workers
+	def stop(self):
+		self._httpd.shutdown()
+		self._httpd.server_close()
+		for updates in self._queues:
+			updates.put(None)
+		for thread in self._threads:
+			thread.join()
+		self._threads = []
+
+# Registers the webhook by setWebhook, if its public URL is configured
+def register(bot):
+	if WEBHOOK_URL is None:
+		return
+	# secret_token is not a named parameter of python-telegram-bot 12, extra arguments are passed to the API as is
+	kwargs = {'url': WEBHOOK_URL + webhook_path(bot.token), 'max_connections': WEBHOOK_MAX_CONNECTIONS,
+			  'secret_token': webhook_secret(bot.token)}
+	if WEBHOOK_SELF_SIGNED:
+		with open(WEBHOOK_CERT, 'rb') as certificate:
+			bot.set_webhook(certificate=certificate, **kwargs)
+	else:
+		bot.set_webhook(**kwargs)
+
+# Returns event, which is set on SIGINT/SIGTERM
+def stop_event():
+	stop = threading.Event()
+	for sig in (signal.SIGINT, signal.SIGTERM):
+		signal.signal(sig, lambda signum, frame: stop.set())
+	return stop
+
+# Runs the bot of given updater in webhook mode until SIGINT/SIGTERM
+def run(updater):
+	dp = updater.dispatcher
+	# Dispatcher thread itself stays idle, but its workers serve run_async (continuations of KDF jobs)
+	threading.Thread(target=dp.start, name='dispatcher', daemon=True).start()
+	updater.job_queue.start()
+
+	server = WebhookServer(dp, updater.bot)
+	server.start()
+	logger.info('Listening to webhook at port {0}'.format(server.port))
+	register(updater.bot)
+
+	stop = stop_event()
+	try:
+		stop.wait()
+	finally:
+		server.stop()
+		logger.info('Webhook stopped: {0}'.format(server.stats()))
+		updater.job_queue.stop()
+		dp.stop()
+		if dp.persistence:
+			dp.update_persistence()
+			dp.persistence.flush()
@@ -0,0 +1,110 @@
+# Offline throughput test of the webhook mode: POSTs recorded updates (JSON object per line) at a webhook
+# and reports rate of accepted requests and amount of 503s. Rejected updates are sent again after Retry-After,
+# as Telegram does. Without URL a local WebhookServer is started, whose dispatcher only simulates handling time
+# and checks that updates of every chat are handled in order. Without file updates of CHATS chats are generated.
+# Requests to a given URL carry given secret token (see webhook.py).
+# Usage: python webhook_replay.py [updates.jsonl|-] [url secret]
+import http.client, json, sys, threading, time
+from urllib.parse import urlsplit
+
+from webhook import WebhookServer
+from constants import *
+
+UPDATES = 20000
+CHATS = 500
+SENDERS = 16
+HANDLE_TIME = 0.0005
+PATH = '/webhook'
+SECRET = 'replay'
+
+def synthesize(count=UPDATES, chats=CHATS):
+	for i in range(count):
+		chat_id = 1000 + i % chats
+		yield {'update_id': i + 1, 'message': {'message_id': i + 1, 'date': int(time.time()), 'text': 'replay',
+				'chat': {'id': chat_id, 'type': 'private'}, 'from': {'id': chat_id, 'is_bot': False, 'first_name': 'replay'}}}
+
+def load(path):
+	with open(path) as f:
+		for line in f:
+			line = line.strip()
+			if line:
+				data = json.loads(line)
+				if 'update_id' in data:
+					yield data
+
+# Dispatcher of the local server: spends HANDLE_TIME per update and counts updates out of order
+class Sink:
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._last = {}
+		self.reordered = 0
+
+	def process_update(self, update):
+		time.sleep(HANDLE_TIME)
+		chat_id = update.effective_chat.id
+		with self._lock:
+			if self._last.get(chat_id, 0) > update.update_id:
+				self.reordered += 1
+			self._last[chat_id] = update.update_id
+
+def send(url, secret, bodies, stats, lock):
+	parts = urlsplit(url)
+	connection_type = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+	connection = connection_type(parts.hostname, parts.port)
+	headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': secret}
+	accepted = rejected = 0
+	for body in bodies:
+		while True:
+			connection.request('POST', parts.path, body, headers)
+			response = connection.getresponse()
+			response.read()
+			if response.status == 403:
+				raise SystemExit('Webhook refused the secret token')
+			if response.status != 503:
+				accepted += 1
+				break
+			rejected += 1
+			time.sleep(float(response.getheader('Retry-After', 1)))
+	connection.close()
+	with lock:
+		stats[0] += accepted
+		stats[1] += rejected
+
+def replay(url, secret, updates, senders=SENDERS):
+	# Updates of one chat are sent by one sender, so that they arrive in order
+	shards = [[] for _ in range(senders)]
+	for data in updates:
+		message = data.get('message') or data.get('callback_query', {}).get('message') or {}
+		chat_id = message.get('chat', {}).get('id', data['update_id'])
+		shards[hash(chat_id) % senders].append(json.dumps(data).encode('utf-8'))
+
+	stats, lock = [0, 0], threading.Lock()
+	threads = [threading.Thread(target=send, args=(url, secret, shard, stats, lock)) for shard in shards]
+	start = time.perf_counter()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return stats[0], stats[1], time.perf_counter() - start
+
+if __name__ == '__main__':
+	updates = list(load(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1] != '-' else synthesize())
+	server = sink = None
+	if len(sys.argv) > 3:
+		url, secret = sys.argv[2], sys.argv[3]
+	else:
+		sink = Sink()
+		server = WebhookServer(sink, None, port=0, path=PATH, secret=SECRET)
+		server.start()
+		url, secret = 'http://{0}:{1}{2}'.format(WEBHOOK_HOST, server.port, PATH), SECRET
+
+	accepted, rejected, elapsed = replay(url, secret, updates)
+	print('updates: {0}, accepted: {1}, 503: {2}, {3:.0f} updates/s'.format(len(updates), accepted, rejected,
+																			accepted / elapsed))
+	if server is not None:
+		start = time.perf_counter()
+		while server.stats()['queued'] > 0:
+			time.sleep(0.01)
+		server.stop()
+		print('handled: {0} in {1:.2f} s, out of order: {2}'.format(server.stats()['handled'],
+																	elapsed + time.perf_counter() - start, sink.reordered))